@@ -0,0 +1,294 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource # Só existe em sistemas Unix; sem ele o RSS não é medido.
+except ImportError:
+    resource = None
+
+from node import METRICS, ChatNode, EventLoop, setup_logging
+
+SCENARIOS = ('pairs', 'many-to-one', 'fan-out')
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] # Nearest-rank.
+
+def process_stats():
+    stats = {'cpu_s': round(time.process_time(), 3), 'max_rss_kb': None}
+    if resource:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats['max_rss_kb'] = max_rss // 1024 if sys.platform == 'darwin' else max_rss # macOS informa em bytes.
+    return stats
+
+class BenchNode:
+    """Um nó headless comandado pelo coordenador por um Pipe; os comandos rodam no loop do nó."""
+    def __init__(self, index, conn, use_asyncio, workdir):
+        self.conn = conn
+        self.loop = EventLoop()
+        self.node = ChatNode(self.loop, use_asyncio, data_dir=workdir) # Ignora CHATMESH_DATA_DIR herdado do coordenador.
+        self.node.set_username(f"bench{index}")
+        self.latencies = []
+        self.last_receive = None
+        self.node.signals.new_message.connect(lambda sender_id, content, timestamp, message_id: self.received(content))
+        self.node.signals.new_group_message.connect(lambda group_id, sender_id, content, timestamp, message_id: self.received(content))
+
+    def received(self, content):
+        now = time.time()
+        self.latencies.append(now - float(content.split(' ', 1)[0])) # O conteúdo começa com o instante do envio.
+        self.last_receive = now
+
+    def run(self):
+        self.node.start()
+        self.started = time.time()
+        threading.Thread(target=self.read_commands, daemon=True).start()
+        try:
+            self.loop.run()
+        finally:
+            self.node.stop()
+
+    def read_commands(self):
+        while True:
+            try:
+                command, args = self.conn.recv()
+            except EOFError: # Coordenador morreu: encerra o nó.
+                command, args = 'stop', ()
+            self.loop.call_soon(lambda command=command, args=args: self.reply(getattr(self, 'cmd_' + command)(*args)))
+            if command == 'stop':
+                return
+
+    def reply(self, result):
+        if result is not None: # Comandos que esperam algo respondem depois, pelo próprio poll.
+            self.conn.send(result)
+
+    def poll(self, condition, result, timeout):
+        deadline = time.time() + timeout
+        def check():
+            if condition() or time.time() >= deadline:
+                self.conn.send(result())
+            else:
+                self.loop.call_later(0.005, check)
+        check()
+
+    def message(self, size):
+        content = f"{time.time():.6f} "
+        return content + 'x' * max(0, size - len(content))
+
+    def cmd_info(self):
+        return {'user_id': self.node.user_id, 'username': self.node.username, 'tcp_port': self.node.tcp_port}
+
+    def cmd_wait_peers(self, peer_ids, timeout):
+        # Convergência: quando todos os outros nós aparecem em self.peers, via listen_for_peers.
+        self.poll(lambda: all(peer_id in self.node.peers for peer_id in peer_ids),
+                  lambda: {'started': self.started, 'converged': time.time(), 'known': sum(peer_id in self.node.peers for peer_id in peer_ids)}, timeout)
+
+    def cmd_befriend(self, friends):
+        for friend_id, username in friends: # Atalho do benchmark: amizade já aceita dos dois lados, sem o diálogo.
+            self.node.friend_cache.add(friend_id, username, 'accepted', replace=True)
+        return True
+
+    def cmd_create_group(self, name, members):
+        return self.node.create_group(name, dict(members))
+
+    def cmd_wait_group(self, group_id, timeout):
+        self.poll(lambda: group_id in self.node.groups, lambda: group_id in self.node.groups, timeout)
+
+    def cmd_send(self, peer_ids, count, size):
+        for _ in range(count):
+            for peer_id in peer_ids:
+                self.node.send_message(peer_id, self.message(size))
+        return True
+
+    def cmd_send_group(self, group_id, count, size):
+        for _ in range(count):
+            self.node.send_group_message(group_id, self.message(size))
+        return True
+
+    def cmd_collect(self, expected, timeout):
+        def result():
+            latencies, self.latencies = self.latencies, []
+            return {'latencies': latencies, 'last_receive': self.last_receive}
+        self.poll(lambda: len(self.latencies) >= expected, result, timeout)
+
+    def cmd_stats(self, metrics=False):
+        return dict(process_stats(), metrics=METRICS.snapshot()) if metrics else process_stats()
+
+    def cmd_stop(self):
+        self.loop.stop()
+        return True
+
+def node_main(index, workdir, conn, use_asyncio):
+    os.chdir(workdir) # Banco, recebidos/ e log próprios de cada nó.
+    sys.stdout = sys.stderr = open('node.log', 'w', buffering=1) # Os logs do nó fazem parte do custo medido, mas não poluem o terminal.
+    setup_logging() # Depois do redirecionamento: o handler escreve no sys.stderr atual.
+    for name in ('CHATMESH_PEER_FRAME_RATE', 'CHATMESH_PEER_BYTE_RATE'): # Todos os nós dividem 127.0.0.1 e os limites desse endereço.
+        os.environ.setdefault(name, '0')
+    BenchNode(index, conn, use_asyncio, workdir).run()
+
+class Cluster:
+    """Coordenador: sobe N nós em processos separados e envia comandos a todos ou a alguns."""
+    def __init__(self, count, use_asyncio, root):
+        context = multiprocessing.get_context('spawn') # Processos limpos, sem herdar threads do coordenador.
+        self.conns, self.processes = [], []
+        for index in range(count):
+            workdir = os.path.join(root, f"node{index}")
+            os.makedirs(workdir)
+            parent, child = context.Pipe()
+            process = context.Process(target=node_main, args=(index, workdir, child, use_asyncio), daemon=True)
+            process.start()
+            self.conns.append(parent)
+            self.processes.append(process)
+
+    def call(self, indexes, command, *args):
+        for index in indexes:
+            self.conns[index].send((command, args))
+        return [self.conns[index].recv() for index in indexes]
+
+    def call_each(self, calls):
+        for index, command, args in calls: # Comandos diferentes por nó, disparados antes de esperar as respostas.
+            self.conns[index].send((command, args))
+        return [self.conns[index].recv() for index, command, args in calls]
+
+    def stop(self):
+        for conn in self.conns:
+            try:
+                conn.send(('stop', ()))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+
+def run_scenario(cluster, name, infos, group_id, messages, size, timeout):
+    everyone = range(len(infos))
+    if name == 'pairs': # Cada nó envia uma rajada ao próximo, em anel.
+        sends = [(i, 'send', ([infos[(i + 1) % len(infos)]['user_id']], messages, size)) for i in everyone]
+        receivers = {i: messages for i in everyone}
+    elif name == 'many-to-one': # Todos enviam ao nó 0.
+        sends = [(i, 'send', ([infos[0]['user_id']], messages, size)) for i in everyone if i]
+        receivers = {0: messages * (len(infos) - 1)}
+    else: # fan-out: o nó 0 envia ao grupo com todos os outros.
+        sends = [(0, 'send_group', (group_id, messages, size))]
+        receivers = {i: messages for i in everyone if i}
+    before = cluster.call(everyone, 'stats')
+    started = time.time()
+    cluster.call_each(sends)
+    collected = cluster.call_each([(i, 'collect', (expected, timeout)) for i, expected in receivers.items()])
+    after = cluster.call(everyone, 'stats')
+    latencies = [latency for result in collected for latency in result['latencies']]
+    finished = max((result['last_receive'] or started) for result in collected)
+    expected = sum(receivers.values())
+    elapsed = max(finished - started, 1e-9)
+    return {
+        'expected': expected,
+        'delivered': len(latencies),
+        'duration_s': round(elapsed, 4),
+        'messages_per_s': round(len(latencies) / elapsed, 1),
+        'latency_ms': {key: (round(value * 1000, 3) if value is not None else None) for key, value in (
+            ('p50', percentile(latencies, 0.50)), ('p95', percentile(latencies, 0.95)),
+            ('p99', percentile(latencies, 0.99)), ('max', max(latencies, default=None)))},
+        'cpu_s': [round(b['cpu_s'] - a['cpu_s'], 3) for a, b in zip(before, after)], # Por nó, só durante o cenário.
+    }
+
+def run_benchmark(args):
+    root = args.workdir or tempfile.mkdtemp(prefix='chatmesh-bench-')
+    os.makedirs(root, exist_ok=True)
+    cluster = Cluster(args.nodes, args.engine == 'asyncio', root)
+    try:
+        infos = cluster.call(range(args.nodes), 'info')
+        ids = [info['user_id'] for info in infos]
+        convergence = cluster.call_each([(i, 'wait_peers', ([peer_id for peer_id in ids if peer_id != ids[i]], args.timeout)) for i in range(args.nodes)])
+        if any(result['known'] < args.nodes - 1 for result in convergence):
+            raise SystemExit(f"[BENCH] Descoberta não convergiu em {args.timeout}s: {[result['known'] for result in convergence]}")
+        discovery_s = max(result['converged'] for result in convergence) - max(result['started'] for result in convergence)
+        print(f"[BENCH] {args.nodes} nós descobertos em {discovery_s:.3f}s.") # Log.
+        cluster.call_each([(i, 'befriend', ([(info['user_id'], info['username']) for info in infos if info is not infos[i]],)) for i in range(args.nodes)])
+        group_id = None
+        if 'fan-out' in args.scenarios:
+            group_id = cluster.call([0], 'create_group', 'bench', [(info['user_id'], info['username']) for info in infos[1:]])[0]
+            if not all(cluster.call(range(1, args.nodes), 'wait_group', group_id, args.timeout)):
+                raise SystemExit("[BENCH] Convite do grupo não chegou a todos os nós.")
+        results = {
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'engine': args.engine,
+            'nodes': args.nodes,
+            'messages': args.messages,
+            'size': args.size,
+            'discovery_s': round(discovery_s, 4),
+            'scenarios': {},
+        }
+        for name in args.scenarios:
+            result = run_scenario(cluster, name, infos, group_id, args.messages, args.size, args.timeout)
+            results['scenarios'][name] = result
+            print(f"[BENCH] {name}: {result['delivered']}/{result['expected']} em {result['duration_s']}s, "
+                  f"{result['messages_per_s']} msg/s, p50 {result['latency_ms']['p50']} ms, p99 {result['latency_ms']['p99']} ms.") # Log.
+        results['node_stats'] = cluster.call(range(args.nodes), 'stats', True) # CPU total, pico de RSS e métricas de cada nó.
+        return results
+    finally:
+        cluster.stop()
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+def compare(results, baseline, tolerance):
+    """Devolve as regressões em relação a `baseline`: vazão menor ou p99 maior que a tolerância."""
+    regressions = []
+    for name, result in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        if result['messages_per_s'] < previous['messages_per_s'] * (1 - tolerance):
+            regressions.append(f"{name}: vazão {previous['messages_per_s']} -> {result['messages_per_s']} msg/s")
+        if None not in (result['latency_ms']['p99'], previous['latency_ms']['p99']) and result['latency_ms']['p99'] > previous['latency_ms']['p99'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {previous['latency_ms']['p99']} -> {result['latency_ms']['p99']} ms")
+        if result['delivered'] < result['expected']:
+            regressions.append(f"{name}: {result['expected'] - result['delivered']} mensagem(ns) não entregue(s)")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de vários nós ChatMesh headless no localhost.")
+    parser.add_argument('--nodes', type=int, default=4, help="número de nós (padrão 4)")
+    parser.add_argument('--messages', type=int, default=500, help="mensagens por remetente em cada cenário (padrão 500)")
+    parser.add_argument('--size', type=int, default=64, help="tamanho do conteúdo em bytes (padrão 64)")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"cenários separados por vírgula ({', '.join(SCENARIOS)})")
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads', help="engine de rede dos nós")
+    parser.add_argument('--timeout', type=float, default=60, help="limite em segundos para descoberta e entrega")
+    parser.add_argument('--workdir', help="diretório dos bancos e logs dos nós (padrão: temporário, apagado no fim)")
+    parser.add_argument('--output', help="grava o resultado em JSON neste arquivo (padrão: stdout)")
+    parser.add_argument('--compare', help="JSON de uma execução anterior; sai com erro se houver regressão")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="regressão tolerada no --compare (padrão 0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown or args.nodes < 2:
+        parser.error(f"cenários desconhecidos: {', '.join(sorted(unknown))}" if unknown else "--nodes deve ser pelo menos 2")
+    results = run_benchmark(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"[BENCH] Regressão: {regression}") # Log.
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
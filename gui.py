@@ -0,0 +1,699 @@
+import logging
+import socket
+import time
+from datetime import datetime
+from PySide6.QtWidgets import (
+    QApplication, QMainWindow, QWidget, QVBoxLayout,
+    QHBoxLayout, QLabel, QLineEdit, QPushButton,
+    QListView, QMessageBox, QDialog, QFileDialog, QInputDialog, QStyledItemDelegate, QStyle
+)
+from PySide6.QtCore import Qt, Signal, QObject, QTimer, QAbstractListModel, QModelIndex, QPoint, QRect, QSize
+from PySide6.QtGui import QStandardItemModel, QStandardItem
+from node import ChatNode, Scheduler, TimerHandle, METRICS, HISTORY_PAGE_SIZE, SEARCH_PAGE_SIZE, fts_query
+
+log = logging.getLogger('chatmesh.gui')
+UI_UPDATE_MS = METRICS.histogram('ui.update_ms') # Tempo de cada callback do nó na thread da interface.
+
+class QtEventLoop(QObject, Scheduler):
+    """Laço do nó sobre o loop do Qt: callbacks vindos de qualquer thread rodam na thread da interface."""
+    invoke = Signal(object, object)
+    schedule = Signal(float, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.invoke.connect(self.run_callback, Qt.QueuedConnection) # Sempre enfileirado, mesmo na própria thread.
+        self.schedule.connect(self.start_timer, Qt.QueuedConnection)
+
+    def call_soon(self, function, *args):
+        self.invoke.emit(function, args)
+
+    def call_later(self, delay, function, *args):
+        handle = TimerHandle(function, args)
+        self.schedule.emit(delay, handle) # O QTimer precisa ser criado na thread da interface.
+        return handle
+
+    def run_callback(self, function, args):
+        started = time.perf_counter()
+        try:
+            function(*args)
+        finally:
+            UI_UPDATE_MS.observe_since(started)
+
+    def start_timer(self, delay, handle):
+        QTimer.singleShot(int(delay * 1000), lambda: self.run_callback(handle.run, ())) # O Qt não mantém vivo o método de um objeto comum; a lambda sim.
+
+class FriendsListModel(QAbstractListModel):
+    """Lista de amigos com índice id -> linha: mudanças de status são O(1) e só repintam a linha alterada."""
+    UsernameRole = Qt.UserRole + 1 # Qt.UserRole guarda o ID do amigo.
+    OnlineRole = Qt.UserRole + 2
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = [] # Lista de [friend_id, username, online]; grupos têm online None.
+        self.row_by_id = {} # friend_id -> posição em self.rows.
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        friend_id, username, online = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            if online is None: # Grupo: não tem status próprio.
+                return f"👥 {username}"
+            return f"{'🟢' if online else '⚫'} {username} ({friend_id})"
+        if role == Qt.UserRole:
+            return friend_id
+        if role == self.UsernameRole:
+            return username
+        if role == self.OnlineRole:
+            return online
+        return None
+
+    def set_friends(self, friends):
+        self.beginResetModel()
+        self.rows = [[friend_id, username, online] for friend_id, username, online in friends]
+        self.row_by_id = {row[0]: i for i, row in enumerate(self.rows)}
+        self.endResetModel()
+
+    def contains(self, friend_id):
+        return friend_id in self.row_by_id
+
+    def add_friend(self, friend_id, username, online):
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.rows.append([friend_id, username, online])
+        self.row_by_id[friend_id] = position
+        self.endInsertRows()
+
+    def set_online(self, friend_id, online):
+        position = self.row_by_id.get(friend_id)
+        if position is None:
+            return False
+        if self.rows[position][2] != online: # Sem mudança, nada é repintado.
+            self.rows[position][2] = online
+            index = self.index(position)
+            self.dataChanged.emit(index, index, [Qt.DisplayRole, self.OnlineRole])
+        return True
+
+class MessageListModel(QAbstractListModel):
+    """Linhas da conversa aberta, no máximo MAX_ROWS: páginas fora da tela são descartadas e relidas do banco."""
+    MAX_ROWS = 5 * HISTORY_PAGE_SIZE # Cerca de 15 telas; o custo de cada relayout não cresce com a conversa.
+    MessageIdRole = Qt.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = [] # Lista de [texto, status, message_id, chave (timestamp, id) ou None, sequência, altura ou None].
+        self.row_by_id = {} # message_id -> linha; a posição é sequência - sequência da primeira linha (O(1)).
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        text, status, message_id = self.rows[index.row()][:3]
+        if role == Qt.DisplayRole:
+            return f"{text} [{status}]" if status else text
+        if role == self.MessageIdRole:
+            return message_id
+        return None
+
+    def make_rows(self, entries, first_sequence):
+        rows = [[text, None, message_id, key, first_sequence + i, None] for i, (text, message_id, key) in enumerate(entries)]
+        self.row_by_id.update((row[2], row) for row in rows if row[2])
+        return rows
+
+    def reset(self, entries=()):
+        self.beginResetModel()
+        self.row_by_id = {}
+        self.rows = self.make_rows(entries, 0)
+        self.endResetModel()
+
+    def append(self, entries):
+        if not entries:
+            return
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position + len(entries) - 1) # Um único insert por lote.
+        self.rows.extend(self.make_rows(entries, self.rows[-1][4] + 1 if self.rows else 0))
+        self.endInsertRows()
+
+    def prepend(self, entries):
+        if not entries:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(entries) - 1)
+        self.rows[0:0] = self.make_rows(entries, (self.rows[0][4] if self.rows else 0) - len(entries))
+        self.endInsertRows()
+
+    def drop(self, count, front):
+        count = min(count, len(self.rows))
+        if not count:
+            return
+        first = 0 if front else len(self.rows) - count
+        self.beginRemoveRows(QModelIndex(), first, first + count - 1)
+        for row in self.rows[first:first + count]:
+            self.row_by_id.pop(row[2], None)
+        del self.rows[first:first + count]
+        self.endRemoveRows()
+
+    def set_status(self, message_id, status):
+        row = self.row_by_id.get(message_id)
+        if row is None: # Mensagem de outra conversa ou já descartada.
+            return False
+        row[1] = status
+        row[5] = None # O texto mudou: a altura é medida de novo.
+        index = self.index(row[4] - self.rows[0][4])
+        self.dataChanged.emit(index, index, [Qt.DisplayRole]) # Repinta só a linha alterada.
+        return True
+
+    def edge(self, front):
+        return self.rows if front else reversed(self.rows) # Da borda para dentro.
+
+    def height(self, count):
+        heights = [row[5] for row in self.rows[:count]]
+        return None if None in heights else sum(heights) # Altura das primeiras linhas; None se alguma não foi medida.
+
+class MessageDelegate(QStyledItemDelegate):
+    """Desenha a mensagem com quebra de linha; a altura vem das métricas da fonte, sem um QTextDocument por linha."""
+    MARGIN = 4
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.width = None
+
+    def sizeHint(self, option, index):
+        width = self.parent().viewport().width()
+        if width != self.width: # Largura nova invalida todas as quebras de linha.
+            self.width = width
+            for row in index.model().rows:
+                row[5] = None
+        row = index.model().rows[index.row()]
+        if row[5] is None: # Cada relayout do QListView mede só as linhas novas ou alteradas.
+            rect = QRect(0, 0, max(1, width - 2 * self.MARGIN), 1 << 20)
+            row[5] = option.fontMetrics.boundingRect(rect, Qt.TextWordWrap, index.data()).height() + self.MARGIN
+        return QSize(width, row[5])
+
+    def paint(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+            painter.setPen(option.palette.highlightedText().color())
+        painter.drawText(option.rect.adjusted(self.MARGIN, self.MARGIN // 2, -self.MARGIN, 0), Qt.TextWordWrap, index.data())
+        painter.restore()
+
+class FriendRequestDialog(QDialog):
+    def __init__(self, sender_id, sender_username, parent=None):
+        super().__init__(parent)
+        self.sender_id = sender_id
+        self.setWindowTitle("Solicitação de Amizade")
+        self.setModal(True)
+        layout = QVBoxLayout(self)
+        message = QLabel(f"{sender_username} ({sender_id}) quer ser seu amigo!")
+        accept_btn = QPushButton("Aceitar") # Botão para aceitar a solicitação.
+        reject_btn = QPushButton("Rejeitar") # Botão para rejeitar a solicitação.
+        accept_btn.clicked.connect(self.accept_request)
+        reject_btn.clicked.connect(self.reject_request)
+        layout.addWidget(message)
+        layout.addWidget(accept_btn)
+        layout.addWidget(reject_btn)
+        
+    def accept_request(self):
+        self.done(1)
+        
+    def reject_request(self):
+        self.done(0)
+
+class P2PChat(QMainWindow):
+    def __init__(self, use_asyncio=None, data_dir=None):
+        super().__init__()
+        self.loop = QtEventLoop(self) # Sinais e timers do nó entregues na thread da interface.
+        self.node = ChatNode(self.loop, use_asyncio, data_dir) # Rede, protocolo e armazenamento, sem dependência do Qt.
+        self.active_chat = None 
+        self.history_cursor = None # (timestamp, id) da mensagem mais antiga exibida na conversa ativa.
+        self.history_newer = None # (timestamp, id) da mais recente exibida quando o fim da conversa foi descartado.
+        self.pending_rows = [] # Mensagens recebidas aguardando o próximo quadro.
+        self.history_sender_name = "Amigo" # Nome do amigo da conversa ativa, resolvido uma vez por chat.
+        self.history_member_names = {} # Em grupos: member_id -> nome, para identificar cada remetente.
+        self.search_state = None # Consulta, escopo e deslocamento da busca em andamento.
+        self.init_ui() # Inicializa a interface do usuário.
+        self.node.start() # Inicia as threads de rede e os timers do nó.
+        self.load_friends() # Carrega os amigos que já estão no banco de dados ao iniciar.
+
+    def init_ui(self):
+        self.setWindowTitle('P2P Chat') # Define o título da janela.
+        self.setGeometry(100, 100, 800, 600) # Define a posição e o tamanho da janela.
+        main_widget = QWidget() # Cria um widget central para a janela.
+        self.setCentralWidget(main_widget) # Define o widget central.
+        layout = QHBoxLayout(main_widget) # Layout horizontal principal para dividir a janela.
+        left_panel = QWidget()
+        left_layout = QVBoxLayout(left_panel) # Layout vertical para o painel esquerdo.
+        profile_group = QWidget()
+        profile_layout = QVBoxLayout(profile_group) # Layout para a seção de perfil.
+        self.username_label = QLabel("Nome de Usuário: Não definido") # Rótulo para exibir o nome de usuário.
+        self.user_id_label = QLabel(f"Seu ID: {self.node.user_id}") # Rótulo para exibir o ID do usuário.
+        self.user_id_label.setWordWrap(True) # Permite que o texto do ID quebre linhas.
+        copy_id_btn = QPushButton("Copiar ID") # Botão para copiar o ID do usuário.
+        copy_id_btn.clicked.connect(self.copy_user_id) # Conecta o botão ao método de cópia.
+        profile_layout.addWidget(self.username_label)
+        profile_layout.addWidget(self.user_id_label)
+        profile_layout.addWidget(copy_id_btn)
+        friends_label = QLabel("Amigos") # Rótulo para a lista de amigos.
+        self.friends_model = FriendsListModel(self) # Modelo com os amigos, seus nomes e status.
+        self.friends_list = QListView() # Widget de lista para exibir amigos.
+        self.friends_list.setModel(self.friends_model)
+        self.friends_list.setUniformItemSizes(True) # Todas as linhas têm a mesma altura: layout mais barato.
+        self.friends_list.clicked.connect(self.select_chat) # Conecta o clique em um amigo para abrir o chat.
+        add_friend_layout = QHBoxLayout() # Layout horizontal para o campo de adicionar amigo.
+        self.friend_id_input = QLineEdit() # Campo de entrada para o ID do amigo.
+        self.friend_id_input.setPlaceholderText("Digite o ID do amigo") # Texto de placeholder.
+        add_friend_btn = QPushButton("Adicionar Amigo") # Botão para enviar solicitação de amizade.
+        add_friend_btn.clicked.connect(self.send_friend_request) # Conecta o botão ao método de envio.
+        add_friend_layout.addWidget(self.friend_id_input)
+        add_friend_layout.addWidget(add_friend_btn)
+        self.friends_list.setSelectionMode(QListView.ExtendedSelection) # Ctrl+clique escolhe os membros de um novo grupo.
+        create_group_btn = QPushButton("Criar grupo com selecionados") # Cria um grupo com os amigos selecionados.
+        create_group_btn.clicked.connect(self.create_group)
+        self.search_input = QLineEdit() # Campo de busca no histórico.
+        self.search_input.setPlaceholderText("Buscar mensagens (Enter)...")
+        self.search_input.returnPressed.connect(self.run_search)
+        self.search_input.setEnabled(self.node.search_enabled)
+        self.search_model = QStandardItemModel(self) # Resultados da busca; Qt.UserRole guarda o ID do amigo.
+        self.search_results = QListView() # Lista de resultados; clicar abre a conversa.
+        self.search_results.setModel(self.search_model)
+        self.search_results.setUniformItemSizes(True)
+        self.search_results.setEditTriggers(QListView.NoEditTriggers)
+        self.search_results.clicked.connect(self.select_chat)
+        self.search_results.verticalScrollBar().valueChanged.connect(self.on_search_scrolled) # Próxima página ao chegar no fim.
+        left_layout.addWidget(profile_group)
+        left_layout.addWidget(friends_label)
+        left_layout.addWidget(self.friends_list)
+        left_layout.addLayout(add_friend_layout)
+        left_layout.addWidget(create_group_btn)
+        left_layout.addWidget(self.search_input)
+        left_layout.addWidget(self.search_results)
+        right_panel = QWidget()
+        right_layout = QVBoxLayout(right_panel) # Layout vertical para o painel direito.
+        self.chat_model = MessageListModel(self) # Só as páginas próximas da tela ficam em memória.
+        self.chat_view = QListView() # Desenha apenas as linhas visíveis, por maior que seja a conversa.
+        self.chat_view.setModel(self.chat_model)
+        self.chat_view.setItemDelegate(MessageDelegate(self.chat_view))
+        self.chat_view.setResizeMode(QListView.Adjust) # Recalcula as quebras de linha ao redimensionar.
+        self.chat_view.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.chat_view.setEditTriggers(QListView.NoEditTriggers)
+        self.chat_view.verticalScrollBar().valueChanged.connect(self.on_chat_scrolled) # Carrega páginas ao chegar às bordas.
+        chat_input_layout = QHBoxLayout() # Layout horizontal para o campo de entrada de mensagem.
+        self.message_input = QLineEdit() # Campo de entrada para digitar mensagens.
+        self.message_input.setPlaceholderText("Digite sua mensagem...") # Texto de placeholder.
+        self.message_input.returnPressed.connect(self.send_message) # Conecta a tecla Enter para enviar mensagem.
+        send_btn = QPushButton("Enviar") # Botão para enviar mensagem.
+        send_btn.clicked.connect(self.send_message) # Conecta o botão ao método de envio.
+        chat_input_layout.addWidget(self.message_input)
+        file_btn = QPushButton("Enviar arquivo") # Envia um arquivo ao amigo do chat ativo.
+        file_btn.clicked.connect(self.send_file)
+        chat_input_layout.addWidget(send_btn)
+        chat_input_layout.addWidget(file_btn)
+        right_layout.addWidget(self.chat_view)
+        right_layout.addLayout(chat_input_layout)
+        layout.addWidget(left_panel, 1) # Painel esquerdo ocupa 1 parte.
+        layout.addWidget(right_panel, 2) # Painel direito ocupa 2 partes (maior).
+        self.node.signals.new_message.connect(self.handle_new_message)
+        self.node.signals.new_group_message.connect(self.handle_new_group_message)
+        self.node.signals.peer_status.connect(self.update_peer_status)
+        self.node.signals.friend_request.connect(self.handle_friend_request)
+        self.node.signals.friend_response.connect(self.handle_friend_response)
+        self.node.signals.update_friends_list.connect(self.load_friends)
+        self.node.signals.message_status.connect(self.show_message_status)
+        self.node.signals.group_status.connect(self.show_group_status)
+        self.node.signals.file_offer.connect(self.handle_file_offer)
+        self.node.signals.file_progress.connect(self.show_file_progress)
+        self.node.signals.file_status.connect(self.show_file_status)
+        self.show_login_dialog() # Exibe o diálogo de login ao iniciar o aplicativo.
+        
+
+    def copy_user_id(self):
+        clipboard = QApplication.clipboard() # Obtém o objeto da área de transferência.
+        clipboard.setText(self.node.user_id) # Define o texto na área de transferência.
+        QMessageBox.information(self, "Sucesso", "ID de usuário copiado para a área de transferência!") # Exibe uma mensagem de sucesso.
+        
+
+    def show_login_dialog(self):
+        dialog = QDialog(self) # Cria um novo diálogo.
+        dialog.setWindowTitle("Login") # Define o título do diálogo.
+        layout = QVBoxLayout(dialog) # Layout vertical para o diálogo.
+        username_input = QLineEdit() # Campo de entrada para o nome de usuário.
+        username_input.setPlaceholderText("Digite seu nome de usuário") # Texto de placeholder.
+        username_input.setText(self.node.username) # Nome da última execução com este diretório de dados.
+        login_btn = QPushButton("Entrar") # Botão de login.
+        layout.addWidget(username_input)
+        layout.addWidget(login_btn)
+        
+        def handle_login():
+            username = username_input.text().strip() # Obtém o nome de usuário e remove espaços extras.
+            if username: # Verifica se o nome de usuário não está vazio.
+                self.node.set_username(username) # Define o nome de usuário do nó (e grava o perfil).
+                self.username_label.setText(f"Nome de Usuário: {username}") # Atualiza o rótulo da UI.
+                dialog.accept() # Fecha o diálogo de login.
+            else:
+                QMessageBox.warning(dialog, "Erro", "Por favor, digite um nome de usuário.") # Exibe um aviso se o nome for vazio.
+        login_btn.clicked.connect(handle_login) # Conecta o botão de login à função.
+        dialog.exec() # Executa o diálogo (bloqueia até ser fechado).
+        
+
+    def send_friend_request(self):
+        friend_id = self.friend_id_input.text().strip() # Obtém o ID do campo de entrada.
+        if not friend_id: # Validação do ID.
+            QMessageBox.warning(self, "Erro", "Por favor, digite o ID do amigo.")
+            return
+        if friend_id == self.node.user_id: # Não pode adicionar a si mesmo.
+            QMessageBox.warning(self, "Erro", "Você não pode se adicionar como amigo.")
+            return
+        existing_friend = self.node.friend_cache.status(friend_id)
+        if existing_friend: # Se já existe um status de amizade.
+            if existing_friend == 'accepted':
+                QMessageBox.information(self, "Info", "Este usuário já é seu amigo.")
+            elif existing_friend == 'pending_sent':
+                QMessageBox.information(self, "Info", "Solicitação de amizade já enviada para este usuário.")
+            elif existing_friend == 'pending_received':
+                QMessageBox.information(self, "Info", "Você tem uma solicitação de amizade pendente deste usuário. Por favor, aceite-a.")
+            return
+        username = (self.node.lookup_peer(friend_id) or (friend_id,))[0]
+        if not self.node.send_friend_request(friend_id, on_done=lambda error: self.friend_request_sent(friend_id, username, error)):
+            QMessageBox.warning(self, "Erro", "Usuário não encontrado na rede ou offline. Por favor, certifique-se de que ele esteja online.")
+
+    def friend_request_sent(self, friend_id, username, error):
+        if error is None:
+            QMessageBox.information(self, "Sucesso", "Solicitação de amizade enviada!") # Mensagem de sucesso.
+            if self.friend_id_input.text().strip() == friend_id:
+                self.friend_id_input.clear() # Limpa o campo de entrada.
+        elif isinstance(error, socket.timeout): # Erro se o tempo limite de conexão for excedido.
+            QMessageBox.warning(self, "Erro", f"Tempo limite excedido ao tentar conectar ao peer {username} ({friend_id}). Ele pode estar offline ou o firewall bloqueando.")
+        elif isinstance(error, ConnectionRefusedError): # Erro se a conexão for recusada pelo peer.
+            QMessageBox.warning(self, "Erro", f"Conexão recusada pelo peer {username} ({friend_id}). Verifique o firewall ou se ele está rodando.")
+        else: # Outros erros.
+            QMessageBox.warning(self, "Erro", f"Falha ao enviar solicitação de amizade: {error}")
+
+    def handle_friend_request(self, sender_id, sender_username):
+        if self.node.friend_cache.status(sender_id) == 'accepted':
+            log.debug("Já amigo de %s (%s). Ignorando solicitação.", sender_username, sender_id) # Log.
+            return
+        dialog = FriendRequestDialog(sender_id, sender_username, self)
+        accepted = dialog.exec() == 1 # Executa o diálogo e obtém o resultado (1 para aceitar, 0 para rejeitar).
+        self.node.respond_friend_request(sender_id, sender_username, accepted) # Grava a decisão e responde ao peer.
+        if accepted:  # Se a solicitação foi aceita.
+            self.add_friend_to_list(sender_id, sender_username, online=True) # Assume online já que enviou a solicitação.
+            QMessageBox.information(self, "Solicitação de Amizade", f"Você agora é amigo de {sender_username}!") # Mensagem para o usuário.
+        else:  # Se a solicitação foi rejeitada.
+            QMessageBox.information(self, "Solicitação de Amizade", f"Você rejeitou a solicitação de amizade de {sender_username}.") # Mensagem para o usuário.
+
+    def handle_friend_response(self, sender_id, accepted):
+        if accepted: # Se a resposta foi 'aceito'.
+            log.info("[FRIEND RESPONSE HANDLER] Recebido resposta 'Aceito' de %s.", sender_id) # Log.
+            sender_username = (self.node.lookup_peer(sender_id) or (sender_id,))[0]
+            self.add_friend_to_list(sender_id, sender_username, online=True) # Adiciona/atualiza o amigo na UI.
+            QMessageBox.information(self, "Solicitação de Amizade", f"Sua solicitação de amizade para {sender_username} foi aceita!") # Mensagem ao usuário.
+        else: # Se a resposta foi 'rejeitado'.
+            log.info("[FRIEND RESPONSE HANDLER] Recebido resposta 'Rejeitado' de %s.", sender_id) # Log.
+            sender_username = (self.node.lookup_peer(sender_id) or (sender_id,))[0]
+            QMessageBox.information(self, "Solicitação de Amizade", f"Sua solicitação de amizade para {sender_username} foi rejeitada.") # Mensagem ao usuário.
+        self.load_friends() # Garante que a lista de amigos na UI esteja atualizada (o nó já gravou a resposta).
+
+    def load_friends(self):
+        friends = [(friend_id, friend_username, friend_id in self.node.peers) for friend_id, friend_username in self.node.friend_cache.accepted()]
+        friends += [(group_id, name, None) for group_id, name in self.node.groups.all()] # Grupos no fim da lista.
+        self.friends_model.set_friends(friends) # Recria a lista da UI de uma vez.
+        log.debug("[FRIENDS] Amigos carregados para %s. Total: %s", self.node.username, self.friends_model.rowCount()) # Log.
+
+    def add_friend_to_list(self, friend_id, friend_username, online=False):
+        if self.friends_model.set_online(friend_id, online): # Amigo já listado: só o status muda.
+            log.debug("[UI STATUS] Status de amigo %s atualizado para %s.", friend_id, 'online' if online else 'offline') # Log.
+            return
+        self.friends_model.add_friend(friend_id, friend_username, online) # Adiciona o amigo ao modelo da lista.
+        log.debug("[UI] Amigo %s (%s) adicionado à lista.", friend_username, friend_id) # Log.
+
+    def create_group(self):
+        members = {index.data(Qt.UserRole): index.data(FriendsListModel.UsernameRole)
+                   for index in self.friends_list.selectionModel().selectedIndexes()
+                   if index.data(FriendsListModel.OnlineRole) is not None} # Só amigos, não grupos.
+        if not members:
+            QMessageBox.warning(self, "Erro", "Selecione na lista (Ctrl+clique) os amigos que farão parte do grupo.")
+            return
+        name, ok = QInputDialog.getText(self, "Novo grupo", "Nome do grupo:")
+        if not ok or not name.strip():
+            return
+        self.node.create_group(name.strip(), members)
+        self.load_friends()
+
+    def show_group_status(self, message_id, sent, delivered, total):
+        label = f"entregue a {delivered}/{total}" if delivered else f"enviada a {sent}/{total}"
+        self.chat_model.set_status(message_id, label) # Ignorado se a mensagem não está na tela.
+
+    def send_message(self):
+        if not self.active_chat: # Verifica se há um chat ativo selecionado.
+            QMessageBox.warning(self, "Erro", "Por favor, selecione um amigo para conversar.")
+            return
+        message = self.message_input.text().strip() # Obtém o texto da mensagem.
+        if not message: # Não envia mensagem vazia.
+            return
+        self.message_input.clear() # Limpa o campo de entrada de mensagem.
+        if self.history_newer is not None: # O fim da conversa foi descartado: volta a ele antes de exibir o envio.
+            self.open_chat(self.active_chat)
+        self.flush_pending_rows() # Mantém a ordem com as mensagens recebidas ainda no lote.
+        if self.active_chat in self.node.groups: # Uma gravação e fan-out paralelo para os membros.
+            message_id = self.node.send_group_message(self.active_chat, message)
+        else:
+            message_id = self.node.send_message(self.active_chat, message)
+        # A linha entra antes de o laço entregar qualquer status: os sinais do nó são sempre enfileirados.
+        self.chat_model.append([(f"Você ({datetime.now().strftime('%H:%M')}): {message}", message_id, None)])
+        self.trim_chat(front=True)
+        self.chat_view.scrollToBottom()
+
+    def show_message_status(self, job_id, status):
+        label = {'sending': 'enviando...', 'sent': 'enviada', 'delivered': 'entregue', 'failed': 'falhou', 'queued': 'na fila'}[status]
+        self.chat_model.set_status(job_id, label) # Ignorado para mensagens de outra conversa.
+
+    def send_file(self):
+        if not self.active_chat:
+            QMessageBox.warning(self, "Erro", "Selecione um amigo para enviar o arquivo.")
+            return
+        if self.active_chat not in self.node.peers: # A conexão dedicada não passa por relays.
+            QMessageBox.warning(self, "Erro", "O amigo precisa estar online e acessível diretamente.")
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Enviar arquivo")
+        if path:
+            self.node.file_transfer.offer(self.active_chat, path)
+
+    def handle_file_offer(self, transfer_id, peer_id, name, size):
+        sender_username = self.node.friend_cache.username(peer_id, peer_id)
+        answer = QMessageBox.question(self, "Arquivo recebido", f"{sender_username} quer enviar \"{name}\" ({size / 1024 / 1024:.1f} MiB). Aceitar?")
+        if answer == QMessageBox.Yes: # O arquivo só é recebido com o aceite do usuário.
+            self.node.file_transfer.accept(transfer_id)
+        else:
+            self.node.file_transfer.reject(transfer_id)
+
+    def show_file_progress(self, transfer_id, peer_id, done, total):
+        percent = 100 * done // total if total else 100
+        self.statusBar().showMessage(f"Arquivo {transfer_id[:8]}: {percent}% ({done}/{total} bytes)")
+
+    def show_file_status(self, transfer_id, peer_id, status, detail):
+        log.debug("[FILE TRANSFER] %s com %s: %s (%s)", transfer_id, peer_id, status, detail) # Log.
+        label = {'waiting': 'aguardando aceite', 'sending': 'enviando', 'receiving': 'recebendo',
+                 'interrupted': 'interrompido', 'done': 'concluído', 'failed': 'falhou'}[status]
+        self.statusBar().showMessage(f"Arquivo {transfer_id[:8]}: {label}")
+        if status in ('done', 'failed') and self.active_chat == peer_id:
+            self.queue_row((f"[arquivo {label}] {detail}", None, None))
+
+    def handle_new_message(self, sender_id, message, timestamp_str, message_id):
+        sender_username = self.node.friend_cache.username(sender_id, "Desconhecido")
+        log.debug("[NEW MESSAGE] Mensagem recebida de %s (%s).", sender_username, sender_id) # Log.
+        if self.active_chat == sender_id:
+            display_time = datetime.fromisoformat(timestamp_str).strftime('%H:%M') # Formata o timestamp.
+            self.queue_row((f"{sender_username} ({display_time}): {message}", message_id, None)) # Exibida no próximo quadro.
+
+    def handle_new_group_message(self, group_id, sender_id, message, timestamp_str, message_id):
+        if self.active_chat == group_id:
+            sender_username = self.node.groups.member_names(group_id).get(sender_id) or self.node.friend_cache.username(sender_id, "Desconhecido")
+            display_time = datetime.fromisoformat(timestamp_str).strftime('%H:%M')
+            self.queue_row((f"{sender_username} ({display_time}): {message}", message_id, None))
+
+    def queue_row(self, row):
+        if self.history_newer is not None: # O fim da conversa não está carregado: a mensagem vem do banco ao rolar.
+            return
+        if not self.pending_rows:
+            QTimer.singleShot(16, self.flush_pending_rows) # Rajadas viram uma única inserção por quadro.
+        self.pending_rows.append(row)
+
+    def flush_pending_rows(self):
+        rows, self.pending_rows = self.pending_rows, []
+        if not rows:
+            return
+        scrollbar = self.chat_view.verticalScrollBar()
+        following = scrollbar.value() == scrollbar.maximum() # Só acompanha o fim se o usuário já estava nele.
+        if following and len(rows) >= MessageListModel.MAX_ROWS: # Rajada maior que a janela: só as últimas linhas são medidas.
+            self.chat_model.drop(self.chat_model.rowCount(), front=True)
+            rows = rows[-MessageListModel.MAX_ROWS:]
+            self.history_cursor = None # Recalculada abaixo a partir da primeira linha que ficou.
+        self.chat_model.append(rows)
+        self.trim_chat(front=True)
+        if self.history_cursor is None:
+            self.history_cursor = self.edge_key(front=True) or False
+        if following:
+            self.chat_view.scrollToBottom()
+
+    def select_chat(self, index):
+        self.open_chat(index.data(Qt.UserRole)) # Obtém o ID real do amigo selecionado.
+
+    def open_chat(self, chat_id):
+        self.active_chat = chat_id
+        log.debug("[CHAT SELECT] Chat ativo alterado para %s", self.active_chat) # Log.
+        self.history_sender_name = self.node.friend_cache.username(self.active_chat, "Amigo") # Resolvido uma vez para todas as linhas do chat.
+        self.history_member_names = self.node.groups.member_names(self.active_chat) # Vazio fora de grupos.
+        self.node.storage.flush() # Garante que mensagens recém-enviadas já estejam no histórico.
+        self.pending_rows = [] # Pertencem à conversa anterior.
+        self.history_cursor = None
+        self.history_newer = None
+        self.chat_model.reset(self.fetch_history_page()) # Página mais recente num único reset.
+        self.append_outbox_rows()
+        self.chat_view.scrollToBottom() # Mostra o fim da conversa.
+
+    def append_outbox_rows(self):
+        rows = []
+        for entry in self.node.outbox.pending(self.active_chat): # Mensagens ainda não entregues ficam no fim.
+            display_time = datetime.fromisoformat(entry.timestamp).strftime('%H:%M')
+            rows.append((f"Você ({display_time}): {entry.content}", entry.job_id, None))
+        self.chat_model.append(rows)
+        for _, job_id, _ in rows:
+            self.show_message_status(job_id, 'queued')
+
+    def history_rows(self, rows):
+        entries = []
+        for row_id, sender_id, message, timestamp_str in rows:
+            prefix = "Você" if sender_id == self.node.user_id else self.history_member_names.get(sender_id, self.history_sender_name)
+            display_time = datetime.fromisoformat(timestamp_str).strftime('%H:%M') # Formata o timestamp.
+            entries.append((f"{prefix} ({display_time}): {message}", None, (timestamp_str, row_id)))
+        return entries
+
+    def fetch_history_page(self):
+        rows = self.node.history_page(self.active_chat, self.history_cursor) # Paginação por chave a partir da mais antiga exibida.
+        if len(rows) < HISTORY_PAGE_SIZE:
+            self.history_cursor = False # Não há mais páginas antigas.
+        else:
+            self.history_cursor = (rows[-1][3], rows[-1][0])
+        return self.history_rows(reversed(rows)) # Da mais antiga para a mais recente.
+
+    def fetch_newer_page(self):
+        self.node.storage.flush() # Inclui as mensagens que chegaram enquanto o fim estava descartado.
+        rows = self.node.history_page(self.active_chat, after=self.history_newer)
+        if len(rows) < HISTORY_PAGE_SIZE:
+            self.history_newer = None # Chegou ao fim: volta a receber as mensagens ao vivo.
+        else:
+            self.history_newer = (rows[-1][3], rows[-1][0])
+        return self.history_rows(rows)
+
+    def edge_key(self, front):
+        # Chave da linha mais externa que já está no banco; linhas ao vivo são resolvidas pelo message_id.
+        flushed = False
+        for text, status, message_id, key, _, _ in self.chat_model.edge(front):
+            if not key and message_id:
+                if not flushed:
+                    self.node.storage.flush() # A linha pode ainda estar na fila de escrita.
+                    flushed = True
+                key = self.node.history_key(message_id)
+            if key:
+                return key
+        return None
+
+    def trim_chat(self, front):
+        excess = self.chat_model.rowCount() - MessageListModel.MAX_ROWS
+        if excess <= 0:
+            return
+        count = -(-excess // HISTORY_PAGE_SIZE) * HISTORY_PAGE_SIZE # Descarta páginas inteiras.
+        scrollbar = self.chat_view.verticalScrollBar()
+        offset = scrollbar.value()
+        height = self.chat_model.height(count) if front else None
+        anchor = self.chat_view.indexAt(QPoint(0, 0)).row() if front and height is None else None # Primeira linha visível.
+        self.chat_model.drop(count, front)
+        if front:
+            self.history_cursor = self.edge_key(front=True) or False # Rolar para cima relê o que saiu.
+            if height is not None: # Alturas em cache: desloca a barra sem procurar a linha âncora.
+                scrollbar.setValue(max(0, offset - height))
+            elif anchor >= count:
+                self.chat_view.scrollTo(self.chat_model.index(anchor - count), QListView.PositionAtTop)
+        else:
+            self.history_newer = self.edge_key(front=False) # Rolar até o fim relê o que saiu.
+
+    def run_search(self):
+        text = self.search_input.text().strip()
+        self.search_model.clear()
+        self.search_state = None
+        if not text:
+            return
+        # Com uma conversa aberta, a busca fica restrita a ela; sem conversa, cobre todos os amigos.
+        conversation_id = self.node.conversation_id(self.active_chat) if self.active_chat else None
+        self.search_state = {'query': fts_query(text), 'conversation_id': conversation_id, 'offset': 0, 'done': False}
+        self.node.storage.flush() # Inclui mensagens ainda na fila de escrita.
+        self.fetch_search_page()
+
+    def fetch_search_page(self):
+        state = self.search_state
+        if not state or state['done']:
+            return
+        started = time.perf_counter()
+        rows = self.node.search_page(state['query'], state['conversation_id'], state['offset'])
+        state['offset'] += len(rows)
+        state['done'] = len(rows) < SEARCH_PAGE_SIZE
+        for sender_id, receiver_id, timestamp_str, snippet in rows:
+            friend_id = receiver_id if sender_id == self.node.user_id or receiver_id in self.node.groups else sender_id
+            prefix = "Você" if sender_id == self.node.user_id else self.node.friend_cache.username(sender_id, sender_id)
+            display_time = datetime.fromisoformat(timestamp_str).strftime('%d/%m %H:%M')
+            item = QStandardItem(f"{prefix} ({display_time}): {snippet}")
+            item.setData(friend_id, Qt.UserRole) # select_chat abre a conversa a partir deste ID.
+            self.search_model.appendRow(item)
+        log.debug("[SEARCH] %s resultado(s) em %.1f ms.", len(rows), (time.perf_counter() - started) * 1000) # Log.
+
+    def on_search_scrolled(self, value):
+        if value == self.search_results.verticalScrollBar().maximum() and value > 0:
+            self.fetch_search_page()
+
+    def on_chat_scrolled(self, value):
+        scrollbar = self.chat_view.verticalScrollBar()
+        if not self.active_chat or scrollbar.minimum() == scrollbar.maximum():
+            return
+        if value == scrollbar.minimum() and self.history_cursor is not False:
+            rows = self.fetch_history_page()
+            if not rows:
+                return
+            anchor = self.chat_view.indexAt(QPoint(0, 0)).row()
+            self.chat_model.prepend(rows) # Insere a página antiga acima do conteúdo atual.
+            self.chat_view.scrollTo(self.chat_model.index(anchor + len(rows)), QListView.PositionAtTop) # Mantém a posição de leitura.
+            self.trim_chat(front=False)
+            log.debug("[CHAT SELECT] %s mensagens antigas carregadas.", len(rows)) # Log.
+        elif value == scrollbar.maximum() and self.history_newer is not None:
+            rows = self.fetch_newer_page()
+            self.chat_model.append(rows) # Entra abaixo da tela: a posição de leitura não muda.
+            if self.history_newer is None:
+                self.append_outbox_rows()
+            self.trim_chat(front=True)
+            log.debug("[CHAT SELECT] %s mensagens recentes carregadas.", len(rows)) # Log.
+
+    def update_peer_status(self, peer_id, online):
+        if self.friends_model.set_online(peer_id, online): # Busca O(1) pelo ID do amigo.
+            return
+        if online:
+            if self.node.friend_cache.status(peer_id) == 'accepted':
+                friend_username = self.node.friend_cache.username(peer_id, "Desconhecido")
+                self.add_friend_to_list(peer_id, friend_username, online=True) # Adiciona o amigo à lista da UI.
+                log.debug("[UI STATUS] Amigo %s (%s) adicionado à lista após ficar online.", friend_username, peer_id) # Log.
+            else:
+                log.debug("[UI STATUS] Peer %s online, mas não é um amigo aceito.", peer_id) # Log.
+
+    def closeEvent(self, event):
+        log.info("[APP] Fechando aplicação. Fechando conexão com o banco de dados.") # Log.
+        self.node.stop() # Encerra rede, transferências e a thread de escrita.
+        event.accept() # Aceita o evento de fechamento, permitindo que a janela seja fechada.
+
+def run_gui(argv, data_dir=None):
+    app = QApplication(argv) # Cria uma instância do aplicativo Qt.
+    window = P2PChat(data_dir=data_dir) # Cria uma instância da sua janela principal de chat.
+    window.show() # Exibe a janela.
+    return app.exec() # Inicia o loop de eventos do Qt; retorna quando a janela é fechada.
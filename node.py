@@ -0,0 +1,3337 @@
+import os
+import asyncio
+import atexit
+import bisect
+import logging
+import logging.handlers
+import socket 
+import threading 
+import json 
+import uuid 
+import sqlite3 
+import random 
+import hashlib
+import heapq
+import itertools
+import select
+import selectors
+import queue
+import shutil
+import signal
+import struct
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import fcntl # Só existe em sistemas Unix; sem ele o diretório de dados não é travado.
+except ImportError:
+    fcntl = None
+
+try:
+    import resource # Só existe em sistemas Unix; sem ele o limite de descritores fica como está.
+except ImportError:
+    resource = None
+
+log = logging.getLogger('chatmesh.node')
+
+def setup_logging(level=None):
+    """Envia os logs de 'chatmesh' por uma fila a uma thread própria: quem loga nunca espera pelo terminal."""
+    level = (level or os.environ.get('CHATMESH_LOG_LEVEL', 'INFO')).upper()
+    root = logging.getLogger('chatmesh')
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(records, handler)
+    root.handlers = [logging.handlers.QueueHandler(records)] # Chamadas repetidas substituem a configuração anterior.
+    root.setLevel(level) # Abaixo do nível, log.debug() custa só a comparação: nada é formatado.
+    root.propagate = False
+    listener.start()
+    atexit.register(listener.stop) # Escreve o que ainda estiver na fila ao sair.
+    return listener
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Histogram:
+    """Distribuição em baldes exponenciais (ms): observar não guarda amostras e custa uma busca binária."""
+    BOUNDS = tuple(0.01 * 2 ** i for i in range(24)) # 0,01 ms a ~84 s.
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.BOUNDS, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def observe_since(self, started):
+        self.observe((time.perf_counter() - started) * 1000) # started vem de time.perf_counter().
+
+    def percentile(self, fraction):
+        rank, seen = fraction * self.count, 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.BOUNDS[bucket], self.max) if bucket < len(self.BOUNDS) else self.max # Limite superior do balde.
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            if not self.count:
+                return {'count': 0}
+            return {'count': self.count, 'avg': round(self.total / self.count, 3), 'p50': round(self.percentile(0.50), 3),
+                    'p95': round(self.percentile(0.95), 3), 'p99': round(self.percentile(0.99), 3), 'max': round(self.max, 3)}
+
+class MetricsRegistry:
+    """Contadores e histogramas do processo, lidos como JSON ou por HTTP em 127.0.0.1."""
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, kind):
+        with self.lock:
+            return self.metrics.setdefault(name, kind())
+
+    def counter(self, name):
+        return self.get(name, Counter)
+
+    def histogram(self, name):
+        return self.get(name, Histogram)
+
+    def snapshot(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return {name: metric.snapshot() for name, metric in metrics}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve o snapshot em GET /metrics numa thread própria; só aceita conexões locais por padrão."""
+        registry = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.to_json().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug("[METRICS] " + format, *args)
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name='metrics-http').start()
+        log.info("[METRICS] Métricas em http://%s:%s/metrics", host, server.server_address[1]) # Log.
+        return server
+
+METRICS = MetricsRegistry() # Compartilhado por todos os nós do processo.
+FRAMES_IN = METRICS.counter('frames.in')
+FRAMES_OUT = METRICS.counter('frames.out')
+BYTES_IN = METRICS.counter('bytes.in')
+BYTES_OUT = METRICS.counter('bytes.out')
+FRAMES_INVALID = METRICS.counter('frames.invalid')
+MESSAGES_DROPPED = METRICS.counter('messages.dropped')
+DB_COMMITS = METRICS.counter('db.commits')
+DB_WRITES = METRICS.counter('db.writes')
+DB_WRITE_MS = METRICS.histogram('db.write_ms')
+SEND_LATENCY_MS = METRICS.histogram('send.latency_ms')
+LOOP_CALLBACK_MS = METRICS.histogram('loop.callback_ms')
+FRAMES_THROTTLED = METRICS.counter('frames.throttled')
+FRAMES_SHED = METRICS.counter('frames.shed')
+CONNECTIONS_SHED = METRICS.counter('tcp.connections_shed')
+TCP_QUEUE_WAIT_MS = METRICS.histogram('tcp.queue_wait_ms')
+
+class TimerHandle:
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        if not self.cancelled:
+            self.function(*self.args)
+
+class Scheduler:
+    """Base dos laços de eventos do nó: subclasses implementam call_soon e call_later."""
+    def call_every(self, interval, function):
+        handle = TimerHandle(function, ())
+        def tick():
+            if not handle.cancelled:
+                function()
+                self.call_later(interval, tick)
+        self.call_later(interval, tick)
+        return handle
+
+class EventLoop(Scheduler):
+    """Laço de eventos sem Qt (modo headless): callbacks e timers do nó rodam todos numa única thread."""
+    def __init__(self):
+        self.ready = queue.SimpleQueue() # (função, argumentos) enviados por qualquer thread.
+        self.timers = [] # Heap de (prazo em time.monotonic(), sequência, TimerHandle).
+        self.sequence = itertools.count() # Desempate estável entre timers com o mesmo prazo.
+        self.lock = threading.Lock()
+        self.running = False
+
+    def call_soon(self, function, *args):
+        self.ready.put((function, args))
+
+    def call_later(self, delay, function, *args):
+        handle = TimerHandle(function, args)
+        with self.lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), handle))
+        self.ready.put(None) # Acorda o laço para recalcular a espera.
+        return handle
+
+    def run(self):
+        self.running = True
+        while self.running:
+            with self.lock:
+                now = time.monotonic()
+                due = []
+                while self.timers and self.timers[0][0] <= now:
+                    due.append(heapq.heappop(self.timers)[2])
+                timeout = min(self.timers[0][0] - now, 1) if self.timers else 1 # Acorda ao menos 1x/s (Ctrl+C).
+            for handle in due:
+                self.invoke(handle.run)
+            try:
+                item = self.ready.get(timeout=0 if due else timeout)
+            except queue.Empty:
+                continue
+            if item:
+                self.invoke(item[0], *item[1])
+
+    def invoke(self, function, *args):
+        started = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            log.exception("[EVENT LOOP ERROR] %s", e) # Um callback com erro não derruba o nó.
+        LOOP_CALLBACK_MS.observe_since(started)
+
+    def stop(self):
+        self.running = False
+        self.ready.put(None)
+
+class Event:
+    """Sinal sem Qt: cada slot é executado no laço do nó, como numa conexão enfileirada do Qt."""
+    def __init__(self, loop):
+        self.loop = loop
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def emit(self, *args):
+        for slot in self.slots:
+            self.loop.call_soon(slot, *args)
+
+class MessageSignals:
+    def __init__(self, loop):
+        self.new_message = Event(loop) # sender_id, conteúdo, timestamp, message_id.
+        self.new_group_message = Event(loop) # group_id, sender_id, conteúdo, timestamp, message_id.
+        self.peer_status_pending = Event(loop) # Há transições online/offline aguardando em PeerStatusBatcher.
+        self.peer_status = Event(loop) # peer_id, online: transições aplicadas em lote, no máximo uma vez por quadro.
+        self.friend_request = Event(loop) # sender_id, sender_username.
+        self.friend_response = Event(loop) # sender_id, aceita.
+        self.update_friends_list = Event(loop)
+        self.send_status = Event(loop) # job_id, peer_id, 'sending'/'sent'/'failed', exceção (ou None).
+        self.message_delivered = Event(loop) # peer_id, message_id confirmado pelo destinatário.
+        self.message_status = Event(loop) # message_id, 'sending'/'sent'/'delivered'/'failed'/'queued' das mensagens de chat.
+        self.group_status = Event(loop) # message_id, membros que receberam, que confirmaram, total.
+        self.file_offer = Event(loop) # transfer_id, peer_id, nome, tamanho: oferta aguardando accept() ou reject().
+        self.file_progress = Event(loop) # transfer_id, peer_id, bytes confirmados, tamanho total.
+        self.file_status = Event(loop) # transfer_id, peer_id, status ('waiting'/'sending'/'receiving'/'interrupted'/'done'/'failed'), nome, caminho ou erro.
+
+FRAME_HEADER = struct.Struct('!I') # Cabeçalho de 4 bytes (big-endian) com o tamanho do payload.
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # Limite de segurança para um único frame (16 MiB).
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload # Cabeçalho de tamanho seguido do payload.
+
+class FrameError(Exception):
+    pass
+
+class FrameReader:
+    """Decodifica um fluxo TCP em frames com prefixo de tamanho, tolerando frames parciais."""
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray() # Buffer reutilizado entre leituras.
+        self.offset = 0 # Início dos bytes ainda não consumidos no buffer.
+        self.legacy = None # True se o peer envia JSON puro sem cabeçalho (versões antigas).
+
+    def feed(self, data):
+        self.buffer += data
+        if self.legacy is None and len(self.buffer) > self.offset:
+            self.legacy = self.buffer[self.offset] == ord('{') # Um cabeçalho nunca começa com '{' (seria > 2 GiB).
+        if self.legacy:
+            return [] # Mensagem antiga: só termina quando o peer fecha a conexão.
+        frames = []
+        buffer, offset = self.buffer, self.offset
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame de {length} bytes excede o limite de {self.max_frame_size}.")
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break # Frame parcial: aguarda o restante na próxima leitura.
+            frames.append(bytes(buffer[offset + FRAME_HEADER.size:end]))
+            offset = end
+        if offset == len(buffer): # Tudo consumido: reaproveita o buffer sem realocar.
+            del buffer[:]
+            offset = 0
+        elif offset > 65536 and offset * 2 > len(buffer): # Compacta quando a parte consumida domina o buffer.
+            del buffer[:offset]
+            offset = 0
+        self.offset = offset
+        return frames
+
+    def finish(self):
+        if self.legacy and len(self.buffer) > self.offset:
+            return bytes(self.buffer[self.offset:]) # Mensagem JSON única de um peer antigo.
+        return None
+
+WIRE_MAGIC = 0xCB # Primeiro byte de uma mensagem binária (JSON sempre começa com '{').
+WIRE_HEADER = struct.Struct('!BBB') # magic, flags, código do tipo.
+WIRE_FLAG_ZLIB = 0x01 # Corpo comprimido com zlib.
+WIRE_CODECS = ('bin1', 'zlib') # Codecs anunciados na presença.
+COMPRESS_THRESHOLD = 512 # Corpos binários menores que isso não compensam a compressão.
+EPOCH = datetime(1970, 1, 1)
+# Código do tipo -> (tipo, campos). Um tipo pode ter mais de um código (um por conjunto de campos);
+# mensagens fora do esquema (ou com campos extras) seguem em JSON.
+WIRE_SCHEMAS = {
+    1: ('message', (('sender_id', 'uuid'), ('content', 'str'), ('timestamp', 'time'))),
+    2: ('friend_request', (('sender_id', 'uuid'), ('sender_username', 'str'), ('receiver_id', 'uuid'))),
+    3: ('friend_response', (('sender_id', 'uuid'), ('receiver_id', 'uuid'), ('accepted', 'bool'), ('sender_username', 'str'))),
+    4: ('message', (('message_id', 'uuid'), ('sender_id', 'uuid'), ('content', 'str'), ('timestamp', 'time'))),
+    5: ('ack', (('sender_id', 'uuid'), ('message_id', 'uuid'))),
+    6: ('relay', (('relay_id', 'uuid'), ('src', 'uuid'), ('dst', 'uuid'), ('ttl', 'uint'), ('payload', 'message'))),
+    7: ('group_message', (('message_id', 'uuid'), ('group_id', 'uuid'), ('sender_id', 'uuid'), ('content', 'str'), ('timestamp', 'time'))),
+    16: ('hb', (('id', 'uuid'), ('v', 'uint'), ('i', 'tenths'))),
+    17: ('who', (('id', 'uuid'),)),
+}
+WIRE_TYPES = {} # tipo -> {conjunto de campos: (código, campos)}.
+for _code, (_name, _fields) in WIRE_SCHEMAS.items():
+    WIRE_TYPES.setdefault(_name, {})[frozenset(name for name, _ in _fields)] = (_code, _fields)
+
+def write_varint(out, value):
+    if value < 0:
+        raise ValueError("varint negativo")
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        if offset >= len(data) or shift > 63:
+            raise FrameError("Varint truncado.")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def write_field(out, kind, value):
+    if kind == 'uuid':
+        raw = uuid.UUID(value)
+        if str(raw) != value: # Só a forma canônica volta idêntica do outro lado.
+            raise ValueError("UUID fora da forma canônica")
+        out += raw.bytes # 16 bytes em vez de 36 caracteres.
+    elif kind == 'str':
+        encoded = value.encode()
+        write_varint(out, len(encoded))
+        out += encoded
+    elif kind == 'time':
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is not None or moment.isoformat() != value:
+            raise ValueError("timestamp não reversível")
+        write_varint(out, (moment - EPOCH) // timedelta(microseconds=1))
+    elif kind == 'bool':
+        if not isinstance(value, bool):
+            raise TypeError("bool esperado")
+        out.append(1 if value else 0)
+    elif kind == 'uint':
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise TypeError("inteiro esperado")
+        write_varint(out, value)
+    elif kind == 'tenths':
+        if round(value * 10) / 10 != value:
+            raise ValueError("mais de uma casa decimal")
+        write_varint(out, round(value * 10))
+    elif kind == 'message': # Mensagem aninhada (envelopes de relay), sempre sem compressão.
+        encoded = encode_message(value, ('bin1',))
+        write_varint(out, len(encoded))
+        out += encoded
+
+def read_field(data, offset, kind):
+    if kind == 'uuid':
+        if offset + 16 > len(data):
+            raise FrameError("UUID truncado.")
+        return str(uuid.UUID(bytes=bytes(data[offset:offset + 16]))), offset + 16
+    if kind == 'str':
+        length, offset = read_varint(data, offset)
+        if offset + length > len(data):
+            raise FrameError("Texto truncado.")
+        try:
+            return bytes(data[offset:offset + length]).decode(), offset + length
+        except UnicodeDecodeError as e:
+            raise FrameError(f"Texto com UTF-8 inválido: {e}") from None
+    if kind == 'time':
+        micros, offset = read_varint(data, offset)
+        try:
+            return (EPOCH + timedelta(microseconds=micros)).isoformat(), offset
+        except OverflowError:
+            raise FrameError("Timestamp fora do intervalo.") from None
+    if kind == 'bool':
+        if offset >= len(data):
+            raise FrameError("Booleano truncado.")
+        return data[offset] == 1, offset + 1
+    if kind == 'uint':
+        return read_varint(data, offset)
+    if kind == 'message':
+        length, offset = read_varint(data, offset)
+        if offset + length > len(data):
+            raise FrameError("Mensagem aninhada truncada.")
+        return decode_message(bytes(data[offset:offset + length])), offset + length
+    value, offset = read_varint(data, offset) # 'tenths'
+    return value / 10, offset
+
+def encode_message(message, codecs=()):
+    """Serializa uma mensagem no formato binário se o peer suporta, senão em JSON (peers antigos)."""
+    schema = None
+    if 'bin1' in codecs:
+        schema = WIRE_TYPES.get(message.get('type'), {}).get(frozenset(message) - {'type'})
+    if schema:
+        try:
+            body = bytearray()
+            for name, kind in schema[1]:
+                write_field(body, kind, message[name])
+        except (KeyError, ValueError, TypeError, OverflowError):
+            pass # Valor que não cabe no esquema: JSON preserva a mensagem como está.
+        else:
+            flags = 0
+            if 'zlib' in codecs and len(body) >= COMPRESS_THRESHOLD:
+                compressed = zlib.compress(body, 1) # Nível baixo: pouco CPU, ganho grande em texto repetitivo.
+                if len(compressed) < len(body):
+                    body, flags = compressed, WIRE_FLAG_ZLIB
+            return WIRE_HEADER.pack(WIRE_MAGIC, flags, schema[0]) + bytes(body)
+    return json.dumps(message, separators=(',', ':')).encode()
+
+def decode_message(data):
+    """Decodifica uma mensagem binária ou JSON; qualquer entrada inválida levanta FrameError."""
+    if not data or data[0] != WIRE_MAGIC:
+        try:
+            message = json.loads(data) # JSON de peers antigos (e mensagens fora do esquema).
+        except ValueError as e: # JSON inválido ou bytes que não são UTF-8.
+            raise FrameError(f"JSON inválido: {e}") from None
+        if not isinstance(message, dict):
+            raise FrameError("A mensagem JSON não é um objeto.")
+        return message
+    if len(data) < WIRE_HEADER.size:
+        raise FrameError("Cabeçalho binário truncado.")
+    _, flags, code = WIRE_HEADER.unpack_from(data)
+    if code not in WIRE_SCHEMAS:
+        raise FrameError(f"Tipo de mensagem binária desconhecido: {code}.")
+    body = memoryview(data)[WIRE_HEADER.size:]
+    if flags & WIRE_FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, MAX_FRAME_SIZE) # Limita o tamanho descomprimido.
+        except zlib.error as e:
+            raise FrameError(f"Corpo zlib inválido: {e}") from None
+        if decompressor.unconsumed_tail:
+            raise FrameError("Mensagem descomprimida excede o limite.")
+    name, fields = WIRE_SCHEMAS[code]
+    message = {'type': name}
+    offset = 0
+    for field, kind in fields:
+        message[field], offset = read_field(body, offset, kind)
+    return message
+
+class PooledConnection:
+    def __init__(self, address):
+        self.address = address # (ip, porta) usados para abrir a conexão.
+        self.sock = None # Socket TCP persistente (None enquanto não conectado).
+        self.last_used = time.monotonic() # Momento do último envio, usado para despejar conexões ociosas.
+        self.lock = threading.Lock() # Serializa os envios nesta conexão.
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def is_stale(self):
+        # O receptor nunca escreve nesta conexão: se ela ficou legível, o peer a fechou.
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+class PeerConnectionPool:
+    """Mantém conexões TCP persistentes por peer, reutilizadas por todos os tipos de mensagem."""
+    def __init__(self, resolve_address, connect_timeout=5, idle_timeout=60, is_legacy=None):
+        self.resolve_address = resolve_address # Função peer_id -> (ip, porta) ou None se o peer estiver offline.
+        self.is_legacy = is_legacy # Função peer_id -> True se o peer só entende um JSON por conexão (versão antiga).
+        self.connect_timeout = connect_timeout # Timeout para abrir uma conexão nova.
+        self.idle_timeout = idle_timeout # Segundos sem uso antes de fechar a conexão.
+        self.connections = {} # peer_id -> PooledConnection.
+        self.lock = threading.Lock() # Protege o dicionário de conexões.
+
+    def send(self, peer_id, data):
+        address = self.resolve_address(peer_id)
+        if address is None:
+            raise ConnectionError(f"Peer {peer_id} não está online.")
+        if self.is_legacy and self.is_legacy(peer_id):
+            self.send_legacy(address, data)
+            return
+        with self.lock:
+            entry = self.connections.get(peer_id)
+            if entry is None or entry.address != address: # Peer novo ou mudou de endereço: reconecta.
+                if entry is not None:
+                    entry.close()
+                entry = PooledConnection(address)
+                self.connections[peer_id] = entry
+        with entry.lock:
+            reused = entry.sock is not None
+            if reused and entry.is_stale():
+                log.debug("[CONNECTION POOL] Conexão com %s estava fechada pelo peer. Reconectando.", peer_id) # Log.
+                entry.close()
+                reused = False
+            try:
+                self._send_on(entry, data)
+            except OSError:
+                entry.close()
+                if not reused: # Falha numa conexão recém-aberta: o peer está inacessível.
+                    raise
+                log.debug("[CONNECTION POOL] Falha ao reutilizar conexão com %s. Tentando novamente.", peer_id) # Log.
+                self._send_on(entry, data) # Uma única nova tentativa com conexão nova.
+
+    def send_legacy(self, address, data):
+        # Versões antigas leem um único JSON sem cabeçalho por conexão: cada frame do lote vai numa conexão própria.
+        for payload in FrameReader().feed(data):
+            with socket.create_connection(address, timeout=self.connect_timeout) as sock:
+                sock.sendall(payload)
+
+    def _send_on(self, entry, data):
+        if entry.sock is None:
+            sock = socket.create_connection(entry.address, timeout=self.connect_timeout) # Handshake apenas na primeira mensagem.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Mensagens curtas saem imediatamente.
+            entry.sock = sock
+            log.debug("[CONNECTION POOL] Nova conexão persistente com %s:%s", entry.address[0], entry.address[1]) # Log.
+        try:
+            entry.sock.sendall(data)
+        except OSError:
+            entry.close()
+            raise
+        entry.last_used = time.monotonic()
+
+    def invalidate(self, peer_id):
+        with self.lock:
+            entry = self.connections.pop(peer_id, None)
+        if entry is not None:
+            with entry.lock:
+                entry.close()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            for peer_id, entry in list(self.connections.items()):
+                if now - entry.last_used > self.idle_timeout and entry.lock.acquire(blocking=False):
+                    try:
+                        entry.close()
+                        del self.connections[peer_id]
+                        log.debug("[CONNECTION POOL] Conexão ociosa com %s fechada.", peer_id) # Log.
+                    finally:
+                        entry.lock.release()
+
+    def close_all(self):
+        with self.lock:
+            entries = list(self.connections.values())
+            self.connections.clear()
+        for entry in entries:
+            entry.close()
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, chat):
+        self.chat = chat
+
+    def datagram_received(self, data, addr):
+        self.chat.handle_presence_datagram(data, addr) # Mesmo tratamento da thread UDP.
+
+class PooledStream:
+    def __init__(self, address, writer):
+        self.address = address # (ip, porta) usados para abrir a conexão.
+        self.writer = writer # StreamWriter da conexão persistente.
+        self.last_used = time.monotonic() # Momento do último envio.
+
+class AsyncNetworkEngine:
+    """Executa o servidor TCP, a descoberta UDP e os envios num único event loop asyncio em background."""
+    def __init__(self, chat, connect_timeout=5, idle_timeout=60):
+        self.chat = chat # Janela principal: fornece endereços dos peers e o tratamento das mensagens.
+        self.connect_timeout = connect_timeout # Timeout para abrir uma conexão nova.
+        self.idle_timeout = idle_timeout # Segundos sem uso (envio ou, nas recebidas, dados) antes de fechar a conexão.
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.connections = {} # peer_id -> PooledStream (acessado apenas dentro do loop).
+        self.locks = {} # peer_id -> asyncio.Lock que serializa os envios para o peer.
+        self.server = None
+        self.udp_transport = None
+        self.clients = 0 # Conexões recebidas abertas agora.
+        self.stopping = False # close_all chamado: as corrotinas das conexões serão canceladas.
+
+    def start(self):
+        self.thread.start() # Inicia a thread do event loop.
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start_endpoints())
+        self.loop.run_forever()
+        tasks = asyncio.all_tasks(self.loop) # Cancela corrotinas de conexões ainda abertas ao encerrar.
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    async def start_endpoints(self):
+        try:
+            self.server = await asyncio.start_server(self.handle_client, '0.0.0.0', self.chat.tcp_port, backlog=self.chat.tcp_backlog)
+            log.info("[ASYNC ENGINE] Servidor TCP iniciado na porta %s", self.chat.tcp_port) # Log de depuração.
+        except OSError as e:
+            log.error("Erro ao iniciar servidor TCP na porta %s: %s", self.chat.tcp_port, e) # Log de erro.
+        try:
+            sock = open_discovery_socket(self.chat.udp_port, self.chat.presence.group) # Socket UDP compartilhado por escuta e anúncios.
+            self.udp_transport, _ = await self.loop.create_datagram_endpoint(lambda: DiscoveryProtocol(self.chat), sock=sock)
+            log.info("[ASYNC ENGINE] Escutando por peers na porta UDP %s", self.chat.udp_port) # Log de depuração.
+        except OSError as e:
+            log.error("Erro ao bindar socket UDP na porta %s: %s", self.chat.udp_port, e) # Log de erro.
+
+    async def handle_client(self, reader, writer):
+        peername = writer.get_extra_info('peername')
+        address = peername[0] if peername else None # Chave dos limites de entrada: o sender_id do frame pode ser forjado.
+        if self.clients >= self.chat.max_connections: # Mesmo limite de conexões abertas da engine com threads.
+            self.chat.connection_shed(address)
+            writer.close()
+            return
+        self.clients += 1
+        frame_reader = FrameReader()
+        try:
+            while True: # Uma corrotina por conexão, sem thread dedicada.
+                try: # Sem dados por idle_timeout, fecha: como na engine com threads, conexões mudas não ocupam o limite.
+                    data = await asyncio.wait_for(reader.read(65536), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    log.debug("[ASYNC ENGINE] Conexão ociosa de %s encerrada.", address) # Log.
+                    return
+                if not data:
+                    break
+                for payload in frame_reader.feed(data):
+                    wait = self.chat.admit_frame(address, len(payload))
+                    if wait is not None:
+                        self.chat.process_tcp_message(payload)
+                    if wait:
+                        await asyncio.sleep(wait) # Não lê o socket: o TCP desacelera o peer.
+            legacy_payload = frame_reader.finish()
+            if legacy_payload and self.chat.admit_frame(address, len(legacy_payload)) is not None: # Peers antigos enviam um único JSON sem cabeçalho e fecham.
+                self.chat.process_tcp_message(legacy_payload)
+        except FrameError as e:
+            FRAMES_INVALID.inc()
+            log.warning("[ASYNC ENGINE] Frame inválido, encerrando conexão: %s", e) # Log de erro de protocolo.
+        except OSError as e:
+            log.warning("[ASYNC ENGINE] Conexão encerrada com erro: %s", e) # Log de erro.
+        except asyncio.CancelledError:
+            writer.close()
+            # No encerramento a tarefa termina normalmente: até o Python 3.11, o callback do servidor de streams
+            # chama task.exception() numa tarefa cancelada e loga "Exception in callback".
+            if not self.stopping:
+                raise
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    def submit(self, peer_id, data):
+        return asyncio.run_coroutine_threadsafe(self.send_async(peer_id, data), self.loop) # concurrent.futures.Future.
+
+    def send(self, peer_id, data):
+        self.submit(peer_id, data).result() # Mesma interface bloqueante de PeerConnectionPool.send.
+
+    async def send_async(self, peer_id, data):
+        address = self.chat.peer_address(peer_id)
+        if address is None:
+            raise ConnectionError(f"Peer {peer_id} não está online.")
+        if self.chat.presence.is_legacy(peer_id): # Versão antiga: um JSON sem cabeçalho por conexão.
+            for payload in FrameReader().feed(data):
+                _, writer = await asyncio.wait_for(asyncio.open_connection(*address), self.connect_timeout)
+                try:
+                    writer.write(payload)
+                    await writer.drain()
+                finally:
+                    writer.close()
+            return
+        lock = self.locks.setdefault(peer_id, asyncio.Lock())
+        async with lock:
+            entry = self.connections.get(peer_id)
+            if entry is not None and (entry.address != address or entry.writer.is_closing()):
+                self.close_connection(peer_id) # Peer mudou de endereço ou fechou a conexão.
+                entry = None
+            if entry is not None:
+                try:
+                    entry.writer.write(data)
+                    await entry.writer.drain()
+                    entry.last_used = time.monotonic()
+                    return
+                except OSError:
+                    log.debug("[ASYNC ENGINE] Falha ao reutilizar conexão com %s. Tentando novamente.", peer_id) # Log.
+                    self.close_connection(peer_id)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), self.connect_timeout)
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[peer_id] = PooledStream(address, writer)
+            self.loop.create_task(self.watch_connection(peer_id, reader, writer))
+            writer.write(data)
+            await writer.drain()
+
+    async def watch_connection(self, peer_id, reader, writer):
+        try:
+            await reader.read() # O receptor nunca escreve: retorna apenas quando o peer fecha a conexão.
+        except OSError:
+            pass
+        entry = self.connections.get(peer_id)
+        if entry is not None and entry.writer is writer:
+            self.close_connection(peer_id)
+
+    def close_connection(self, peer_id):
+        entry = self.connections.pop(peer_id, None)
+        if entry is not None:
+            entry.writer.close()
+
+    def invalidate(self, peer_id):
+        self.loop.call_soon_threadsafe(self.close_connection, peer_id)
+
+    def evict_idle(self):
+        self.loop.call_soon_threadsafe(self.evict_idle_now)
+
+    def evict_idle_now(self):
+        now = time.monotonic()
+        for peer_id, entry in list(self.connections.items()):
+            if now - entry.last_used > self.idle_timeout and not self.locks[peer_id].locked():
+                self.close_connection(peer_id)
+                log.debug("[ASYNC ENGINE] Conexão ociosa com %s fechada.", peer_id) # Log.
+
+    def send_datagram(self, data, address):
+        self.loop.call_soon_threadsafe(self.send_datagram_now, data, address)
+
+    def send_datagram_now(self, data, address):
+        if self.udp_transport is not None:
+            self.udp_transport.sendto(data, address)
+
+    def close_all(self):
+        self.loop.call_soon_threadsafe(self.close_all_now)
+
+    def close_all_now(self):
+        self.stopping = True
+        for peer_id in list(self.connections):
+            self.close_connection(peer_id)
+        if self.server is not None:
+            self.server.close()
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+        self.loop.stop() # Encerra o event loop após fechar tudo.
+
+class SendQueueFull(Exception):
+    pass
+
+class OutboundDispatcher:
+    """Executa os envios fora da thread da interface e informa o resultado por MessageSignals.send_status."""
+    def __init__(self, connection_pool, signals, max_workers=8, max_pending=1000):
+        self.connection_pool = connection_pool # PeerConnectionPool ou AsyncNetworkEngine.
+        self.signals = signals
+        self.max_pending = max_pending # Limite de envios na fila antes de recusar novos.
+        # A engine asyncio já envia sem bloquear; o pool de threads só é necessário para o PeerConnectionPool.
+        self.executor = None if isinstance(connection_pool, AsyncNetworkEngine) else ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sender')
+        self.queues = {} # peer_id -> deque de (job_id, data, future, instante da submissão) aguardando envio.
+        self.in_flight = {} # peer_id -> lote sendo enviado agora.
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, peer_id, data, job_id=None):
+        job_id = job_id or str(uuid.uuid4())
+        future = Future()
+        with self.lock:
+            full = self.pending >= self.max_pending
+            if not full:
+                self.pending += 1
+                self.queues.setdefault(peer_id, deque()).append((job_id, data, future, time.perf_counter()))
+                start = peer_id not in self.in_flight # Um lote por peer de cada vez preserva a ordem das mensagens.
+                if start:
+                    self.in_flight[peer_id] = []
+        if full:
+            MESSAGES_DROPPED.inc()
+            error = SendQueueFull(f"Fila de envio cheia ({self.max_pending} mensagens).")
+            future.set_exception(error)
+            self.signals.send_status.emit(job_id, peer_id, 'failed', error)
+            return job_id, future
+        self.signals.send_status.emit(job_id, peer_id, 'sending', None)
+        if start:
+            self.send_next_batch(peer_id)
+        return job_id, future
+
+    def send_next_batch(self, peer_id):
+        with self.lock:
+            queue = self.queues.pop(peer_id, None)
+            if not queue:
+                self.in_flight.pop(peer_id, None)
+                return
+            batch = list(queue) # Mensagens acumuladas para o mesmo peer saem juntas num único envio.
+            self.in_flight[peer_id] = batch
+        data = b''.join(job[1] for job in batch)
+        FRAMES_OUT.inc(len(batch))
+        BYTES_OUT.inc(len(data))
+        if self.executor is None:
+            inner = self.connection_pool.submit(peer_id, data)
+        else:
+            inner = self.executor.submit(self.connection_pool.send, peer_id, data)
+        inner.add_done_callback(lambda done: self.batch_finished(peer_id, batch, done))
+
+    def batch_finished(self, peer_id, batch, done):
+        error = done.exception()
+        with self.lock:
+            self.pending -= len(batch)
+        for job_id, _, future, submitted in batch:
+            if error is None:
+                SEND_LATENCY_MS.observe_since(submitted) # Da entrada na fila até o envio completo.
+                future.set_result(None)
+                self.signals.send_status.emit(job_id, peer_id, 'sent', None)
+            else:
+                future.set_exception(error)
+                self.signals.send_status.emit(job_id, peer_id, 'failed', error)
+        self.send_next_batch(peer_id) # Segue com o que chegou para o peer durante o envio.
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+class InboundConnection:
+    """Estado de uma conexão TCP recebida entre uma leitura e a próxima."""
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address # IP remoto: chave dos limites de entrada (o sender_id dos frames pode ser forjado).
+        self.reader = FrameReader()
+        self.frames = deque() # Frames já lidos e ainda não processados: a conexão foi pausada no meio de uma leitura.
+        self.last_active = time.monotonic()
+
+class InboundConnectionPool:
+    """Atende as conexões TCP recebidas com poucas threads, guiadas por prontidão.
+
+    Um selector vigia todas as conexões abertas e só as que têm dados vão para a fila `ready`; uma thread livre
+    processa o que chegou e devolve a conexão ao selector. Assim nenhuma thread fica presa a uma conexão persistente.
+    Com a fila cheia, o selector espera uma thread (os dados aguardam no kernel e o TCP desacelera os remetentes);
+    só acima de `max_connections` conexões abertas as novas são recusadas.
+    """
+    def __init__(self, handler, workers=64, max_pending=256, max_connections=10000, idle_timeout=60, on_shed=None):
+        self.handler = handler # (conexão, buffer) -> segundos de pausa, ou None quando a conexão terminou.
+        self.workers = workers
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout # Sem dados por esse tempo, a conexão é fechada; o remetente reconecta no próximo envio.
+        self.on_shed = on_shed # Chamada com o IP de cada conexão recusada.
+        self.selector = selectors.DefaultSelector() # Usado apenas pela thread do servidor.
+        self.ready = queue.Queue(max_pending) # Conexões com dados esperando uma thread livre.
+        self.returned = queue.SimpleQueue() # (conexão, pausa) devolvidas pelas threads ao selector.
+        self.paused = [] # Heap de (instante da retomada, seq, conexão) pausadas pelos limites de entrada.
+        self.sequence = itertools.count()
+        self.wakeup, self.wakeup_signal = socket.socketpair() # Acorda o select quando uma thread devolve uma conexão.
+        self.accept_warnings = TokenBucket(1)
+        self.count = 0 # Conexões abertas, onde quer que estejam.
+        self.threads = []
+        self.stopped = False
+
+    def stop(self):
+        """Pede o encerramento: o laço do selector fecha o socket de escuta e as conexões, e as threads terminam."""
+        self.stopped = True
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wakeup_signal.send(b'\0')
+        except OSError: # Buffer do socketpair cheio (o select já tem o que acordar) ou pool já encerrado.
+            pass
+
+    def serve(self, server):
+        """Laço do selector: aceita conexões e distribui as prontas. Roda na thread do servidor TCP."""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, daemon=True, name=f'tcp-handler-{i}')
+            thread.start()
+            self.threads.append(thread)
+        for sock in (self.wakeup, self.wakeup_signal):
+            sock.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        next_sweep = time.monotonic() + 1
+        while not self.stopped:
+            try:
+                timeout = 1 if not self.paused else min(1, max(0, self.paused[0][0] - time.monotonic()))
+                for key, _ in self.selector.select(timeout):
+                    if key.fileobj is server: # Nova conexão.
+                        self.accept(server)
+                    elif key.fileobj is self.wakeup:
+                        self.drain_wakeup()
+                    else: # Dados numa conexão: sai do selector até uma thread terminar de processá-la.
+                        self.selector.unregister(key.fileobj)
+                        self.dispatch(key.data)
+                self.reclaim()
+                now = time.monotonic()
+                while self.paused and self.paused[0][0] <= now:
+                    self.resume(heapq.heappop(self.paused)[2])
+                if now >= next_sweep:
+                    self.close_idle(now)
+                    next_sweep = now + 1
+            except Exception as e:
+                log.warning("Erro no loop do servidor TCP: %s", e) # Log de erro.
+        self.shutdown(server)
+
+    def shutdown(self, server):
+        server.close() # Novas conexões passam a ser recusadas pelo sistema.
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self.close(key.data)
+        for _, _, connection in self.paused:
+            self.close(connection)
+        self.paused = []
+        self.selector.close()
+        for _ in self.threads:
+            self.ready.put(None) # Uma marca de fim por thread, depois das conexões que já estavam na fila.
+        for thread in self.threads:
+            thread.join()
+        while not self.returned.empty():
+            self.close(self.returned.get_nowait()[0])
+        self.wakeup.close()
+        self.wakeup_signal.close()
+
+    def accept(self, server):
+        try:
+            sock, address = server.accept()
+        except BlockingIOError:
+            return
+        except OSError as e: # Sem descritores livres, por exemplo: a conexão fica no backlog do kernel.
+            if self.accept_warnings.consume():
+                log.warning("[TCP SERVER] Erro ao aceitar conexão: %s", e) # Log de erro.
+            time.sleep(0.1) # O socket do servidor continua legível: evita girar em falso.
+            return
+        log.debug("[TCP SERVER] Conexão TCP aceita de %s", address) # Log de depuração.
+        if self.count >= self.max_connections: # Sobrecarga: recusa em vez de acumular conexões.
+            sock.close()
+            if self.on_shed:
+                self.on_shed(address[0])
+            return
+        sock.setblocking(False)
+        self.count += 1
+        self.selector.register(sock, selectors.EVENT_READ, InboundConnection(sock, address[0]))
+
+    def dispatch(self, connection):
+        self.ready.put((connection, time.perf_counter())) # Fila cheia: espera uma thread livre.
+
+    def run(self):
+        chunk = memoryview(bytearray(65536)) # Buffer de leitura da thread, reutilizado por todas as conexões.
+        while True:
+            item = self.ready.get()
+            if item is None: # Pool encerrado.
+                return
+            connection, queued = item
+            TCP_QUEUE_WAIT_MS.observe_since(queued)
+            try:
+                pause = self.handler(connection, chunk)
+            except Exception as e: # A thread continua atendendo as próximas conexões.
+                log.warning("[TCP HANDLER ERROR] Erro inesperado ao lidar com conexão TCP: %s", e) # Log de erro geral.
+                pause = None
+            self.returned.put((connection, pause))
+            self.wake()
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def reclaim(self):
+        while True:
+            try:
+                connection, pause = self.returned.get_nowait()
+            except queue.Empty:
+                return
+            if pause is None:
+                self.close(connection)
+            elif pause: # Limite de entrada: o socket não é lido até a retomada e o TCP desacelera o peer.
+                heapq.heappush(self.paused, (time.monotonic() + pause, next(self.sequence), connection))
+            else:
+                self.resume(connection)
+
+    def resume(self, connection):
+        if connection.frames: # Ainda há frames lidos antes da pausa: não espera o socket.
+            self.dispatch(connection)
+        else:
+            self.selector.register(connection.sock, selectors.EVENT_READ, connection)
+
+    def close(self, connection):
+        self.count -= 1
+        connection.sock.close()
+
+    def close_idle(self, now):
+        for key in list(self.selector.get_map().values()):
+            connection = key.data
+            if connection is not None and now - connection.last_active > self.idle_timeout:
+                log.debug("[TCP HANDLER] Conexão ociosa de %s encerrada.", connection.address) # Log.
+                self.selector.unregister(connection.sock)
+                self.close(connection)
+
+HISTORY_PAGE_SIZE = 100 # Mensagens carregadas por página ao abrir ou rolar uma conversa.
+SEARCH_PAGE_SIZE = 50 # Resultados carregados por página na busca.
+MESSAGE_NAMESPACE = uuid.UUID('6f1c1d7e-3b0a-5c8e-9d4f-2a7b8c9d0e1f') # Base dos IDs derivados (uuid5).
+
+def legacy_message_id(sender_id, receiver_id, timestamp, content):
+    # Peers antigos não mandam ID: o mesmo conteúdo reenviado gera o mesmo ID e é deduplicado.
+    return str(uuid.uuid5(MESSAGE_NAMESPACE, f"{sender_id}|{receiver_id}|{timestamp}|{content}"))
+
+def conversation_key(user_a, user_b):
+    return ':'.join(sorted((user_a, user_b))) # Mesma chave para os dois sentidos da conversa.
+
+def fts_query(text):
+    # Cada palavra vira um termo entre aspas (sem operadores do FTS5); a última também casa como prefixo.
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def connect_database(path, check_same_thread=True):
+    conn = sqlite3.connect(path, timeout=10, cached_statements=256, check_same_thread=check_same_thread) # Cache de statements preparados por conexão.
+    conn.execute("PRAGMA journal_mode=WAL") # Leitores não bloqueiam o escritor (e vice-versa).
+    conn.execute("PRAGMA synchronous=NORMAL") # Em WAL, fsync apenas nos checkpoints.
+    return conn
+
+def raise_open_files_limit(connections, reserve=256):
+    """Sobe o limite de descritores do processo para caber `connections` conexões e devolve quantas de fato cabem."""
+    if resource is None:
+        return connections
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = connections + reserve # Banco, logs, conexões de saída e arquivos.
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        log.info("[TCP SERVER] Limite de %s descritores: até %s conexões recebidas.", soft, max(1, soft - reserve)) # Log.
+        return max(1, soft - reserve)
+    return connections
+
+class DataDirectoryBusy(RuntimeError):
+    """Outro processo já usa o diretório de dados."""
+
+class DataDirectory:
+    """Diretório de um nó: banco, identidade persistente e arquivos recebidos. Um único processo por diretório."""
+    IDENTITY_FILE = 'identity.json'
+    LOCK_FILE = 'node.lock'
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def acquire(self):
+        if fcntl is None:
+            return
+        self.lock_file = open(self.file(self.LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB) # Liberada pelo sistema quando o processo termina.
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise DataDirectoryBusy(f"O diretório de dados {os.path.abspath(self.path)} já está em uso por outro nó (use --data-dir).")
+
+    def release(self):
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def load_identity(self):
+        """Devolve (user_id, username) gravados no diretório; na primeira execução cria um user_id novo."""
+        try:
+            with open(self.file(self.IDENTITY_FILE), encoding='utf-8') as f:
+                identity = json.load(f)
+        except FileNotFoundError:
+            identity = {'user_id': str(uuid.uuid4()), 'username': ''}
+            self.save_identity(identity['user_id'], identity['username'])
+            log.info("[IDENTITY] Nova identidade %s criada em %s.", identity['user_id'], self.path) # Log.
+        return identity['user_id'], identity.get('username', '')
+
+    def save_identity(self, user_id, username):
+        path = self.file(self.IDENTITY_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'user_id': user_id, 'username': username}, f)
+        os.replace(path + '.tmp', path) # Troca atômica: uma queda no meio não corrompe a identidade.
+
+class StorageWriter:
+    """Única thread que escreve no SQLite, agrupando as escritas da fila em transações por tamanho/tempo."""
+    def __init__(self, db_path, batch_size=256, batch_window=0.02):
+        self.db_path = db_path
+        self.batch_size = batch_size # Máximo de escritas por transação.
+        self.batch_window = batch_window # Tempo máximo (s) esperando mais escritas antes do commit.
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='storage-writer')
+        self.thread.start()
+
+    def execute(self, sql, params=(), wait=False):
+        future = Future()
+        self.queue.put((sql, params, future))
+        if wait: # Usado quando a interface precisa ler o resultado logo em seguida.
+            return future.result()
+        return future
+
+    def flush(self):
+        future = Future()
+        self.queue.put((None, None, future)) # Marcador: resolvido após o commit de tudo que veio antes.
+        future.result()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+    def run(self):
+        conn = connect_database(self.db_path) # Conexão compartilhada por todas as escritas.
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size and item[0] is not None: # Junta o que chegar na janela numa única transação.
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None) # Processa o lote atual antes de encerrar.
+                    break
+                batch.append(item) # Um flush fecha o lote: quem espera não paga a janela inteira.
+            self.write_batch(conn, batch)
+        conn.close()
+
+    def write_batch(self, conn, batch):
+        results = []
+        started = time.perf_counter()
+        try:
+            with conn: # Um commit (e um fsync) por lote.
+                for sql, params, future in batch:
+                    if sql is None:
+                        results.append((future, None, None))
+                        continue
+                    try:
+                        results.append((future, conn.execute(sql, params).rowcount, None))
+                    except sqlite3.Error as e:
+                        log.error("[STORAGE ERROR] Falha na escrita: %s", e) # Log de erro.
+                        results.append((future, None, e))
+        except sqlite3.Error as e:
+            log.error("[STORAGE ERROR] Falha ao confirmar lote de %s escritas: %s", len(batch), e) # Log de erro.
+            results = [(future, None, e) for _, _, future in batch]
+        DB_COMMITS.inc()
+        DB_WRITES.inc(len(batch))
+        DB_WRITE_MS.observe_since(started)
+        for future, rowcount, error in results:
+            if error is None:
+                future.set_result(rowcount)
+            else:
+                future.set_exception(error)
+
+Peer = namedtuple('Peer', 'ip port username last_seen') # last_seen em time.monotonic().
+
+class PeerRegistry:
+    """Tabela de peers online, thread-safe, com um heap de expiração: expirar custa O(peers expirados)."""
+    def __init__(self, timeout=10):
+        self.timeout = timeout # Segundos sem presença antes de o peer ser considerado offline.
+        self.peers = {} # peer_id -> Peer.
+        self.heap = [] # (prazo de expiração, peer_id), no máximo uma entrada por peer.
+        self.scheduled = set() # Peers com entrada no heap.
+        self.timeouts = {} # peer_id -> timeout anunciado pelo próprio peer (se diferente do padrão).
+        self.lock = threading.Lock()
+
+    def touch(self, peer_id, ip, port, username, timeout=None, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            previous = self.peers.get(peer_id)
+            self.peers[peer_id] = Peer(ip, port, username, now) # Renovar a presença não mexe no heap.
+            if timeout is None:
+                self.timeouts.pop(peer_id, None)
+            else:
+                self.timeouts[peer_id] = timeout
+            if peer_id not in self.scheduled:
+                self.scheduled.add(peer_id)
+                heapq.heappush(self.heap, (now + self.timeout, peer_id))
+        return previous
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now: # Só olha entradas cujo prazo já passou.
+                _, peer_id = heapq.heappop(self.heap)
+                peer = self.peers.get(peer_id)
+                deadline = peer.last_seen + self.timeouts.get(peer_id, self.timeout) if peer else None
+                if peer is None: # Removido explicitamente antes do prazo.
+                    self.scheduled.discard(peer_id)
+                elif deadline > now: # Presença renovada: reagenda para o prazo real.
+                    heapq.heappush(self.heap, (deadline, peer_id))
+                else:
+                    del self.peers[peer_id]
+                    self.timeouts.pop(peer_id, None)
+                    self.scheduled.discard(peer_id)
+                    expired.append((peer_id, peer))
+        return expired
+
+    def remove(self, peer_id):
+        with self.lock:
+            self.timeouts.pop(peer_id, None)
+            return self.peers.pop(peer_id, None) # A entrada no heap é descartada quando vencer.
+
+    def get(self, peer_id, default=None):
+        with self.lock:
+            return self.peers.get(peer_id, default)
+
+    def ids(self):
+        with self.lock:
+            return list(self.peers)
+
+    def __contains__(self, peer_id):
+        with self.lock:
+            return peer_id in self.peers
+
+    def __getitem__(self, peer_id):
+        with self.lock:
+            return self.peers[peer_id]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.peers)
+
+class RecentIds:
+    """Conjunto limitado (LRU) dos IDs de mensagens vistos recentemente, para descartar retransmissões sem ir ao banco."""
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.ids = OrderedDict()
+        self.lock = threading.Lock() # Consultado pelas threads de rede.
+
+    def add(self, message_id):
+        """Registra o ID e devolve False se ele já tinha sido visto."""
+        with self.lock:
+            if message_id in self.ids:
+                self.ids.move_to_end(message_id)
+                return False
+            self.ids[message_id] = None
+            if len(self.ids) > self.capacity:
+                self.ids.popitem(last=False) # Descarta o mais antigo; o índice único no banco continua valendo.
+            return True
+
+    def __contains__(self, message_id):
+        with self.lock:
+            return message_id in self.ids
+
+class ExpiringSet:
+    """IDs lembrados por `ttl` segundos (e no máximo `capacity`), para descartar frames repetidos em loops."""
+    def __init__(self, ttl=60, capacity=65536):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.expires = OrderedDict() # id -> momento de expiração, em ordem de inserção.
+        self.lock = threading.Lock()
+
+    def add(self, item, now=None):
+        """Registra o ID e devolve False se ele ainda estava no conjunto."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            while self.expires and (next(iter(self.expires.values())) <= now or len(self.expires) >= self.capacity):
+                self.expires.popitem(last=False) # Os mais antigos vencem primeiro: basta olhar o início.
+            if item in self.expires:
+                return False
+            self.expires[item] = now + self.ttl
+            return True
+
+class TokenBucket:
+    """Limitador de taxa: `rate` unidades por segundo com rajadas de até `burst`."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount=1, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+    def reserve(self, amount, max_wait, now=None):
+        """Como consume, mas aceita ficar devendo: devolve a espera em segundos, ou None se ela passar de `max_wait`."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (amount - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self.tokens -= amount
+            return wait
+
+class InboundLimiter:
+    """Limites por endereço remoto no tráfego recebido: frames/s e bytes/s, cada um num TokenBucket.
+
+    Acima do limite o frame é aceito com atraso: quem lê a conexão espera antes do próximo frame e o controle de
+    fluxo do TCP desacelera o remetente. Se a espera passar de `max_wait`, o frame é descartado. Taxa 0 desliga o limite.
+    """
+    def __init__(self, frame_rate, byte_rate, max_wait=1.0, capacity=4096):
+        self.frame_rate = frame_rate
+        self.byte_rate = byte_rate
+        self.max_wait = max_wait
+        self.capacity = capacity # Endereços com baldes em memória; os mais antigos são esquecidos.
+        self.buckets = OrderedDict() # IP remoto -> (balde de frames, balde de bytes).
+        self.lock = threading.Lock()
+
+    def buckets_for(self, address):
+        with self.lock:
+            buckets = self.buckets.pop(address, None)
+            if buckets is None:
+                frames = TokenBucket(self.frame_rate, burst=self.frame_rate * 2) if self.frame_rate else None
+                data = TokenBucket(self.byte_rate, burst=max(self.byte_rate * 2, MAX_FRAME_SIZE)) if self.byte_rate else None # Qualquer frame válido cabe no balde cheio.
+                buckets = (frames, data)
+            self.buckets[address] = buckets
+            if len(self.buckets) > self.capacity:
+                self.buckets.popitem(last=False)
+        return buckets
+
+    def admit(self, address, size):
+        """Devolve quantos segundos esperar antes de ler o próximo frame do endereço, ou None se este deve ser descartado."""
+        wait = 0.0
+        for bucket, amount in zip(self.buckets_for(address), (1, size)):
+            if bucket is not None:
+                delay = bucket.reserve(amount, self.max_wait)
+                if delay is None:
+                    return None
+                wait = max(wait, delay)
+        return wait
+
+Route = namedtuple('Route', 'next_hop hops username expires')
+
+class RelayRouter:
+    """Roteamento em múltiplos saltos: rotas aprendidas dos anúncios de relays e encaminhamento com TTL.
+
+    Qualquer nó usa as rotas para alcançar peers que não ouve diretamente; só nós com `enabled`
+    encaminham frames de terceiros (até `rate` bytes por segundo) e anunciam as próprias rotas.
+    """
+    ROUTES_PER_PACKET = 24 # Mantém cada anúncio de rotas abaixo do MTU típico.
+
+    def __init__(self, chat, enabled=False, max_hops=8, route_ttl=90, rate=64 * 1024):
+        self.chat = chat # Fornece a tabela de peers, o codec de cada peer e o dispatcher.
+        self.enabled = enabled
+        self.max_hops = max_hops # TTL inicial dos envelopes e distância máxima de uma rota.
+        self.route_ttl = route_ttl # Rotas não reanunciadas nesse prazo são descartadas.
+        self.routes = {} # peer_id de destino -> Route.
+        self.seen = ExpiringSet(ttl=60) # relay_id dos envelopes já tratados.
+        self.bucket = TokenBucket(rate, burst=rate * 2) # Banda máxima gasta encaminhando para outros nós.
+        self.lock = threading.Lock()
+
+    def learn(self, relay_id, entries, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for dest, hops, username in entries:
+                hops = int(hops) + 1 # Mais o salto até o relay que anunciou.
+                if dest == self.chat.user_id or hops > self.max_hops:
+                    continue
+                current = self.routes.get(dest)
+                if current is None or current.expires <= now or hops <= current.hops or current.next_hop == relay_id:
+                    self.routes[dest] = Route(relay_id, hops, username, now + self.route_ttl)
+
+    def next_hop(self, dest, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            route = self.routes.get(dest)
+            if route is None:
+                return None
+            if route.expires <= now or route.next_hop not in self.chat.peers: # Rota velha ou relay offline.
+                del self.routes[dest]
+                return None
+            return route.next_hop
+
+    def username(self, dest, default=None):
+        route = self.routes.get(dest)
+        return route.username if route else default
+
+    def advertisements(self, now=None):
+        """Pacotes UDP com os destinos alcançáveis a partir deste nó (só no modo relay)."""
+        if not self.enabled:
+            return []
+        now = time.monotonic() if now is None else now
+        entries = {}
+        for peer_id in self.chat.peers.ids():
+            peer = self.chat.peers.get(peer_id)
+            if peer:
+                entries[peer_id] = [peer_id, 0, peer.username] # Vizinho direto.
+        with self.lock:
+            for dest, route in self.routes.items():
+                if dest not in entries and route.expires > now and route.hops < self.max_hops:
+                    entries[dest] = [dest, route.hops, route.username]
+        entries = list(entries.values())
+        return [json.dumps({'type': 'routes', 'id': self.chat.user_id, 'r': entries[i:i + self.ROUTES_PER_PACKET]},
+                           separators=(',', ':')).encode()
+                for i in range(0, len(entries), self.ROUTES_PER_PACKET)]
+
+    def wrap(self, dest, message):
+        relay_id = str(uuid.uuid4())
+        self.seen.add(relay_id) # Se o envelope voltar para a origem, é descartado como loop.
+        return {
+            'type': 'relay',
+            'relay_id': relay_id,
+            'src': self.chat.user_id,
+            'dst': dest,
+            'ttl': self.max_hops,
+            'payload': message
+        }
+
+    def forward(self, envelope):
+        if not self.enabled:
+            log.debug("[RELAY] Envelope para %s descartado: modo relay desligado.", envelope['dst']) # Log.
+            return
+        if envelope['ttl'] <= 1:
+            log.debug("[RELAY] Envelope %s descartado: TTL esgotado.", envelope['relay_id']) # Log.
+            MESSAGES_DROPPED.inc()
+            return
+        dest = envelope['dst']
+        target = dest if dest in self.chat.peers else self.next_hop(dest)
+        if target is None:
+            log.debug("[RELAY] Sem rota para %s.", dest) # Log.
+            MESSAGES_DROPPED.inc()
+            return
+        forwarded = dict(envelope, ttl=envelope['ttl'] - 1)
+        data = encode_frame(encode_message(forwarded, self.chat.presence.peer_codecs(target)))
+        if not self.bucket.consume(len(data)): # Relay sobrecarregado: descarta em vez de virar gargalo.
+            log.debug("[RELAY] Limite de banda atingido; envelope para %s descartado.", dest) # Log.
+            MESSAGES_DROPPED.inc()
+            return
+        self.chat.dispatcher.submit(target, data)
+
+def open_discovery_socket(port, group=None):
+    """Socket UDP da descoberta. Vários nós do mesmo host podem escutar a mesma porta ao mesmo tempo."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Permite o reuso do endereço, útil para reiniciar o app.
+    if hasattr(socket, 'SO_REUSEPORT'): # Exigido no BSD/macOS para dividir a porta; no Linux cada nó recebe sua cópia dos anúncios.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1) # O mesmo socket escuta e anuncia.
+    try:
+        sock.bind(('0.0.0.0', port))
+        if group: # Anúncios por multicast: só chegam aos hosts que entraram no grupo.
+            membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1) # Não sai do segmento local.
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # Nós do próprio host também recebem.
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+class PresenceService:
+    """Presença adaptativa: heartbeats compactos com jitter e backoff, perfil completo só quando muda.
+
+    O intervalo dobra a cada rodada sem mudanças no conjunto de peers (até max_interval) e nunca fica
+    abaixo de (peers + 1) / rate_budget, de modo que o tráfego total do segmento fica limitado a cerca de
+    rate_budget pacotes por segundo. Cada anúncio informa o intervalo até o próximo, e quem recebe usa
+    esse valor para calcular quando o peer expira. Com `seeds` (ou broadcast desabilitado) os anúncios
+    também vão por unicast para as seeds e para alguns peers conhecidos (gossip). Com `group`, os anúncios
+    vão para esse grupo multicast em vez do endereço de broadcast.
+    """
+    def __init__(self, chat, min_interval=5, max_interval=30, rate_budget=50, jitter=0.25,
+                 broadcast=True, seeds=(), fanout=3, max_targets=256, group=None):
+        self.chat = chat # Fornece identidade, portas, tabela de peers e o tratamento de entradas/saídas.
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate_budget = rate_budget # Anúncios por segundo somando todos os nós do segmento.
+        self.jitter = jitter # Variação relativa do intervalo, evita rajadas sincronizadas.
+        self.broadcast = broadcast
+        self.group = group # Grupo multicast dos anúncios; None usa broadcast.
+        self.seeds = set(seeds) # Endereços UDP sempre incluídos no gossip.
+        self.fanout = fanout # Peers conhecidos sorteados por rodada de gossip.
+        self.max_targets = max_targets
+        self.stable_rounds = 0 # Rodadas seguidas sem mudança no conjunto de peers.
+        self.sent_version = None # Versão do perfil no último anúncio completo.
+        self.send_full = True
+        self.profiles = {} # peer_id -> (versão, username, tcp_port, codecs); sobrevive à expiração do peer.
+        self.queried = {} # peer_id -> momento da última consulta 'who' (evita repetir a cada heartbeat).
+        self.last_reply = 0 # Momento da última resposta a 'who' ou a um peer novo (no máximo uma por segundo).
+        self.targets = set() # Endereços UDP aprendidos por gossip.
+        self.sock = None # Socket UDP único da engine com threads (escuta e envio).
+        self.lock = threading.Lock()
+
+    @property
+    def gossip(self):
+        return bool(self.seeds) or not self.broadcast
+
+    def version(self):
+        return zlib.crc32(f"{self.chat.username}:{self.chat.tcp_port}".encode()) # Muda junto com o perfil.
+
+    def segment_address(self):
+        return (self.group or '255.255.255.255', self.chat.udp_port) # Destino dos anúncios para todo o segmento.
+
+    def open_socket(self):
+        sock = open_discovery_socket(self.chat.udp_port, self.group)
+        sock.settimeout(1) # Timeout de recebimento para não bloquear indefinidamente.
+        self.sock = sock
+        return sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, data, address):
+        if self.chat.network_engine:
+            self.chat.network_engine.send_datagram(data, address) # Usa o socket UDP do loop.
+            return
+        if self.sock is None:
+            return
+        try:
+            self.sock.sendto(data, address)
+        except OSError as e:
+            log.warning("Error broadcasting presence: %s", e) # Log de erro.
+
+    def peer_set_changed(self, joined=False, address=None):
+        self.stable_rounds = 0 # Volta ao intervalo mínimo enquanto a rede está mudando.
+        if joined:
+            self.send_full = True # Quem acabou de entrar ainda não conhece o nosso perfil.
+            if address: # Responde já: com o intervalo estável, o próximo anúncio pode demorar até ~36 s.
+                self.reply_profile(address)
+
+    def reply_profile(self, addr):
+        now = time.monotonic()
+        if now - self.last_reply >= 1: # Várias entradas ou consultas seguidas recebem uma única resposta.
+            self.last_reply = now
+            data = self.profile_message(self.current_interval() * (1 + self.jitter))
+            self.send(data, self.segment_address() if self.broadcast else addr)
+
+    def current_interval(self):
+        interval = min(self.max_interval, self.min_interval * 2 ** self.stable_rounds)
+        return max(interval, (len(self.chat.peers) + 1) / self.rate_budget)
+
+    def next_interval(self):
+        interval = self.current_interval()
+        self.stable_rounds = min(self.stable_rounds + 1, 16)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def profile_message(self, interval):
+        return json.dumps({
+            'type': 'presence',
+            'user_id': self.chat.user_id,
+            'username': self.chat.username,
+            'tcp_port': self.chat.tcp_port,
+            'version': self.version(),
+            'interval': round(interval, 1),
+            'codecs': list(WIRE_CODECS) # Sempre em JSON: é por aqui que os peers descobrem o formato binário.
+        }).encode()
+
+    def heartbeat_message(self, interval, digest=None):
+        message = {'type': 'hb', 'id': self.chat.user_id, 'v': self.version(), 'i': round(interval, 1)}
+        if digest:
+            message['p'] = digest # Amostra de peers conhecidos, só no gossip.
+        return encode_message(message, self.broadcast_codecs())
+
+    def peer_codecs(self, peer_id):
+        profile = self.profiles.get(peer_id)
+        return profile[3] if profile else ()
+
+    def is_legacy(self, peer_id):
+        # Todo nó com frames anuncia codecs na presença; um perfil sem eles é de uma versão antiga.
+        profile = self.profiles.get(peer_id)
+        return profile is not None and not profile[3]
+
+    def broadcast_codecs(self):
+        for peer_id in self.chat.peers.ids(): # Broadcast binário só se todos os peers online o entendem.
+            if 'bin1' not in self.peer_codecs(peer_id):
+                return ()
+        return WIRE_CODECS
+
+    def announce(self):
+        """Envia um anúncio e devolve o atraso em segundos até o próximo."""
+        interval = self.next_interval()
+        version = self.version()
+        if self.send_full or version != self.sent_version:
+            self.send_full = False
+            self.sent_version = version
+            broadcast_data = gossip_data = self.profile_message(interval)
+        else:
+            broadcast_data = self.heartbeat_message(interval)
+            gossip_data = None
+        advertisements = self.chat.relay.advertisements() # Rotas conhecidas, se este nó for relay.
+        if self.broadcast:
+            for data in [broadcast_data] + advertisements:
+                self.send(data, self.segment_address())
+        if self.gossip:
+            targets, digest = self.gossip_round()
+            gossip_data = gossip_data or self.heartbeat_message(interval, digest)
+            for address in targets:
+                for data in [gossip_data] + advertisements:
+                    self.send(data, address)
+        return interval
+
+    def gossip_round(self):
+        peer_ips = {}
+        for peer_id in self.chat.peers.ids():
+            peer = self.chat.peers.get(peer_id)
+            if peer:
+                peer_ips[peer_id] = peer.ip
+        with self.lock:
+            known = self.targets | {(ip, self.chat.udp_port) for ip in peer_ips.values()}
+        others = list(known - self.seeds)
+        targets = self.seeds | set(random.sample(others, min(self.fanout, len(others))))
+        digest = random.sample(sorted(peer_ips.items()), min(8, len(peer_ips)))
+        return targets, [list(item) for item in digest]
+
+    def handle_datagram(self, data, addr):
+        message = decode_message(data) # Binário ou JSON, conforme o primeiro byte.
+        kind = message.get('type')
+        if kind == 'hb' and message['id'] != self.chat.user_id:
+            self.learn_targets(addr, message.get('p', ()))
+            profile = self.profiles.get(message['id'])
+            if profile is None or profile[0] != message['v']: # Perfil desconhecido ou desatualizado.
+                self.query(message['id'], addr)
+                return
+            self.chat.peer_seen(message['id'], addr[0], profile[2], profile[1], self.peer_timeout(message.get('i')))
+        elif kind == 'presence' and message['user_id'] != self.chat.user_id:
+            self.learn_targets(addr, ())
+            username = message.get('username', 'Unknown') # Obtém o nome de usuário (com fallback).
+            codecs = frozenset(message.get('codecs', ())) # Peers antigos não anunciam codecs: só JSON.
+            self.profiles[message['user_id']] = (message.get('version'), username, message['tcp_port'], codecs)
+            timeout = self.peer_timeout(message.get('interval'))
+            self.chat.peer_seen(message['user_id'], addr[0], message['tcp_port'], username, timeout)
+        elif kind == 'routes' and message['id'] in self.chat.peers: # Só relays alcançáveis diretamente viram próximo salto.
+            self.chat.relay.learn(message['id'], message['r'])
+        elif kind == 'who' and message.get('id') == self.chat.user_id:
+            self.reply_profile(addr)
+
+    def query(self, peer_id, addr):
+        now = time.monotonic()
+        if now - self.queried.get(peer_id, 0) < 2:
+            return
+        self.queried[peer_id] = now
+        data = encode_message({'type': 'who', 'id': peer_id}, self.broadcast_codecs())
+        self.send(data, self.segment_address() if self.broadcast else addr)
+
+    def peer_timeout(self, interval):
+        if not interval: # Peers sem intervalo anunciado seguem o timeout padrão da tabela.
+            return None
+        return max(self.chat.peers.timeout, 2.5 * float(interval)) # Tolera a perda de um anúncio.
+
+    def learn_targets(self, addr, digest):
+        if not self.gossip:
+            return
+        with self.lock:
+            candidates = [(addr[0], self.chat.udp_port)] + [(ip, self.chat.udp_port) for _, ip in digest]
+            for address in candidates:
+                if len(self.targets) < self.max_targets:
+                    self.targets.add(address)
+
+class PeerStatusBatcher:
+    """Acumula transições online/offline dos peers para a interface aplicá-las em lote."""
+    def __init__(self, signals):
+        self.signals = signals
+        self.pending = {} # peer_id -> online (a última transição vence).
+        self.lock = threading.Lock()
+
+    def mark(self, peer_id, online):
+        with self.lock:
+            notify = not self.pending # Só avisa a interface quando o lote começa.
+            self.pending[peer_id] = online
+        if notify:
+            self.signals.peer_status_pending.emit()
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+class FriendCache:
+    """Tabela de amigos em memória, consultada sem acessar o banco e gravada em background pelo StorageWriter."""
+    def __init__(self, storage, user_id):
+        self.storage = storage
+        self.user_id = user_id
+        self.friends = {} # friend_id -> (friend_username, status).
+        self.lock = threading.Lock() # Acessada pelas threads de rede e pela interface.
+
+    def load(self, cursor):
+        cursor.execute("SELECT friend_id, friend_username, status FROM friends WHERE user_id = ?", (self.user_id,))
+        with self.lock:
+            self.friends = {friend_id: (username, status) for friend_id, username, status in cursor.fetchall()}
+
+    def status(self, friend_id):
+        entry = self.friends.get(friend_id)
+        return entry[1] if entry else None
+
+    def username(self, friend_id, default=None):
+        entry = self.friends.get(friend_id)
+        return entry[0] if entry and entry[0] else default
+
+    def accepted(self):
+        with self.lock:
+            return [(friend_id, username) for friend_id, (username, status) in self.friends.items() if status == 'accepted']
+
+    def add(self, friend_id, username, status, replace=False):
+        with self.lock:
+            if not replace and friend_id in self.friends:
+                return # Mesmo comportamento do INSERT OR IGNORE.
+            self.friends[friend_id] = (username, status)
+        self.storage.execute(f'''
+            INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO friends (user_id, friend_id, friend_username, status)
+            VALUES (?, ?, ?, ?)
+        ''', (self.user_id, friend_id, username, status))
+
+    def set_status(self, friend_id, status, username=None):
+        with self.lock:
+            if friend_id not in self.friends:
+                return # Mesmo comportamento do UPDATE sem linhas correspondentes.
+            self.friends[friend_id] = (username or self.friends[friend_id][0], status)
+        self.storage.execute('''
+            UPDATE friends
+            SET status = ?, friend_username = COALESCE(?, friend_username)
+            WHERE user_id = ? AND friend_id = ?
+        ''', (status, username, self.user_id, friend_id))
+
+    def remove(self, friend_id, status):
+        with self.lock:
+            if self.status(friend_id) != status:
+                return # Só remove se ainda estiver no estado esperado.
+            del self.friends[friend_id]
+        self.storage.execute('''
+            DELETE FROM friends
+            WHERE user_id = ? AND friend_id = ? AND status = ?
+        ''', (self.user_id, friend_id, status))
+
+class GroupDirectory:
+    """Grupos e seus membros em memória, consultados pelas threads de rede e gravados em background pelo StorageWriter."""
+    def __init__(self, storage, user_id):
+        self.storage = storage
+        self.user_id = user_id
+        self.groups = {} # group_id -> nome.
+        self.members = {} # group_id -> {member_id: username}.
+        self.lock = threading.Lock()
+
+    def load(self, cursor):
+        cursor.execute("SELECT group_id, name FROM groups WHERE user_id = ?", (self.user_id,))
+        groups = dict(cursor.fetchall())
+        cursor.execute("SELECT group_id, member_id, username FROM group_members WHERE user_id = ?", (self.user_id,))
+        members = {}
+        for group_id, member_id, username in cursor.fetchall():
+            members.setdefault(group_id, {})[member_id] = username
+        with self.lock:
+            self.groups, self.members = groups, members
+
+    def __contains__(self, group_id):
+        return group_id in self.groups
+
+    def name(self, group_id, default=None):
+        return self.groups.get(group_id, default)
+
+    def all(self):
+        with self.lock:
+            return list(self.groups.items())
+
+    def member_names(self, group_id):
+        with self.lock:
+            return dict(self.members.get(group_id, {}))
+
+    def is_member(self, group_id, member_id):
+        return member_id in self.members.get(group_id, ())
+
+    def others(self, group_id):
+        return [member_id for member_id in self.member_names(group_id) if member_id != self.user_id]
+
+    def add(self, group_id, name, owner_id, members):
+        with self.lock:
+            if group_id in self.groups:
+                return False # Convite repetido: o grupo já existe.
+            self.groups[group_id] = name
+            self.members[group_id] = dict(members)
+        self.storage.execute('''
+            INSERT OR IGNORE INTO groups (user_id, group_id, name, owner_id)
+            VALUES (?, ?, ?, ?)
+        ''', (self.user_id, group_id, name, owner_id))
+        for member_id, username in members.items():
+            self.storage.execute('''
+                INSERT OR IGNORE INTO group_members (user_id, group_id, member_id, username)
+                VALUES (?, ?, ?, ?)
+            ''', (self.user_id, group_id, member_id, username))
+        return True
+
+OutboxEntry = namedtuple('OutboxEntry', 'job_id peer_id content timestamp')
+
+class Outbox:
+    """Mensagens ainda não confirmadas pelo destinatário, persistidas na tabela outbox.
+
+    Acessada apenas na thread da interface. As que ainda não saíram (`entries`) são enviadas em lotes: cada peer
+    tem no máximo um lote em voo; uma falha no lote adia a próxima tentativa (base_delay, 2x, 4x... até max_delay)
+    e a volta do peer à rede zera o backoff. As já enviadas vão para o histórico, mas só saem da tabela com o ack;
+    até lá o AckTracker as reenvia.
+    """
+    def __init__(self, storage, user_id, base_delay=2, max_delay=300):
+        self.storage = storage
+        self.user_id = user_id
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.entries = {} # peer_id -> {job_id: OutboxEntry}, na ordem de envio.
+        self.in_flight = {} # peer_id -> job_ids do lote em andamento.
+        self.failures = {} # peer_id -> falhas seguidas (define o backoff).
+        self.retry_at = {} # peer_id -> time.monotonic() da próxima tentativa.
+
+    def load(self, cursor):
+        """Carrega as pendentes; devolve as que já foram enviadas (estão no histórico) e esperam o ack."""
+        cursor.execute('''
+            SELECT o.job_id, o.receiver_id, o.message, o.timestamp, m.id IS NOT NULL FROM outbox o
+            LEFT JOIN messages m ON m.message_id = o.job_id
+            WHERE o.sender_id = ? ORDER BY o.rowid
+        ''', (self.user_id,))
+        unacked = []
+        for *row, sent in cursor.fetchall():
+            entry = OutboxEntry(*row)
+            if sent:
+                unacked.append(entry)
+            else:
+                self.entries.setdefault(entry.peer_id, {})[entry.job_id] = entry
+        return unacked
+
+    def __contains__(self, job_id):
+        return any(job_id in entries for entries in self.entries.values())
+
+    def has(self, peer_id):
+        return bool(self.entries.get(peer_id))
+
+    def pending(self, peer_id):
+        return list(self.entries.get(peer_id, {}).values())
+
+    def enqueue(self, peer_id, content, timestamp, job_id):
+        entry = OutboxEntry(job_id, peer_id, content, timestamp)
+        self.entries.setdefault(peer_id, {})[job_id] = entry
+        self.storage.execute('''
+            INSERT OR IGNORE INTO outbox (job_id, sender_id, receiver_id, message, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (job_id, self.user_id, peer_id, content, timestamp))
+        return entry
+
+    def due_peers(self, now=None):
+        now = time.monotonic() if now is None else now
+        return [peer_id for peer_id, entries in self.entries.items()
+                if entries and not self.in_flight.get(peer_id) and self.retry_at.get(peer_id, 0) <= now]
+
+    def peer_online(self, peer_id):
+        self.failures.pop(peer_id, None) # O peer acabou de ser visto: tenta já, sem esperar o backoff.
+        self.retry_at.pop(peer_id, None)
+
+    def take(self, peer_id):
+        """Devolve todo o backlog do peer como um lote, ou [] se já houver um lote em voo."""
+        if self.in_flight.get(peer_id):
+            return []
+        batch = self.pending(peer_id)
+        self.in_flight[peer_id] = {entry.job_id for entry in batch}
+        return batch
+
+    def sent(self, entry, delivery='sent'):
+        """Grava a mensagem enviada no histórico; sem o ack, ela continua na tabela até `acked`."""
+        self.settle(entry)
+        entries = self.entries.get(entry.peer_id, {})
+        queued = entries.pop(entry.job_id, None) is not None
+        if not entries:
+            self.entries.pop(entry.peer_id, None)
+        self.failures.pop(entry.peer_id, None)
+        if delivery == 'delivered': # O ack chegou antes do fim do envio.
+            if queued:
+                self.acked(entry.job_id)
+        elif not queued: # Envio direto: guardada até o ack, inclusive se o nó reiniciar antes dele.
+            self.storage.execute('''
+                INSERT OR IGNORE INTO outbox (job_id, sender_id, receiver_id, message, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (entry.job_id, self.user_id, entry.peer_id, entry.content, entry.timestamp))
+        self.storage.execute('''
+            INSERT OR IGNORE INTO messages (message_id, sender_id, receiver_id, message, timestamp, conversation_id, delivery)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (entry.job_id, self.user_id, entry.peer_id, entry.content, entry.timestamp, conversation_key(self.user_id, entry.peer_id), delivery))
+
+    def acked(self, job_id):
+        self.storage.execute("DELETE FROM outbox WHERE job_id = ?", (job_id,))
+
+    def failed(self, entry, now=None):
+        now = time.monotonic() if now is None else now
+        self.settle(entry) # A mensagem continua na fila para a próxima tentativa.
+        if self.retry_at.get(entry.peer_id, 0) > now:
+            return # Outra mensagem do mesmo lote já adiou o peer.
+        failures = self.failures.get(entry.peer_id, 0) + 1
+        self.failures[entry.peer_id] = failures
+        delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        self.retry_at[entry.peer_id] = now + delay * random.uniform(0.5, 1) # Jitter evita retentativas em sincronia.
+
+    def settle(self, entry):
+        batch = self.in_flight.get(entry.peer_id)
+        if batch is not None:
+            batch.discard(entry.job_id) # Lote vazio libera o peer para a próxima tentativa.
+
+class AckTracker:
+    """Envios que esperam o ack do destinatário, por (peer, message_id).
+
+    Um envio concluído só diz que os bytes saíram: o receptor pode ter descartado o frame ou recusado a conexão por
+    sobrecarga. Sem ack até o prazo (timeout, 2x, 4x... até max_delay), `due` devolve o reenvio; o receptor descarta
+    a duplicata pelo ID e confirma de novo. Peers antigos nunca confirmam: depois de max_attempts reenvios, desiste.
+    """
+    def __init__(self, timeout=10, max_delay=300, max_attempts=5):
+        self.timeout = timeout
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.waiting = {} # (peer_id, message_id) -> [prazo, reenvios feitos, função que reenvia].
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def wait(self, peer_id, message_id, resend, delay=None, now=None):
+        now = time.monotonic() if now is None else now
+        # Um reenvio concluído não renova o registro: prazo e contagem continuam valendo.
+        self.waiting.setdefault((peer_id, message_id), [now + (self.timeout if delay is None else delay), 0, resend])
+
+    def acked(self, peer_id, message_id):
+        return self.waiting.pop((peer_id, message_id), None) is not None
+
+    def due(self, reachable, now=None):
+        """Devolve (reenvios a fazer agora, (peer, message_id) abandonados). Peers fora de alcance esperam sem contar tentativa."""
+        now = time.monotonic() if now is None else now
+        resend, abandoned = [], []
+        for key, item in list(self.waiting.items()):
+            deadline, attempts, callback = item
+            if deadline > now or not reachable(key[0]):
+                continue
+            if attempts >= self.max_attempts:
+                del self.waiting[key]
+                abandoned.append(key)
+                continue
+            item[0] = now + min(self.max_delay, self.timeout * 2 ** (attempts + 1))
+            item[1] = attempts + 1
+            resend.append(callback)
+        return resend, abandoned
+
+class HistorySync:
+    """Reconcilia o histórico de uma conversa quando um amigo volta: compara resumos por dia e transfere só o que falta.
+
+    Protocolo (o nó de menor ID inicia):
+      sync_summary {since, buckets: {dia: [contagem, xor dos IDs]}} ->
+      <- sync_ids {since, days: {dia: [IDs]}} apenas dos dias divergentes
+      sync_messages (as que o outro não tem) + sync_pull {ids} -> <- sync_messages
+    `since` é o ponto até onde a conversa já foi confirmada igual; nada antes dele é comparado de novo. O
+    respondedor usa o maior entre o `since` recebido e o próprio, e os dois lados comparam a partir dele.
+    """
+    BATCH_SIZE = 200 # Mensagens por frame sync_messages.
+    MARGIN = timedelta(days=7) # Folga do `since`: mensagens da outbox chegam com o timestamp original.
+
+    def __init__(self, chat, db_path):
+        self.chat = chat # Fornece identidade, escrita (storage) e envio (send_to_peer).
+        self.conn = connect_database(db_path, check_same_thread=False) # Leituras próprias, fora da thread da interface.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-sync') # Uma sincronização por vez.
+
+    def start(self, peer_id):
+        self.executor.submit(self.run, self.send_summary, peer_id)
+
+    def handle(self, message):
+        self.executor.submit(self.run, self.dispatch, message)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, function, *args):
+        try:
+            function(*args)
+        except Exception as e:
+            log.warning("[HISTORY SYNC ERROR] %s", e) # Log de erro.
+
+    def dispatch(self, message):
+        handler = {
+            'sync_summary': self.handle_summary,
+            'sync_ids': self.handle_ids,
+            'sync_pull': self.handle_pull,
+            'sync_messages': self.handle_messages
+        }[message['type']]
+        handler(message['sender_id'], message)
+
+    def synced_until(self, peer_id):
+        row = self.conn.execute('''
+            SELECT synced_until FROM sync_state
+            WHERE (user_id = ? AND peer_id = ?) OR (user_id = '*' AND peer_id = '*')
+            ORDER BY user_id = '*' LIMIT 1
+        ''', (self.chat.user_id, peer_id)).fetchone()
+        return row[0] if row and row[0] else ''
+
+    def day_range(self, day):
+        next_day = (datetime.fromisoformat(day) + timedelta(days=1)).date().isoformat()
+        return day, next_day # Intervalo [dia, dia seguinte) nos timestamps ISO, usando o índice da conversa.
+
+    def buckets(self, peer_id, since):
+        self.chat.storage.flush() # Inclui escritas ainda na fila.
+        buckets = {}
+        for timestamp, message_id in self.conn.execute('''
+            SELECT timestamp, message_id FROM messages
+            WHERE conversation_id = ? AND timestamp > ?
+        ''', (conversation_key(self.chat.user_id, peer_id), since)):
+            count, digest = buckets.get(timestamp[:10], (0, 0))
+            buckets[timestamp[:10]] = (count + 1, digest ^ (uuid.UUID(message_id).int >> 64)) # XOR: independe da ordem.
+        return {day: list(value) for day, value in buckets.items()}
+
+    def day_ids(self, peer_id, day, since=''):
+        start, end = self.day_range(day)
+        return {row[0] for row in self.conn.execute('''
+            SELECT message_id FROM messages
+            WHERE conversation_id = ? AND timestamp >= ? AND timestamp < ? AND timestamp > ?
+        ''', (conversation_key(self.chat.user_id, peer_id), start, end, since))}
+
+    def send_summary(self, peer_id):
+        since = self.synced_until(peer_id)
+        buckets = self.buckets(peer_id, since)
+        log.debug("[HISTORY SYNC] Enviando resumo de %s dia(s) para %s (desde '%s').", len(buckets), peer_id, since) # Log.
+        self.chat.send_to_peer(peer_id, {'type': 'sync_summary', 'sender_id': self.chat.user_id, 'since': since, 'buckets': buckets})
+
+    def handle_summary(self, peer_id, message):
+        # Compara a partir do marco mais recente dos dois lados: antes do nosso, os IDs podem ser só locais.
+        since = max(message['since'], self.synced_until(peer_id))
+        theirs = {day: value for day, value in message['buckets'].items() if day >= since[:10]}
+        mine = self.buckets(peer_id, since)
+        partial = since[:10] if since != message['since'] else None # Dia cortado no meio: os resumos não são comparáveis.
+        days = {day: sorted(self.day_ids(peer_id, day, since)) if day in mine else []
+                for day in set(mine) | set(theirs) if day == partial or mine.get(day) != theirs.get(day)}
+        log.debug("[HISTORY SYNC] %s dia(s) divergente(s) com %s.", len(days), peer_id) # Log.
+        self.chat.send_to_peer(peer_id, {'type': 'sync_ids', 'sender_id': self.chat.user_id, 'since': since, 'days': days})
+
+    def handle_ids(self, peer_id, message):
+        if not message['days']: # Conversa igual dos dois lados: o próximo resumo começa mais adiante.
+            since = max(self.synced_until(peer_id), (datetime.now() - self.MARGIN).date().isoformat())
+            self.chat.storage.execute('''
+                INSERT OR REPLACE INTO sync_state (user_id, peer_id, synced_until) VALUES (?, ?, ?)
+            ''', (self.chat.user_id, peer_id, since))
+            return
+        since = max(message.get('since', ''), self.synced_until(peer_id)) # Peers antigos não informam o marco usado.
+        push, pull = set(), set()
+        for day, their_ids in message['days'].items():
+            mine, theirs = self.day_ids(peer_id, day, since), set(their_ids)
+            push |= mine - theirs
+            pull |= theirs - mine
+        log.debug("[HISTORY SYNC] Enviando %s e pedindo %s mensagem(ns) de %s.", len(push), len(pull), peer_id) # Log.
+        self.send_messages(peer_id, push)
+        if pull:
+            self.chat.send_to_peer(peer_id, {'type': 'sync_pull', 'sender_id': self.chat.user_id, 'ids': sorted(pull)})
+
+    def handle_pull(self, peer_id, message):
+        self.send_messages(peer_id, message['ids'])
+
+    def send_messages(self, peer_id, message_ids):
+        message_ids = list(message_ids)
+        conversation_id = conversation_key(self.chat.user_id, peer_id)
+        for i in range(0, len(message_ids), self.BATCH_SIZE):
+            chunk = message_ids[i:i + self.BATCH_SIZE]
+            rows = self.conn.execute(f'''
+                SELECT message_id, sender_id, receiver_id, message, timestamp FROM messages
+                WHERE conversation_id = ? AND message_id IN ({','.join('?' * len(chunk))})
+            ''', [conversation_id] + chunk).fetchall() # Só mensagens desta conversa, mesmo que peçam outras.
+            if rows:
+                self.chat.send_to_peer(peer_id, {'type': 'sync_messages', 'sender_id': self.chat.user_id, 'messages': [list(row) for row in rows]})
+
+    def handle_messages(self, peer_id, message):
+        members = {self.chat.user_id, peer_id}
+        rows = []
+        for message_id, sender_id, receiver_id, content, timestamp in message['messages']:
+            if {sender_id, receiver_id} != members:
+                continue # Ignora mensagens de outras conversas.
+            delivery = 'delivered' if sender_id == self.chat.user_id else None # O amigo já tem a nossa mensagem.
+            rows.append((message_id, sender_id, receiver_id, content, timestamp, conversation_key(sender_id, receiver_id), delivery))
+        for row in rows:
+            self.chat.storage.execute('''
+                INSERT OR IGNORE INTO messages (message_id, sender_id, receiver_id, message, timestamp, conversation_id, delivery)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', row)
+        log.debug("[HISTORY SYNC] %s mensagem(ns) recebida(s) de %s.", len(rows), peer_id) # Log.
+
+FILE_HELLO = struct.Struct('!16sQ') # Abertura da conexão de arquivo: ID da transferência e deslocamento inicial.
+FILE_CHUNK = struct.Struct('!QI32s') # Cabeçalho de cada bloco: deslocamento, tamanho e SHA-256 do conteúdo.
+FILE_ACK = struct.Struct('!Q') # Deslocamento confirmado pelo destinatário (tudo antes dele verificado e gravado).
+
+def recv_exact(sock, view):
+    """Preenche `view` inteiro a partir do socket, sem cópias intermediárias."""
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Conexão de arquivo encerrada.")
+        received += count
+
+IncomingFile = namedtuple('IncomingFile', 'peer_id name size part_path')
+
+class FileTransfer:
+    """Transferência de arquivos entre amigos por uma conexão TCP dedicada, separada do pool das mensagens.
+
+    Protocolo:
+      file_offer {transfer_id, name, size, chunk_size} pelo canal de mensagens ->
+      <- file_accept {transfer_id, port, offset}: o destinatário escuta numa porta efêmera e informa de onde retomar
+      conexão dedicada: FILE_HELLO, depois blocos FILE_CHUNK + conteúdo; cada bloco verificado é confirmado com FILE_ACK.
+      ou file_reject {transfer_id, reason} se o destinatário recusar (usuário, tamanho inválido, disco cheio)
+      conexão dedicada: FILE_HELLO, depois blocos FILE_CHUNK + conteúdo; cada bloco verificado é confirmado com FILE_ACK.
+    Uma oferta nova só é aceita por accept() (a interface pergunta ao usuário; o modo headless decide por política);
+    até lá fica em `offers`, emitida por signals.file_offer. Recepções e envios rodam em pools pequenos, então ofertas
+    em excesso esperam na fila em vez de abrir uma thread cada.
+    O remetente mantém no máximo `window` blocos sem confirmação (controle de fluxo próprio, opcionalmente limitado por
+    `rate` bytes/s), então uma transferência grande não atrasa o chat. Só blocos verificados são gravados no arquivo
+    `.part`, por isso o tamanho dele é o ponto de retomada; uma queda ou um bloco corrompido encerra a conexão e o
+    remetente oferece de novo, continuando do último deslocamento confirmado.
+    """
+    CHUNK_SIZE = 256 * 1024
+    RETRIES = 5 # Novas ofertas após falhas antes de desistir.
+    MAX_OFFERS = 16 # Ofertas aguardando decisão; além disso são recusadas.
+
+    def __init__(self, chat, directory='recebidos', window=8, rate=0, timeout=30, max_size=4 * 1024 ** 3, workers=4):
+        self.chat = chat # Fornece identidade, endereços dos peers e envio de controle (send_to_peer).
+        self.directory = directory # Destino dos arquivos recebidos (e dos parciais .part).
+        self.window = window
+        self.rate = rate # 0 = sem limite além da janela.
+        self.timeout = timeout
+        self.max_size = max_size # Maior arquivo aceito, em bytes.
+        self.outgoing = {} # transfer_id -> [peer_id, caminho, tamanho, tentativas].
+        self.incoming = {} # transfer_id -> IncomingFile.
+        self.offers = {} # transfer_id -> file_offer aguardando accept() ou reject().
+        self.queued = set() # transfer_ids aceitos esperando uma thread livre do pool de recepção.
+        self.active = {} # transfer_id -> socket da conexão em uso (encerrado quando chega uma nova oferta).
+        self.lock = threading.Lock()
+        # No máximo `workers` recepções e `workers` envios simultâneos; o resto espera na fila do pool.
+        self.receivers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='file-in')
+        self.senders = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='file-out')
+
+    def offer(self, peer_id, path):
+        transfer_id = str(uuid.uuid4())
+        with self.lock:
+            self.outgoing[transfer_id] = [peer_id, path, os.path.getsize(path), 0]
+        self.send_offer(transfer_id)
+        return transfer_id
+
+    def send_offer(self, transfer_id):
+        peer_id, path, size, _ = self.outgoing[transfer_id]
+        self.chat.signals.file_status.emit(transfer_id, peer_id, 'waiting', os.path.basename(path))
+        self.chat.send_to_peer(peer_id, {
+            'type': 'file_offer',
+            'sender_id': self.chat.user_id,
+            'transfer_id': transfer_id,
+            'name': os.path.basename(path),
+            'size': size,
+            'chunk_size': self.CHUNK_SIZE
+        })
+
+    def handle(self, message):
+        if message['type'] == 'file_offer':
+            self.offered(message)
+        elif message['type'] == 'file_accept':
+            self.senders.submit(self.run, self.send, message)
+        else:
+            self.rejected(message)
+
+    def offered(self, message):
+        peer_id = message['sender_id']
+        try:
+            transfer_id, name, size = str(uuid.UUID(message['transfer_id'])), str(message['name']), message['size']
+        except (KeyError, ValueError, TypeError, AttributeError):
+            return # Oferta malformada: não há nem como responder.
+        if type(size) is not int or not 0 < size <= self.max_size:
+            self.send_reject(peer_id, transfer_id, f"tamanho inválido ({size!r})")
+            return
+        if message.get('chunk_size') != self.CHUNK_SIZE:
+            self.send_reject(peer_id, transfer_id, "tamanho de bloco não suportado")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        part_path = self.part_path(transfer_id)
+        received = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if shutil.disk_usage(self.directory).free < size - received:
+            self.send_reject(peer_id, transfer_id, "espaço em disco insuficiente")
+            return
+        with self.lock:
+            entry = self.incoming.get(transfer_id)
+            resumed = entry is not None and entry.peer_id == peer_id # Retomada de uma transferência já aceita.
+            pending = transfer_id in self.offers
+            full = not resumed and not pending and len(self.offers) >= self.MAX_OFFERS
+            if not resumed and not full:
+                self.offers[transfer_id] = message
+        if full:
+            self.send_reject(peer_id, transfer_id, "ofertas pendentes demais")
+        elif resumed:
+            self.start_receive(message)
+        elif not pending: # Oferta repetida enquanto o usuário decide: não pergunta de novo.
+            self.chat.signals.file_offer.emit(transfer_id, peer_id, name, size)
+
+    def accept(self, transfer_id):
+        """Aceita uma oferta pendente de signals.file_offer; a recepção entra na fila do pool."""
+        with self.lock:
+            message = self.offers.pop(transfer_id, None)
+        if message:
+            self.start_receive(message)
+
+    def reject(self, transfer_id, reason='recusado pelo destinatário'):
+        """Recusa uma oferta pendente; o remetente recebe file_reject e desiste da transferência."""
+        with self.lock:
+            message = self.offers.pop(transfer_id, None)
+        if message:
+            self.send_reject(message['sender_id'], transfer_id, reason)
+
+    def send_reject(self, peer_id, transfer_id, reason):
+        log.info("[FILE TRANSFER] Oferta %s de %s recusada: %s", transfer_id, peer_id, reason) # Log.
+        self.chat.send_to_peer(peer_id, {
+            'type': 'file_reject',
+            'sender_id': self.chat.user_id,
+            'transfer_id': transfer_id,
+            'reason': reason
+        })
+
+    def rejected(self, message):
+        transfer_id = message.get('transfer_id')
+        with self.lock:
+            entry = self.outgoing.get(transfer_id)
+            if not entry or entry[0] != message['sender_id']:
+                return
+            del self.outgoing[transfer_id]
+        self.chat.signals.file_status.emit(transfer_id, entry[0], 'failed', str(message.get('reason', 'recusado')))
+
+    def start_receive(self, message):
+        transfer_id = str(uuid.UUID(message['transfer_id']))
+        with self.lock:
+            if transfer_id in self.queued:
+                return # Já está na fila; a recepção usa o estado mais recente ao começar.
+            self.queued.add(transfer_id)
+            previous = self.active.get(transfer_id)
+        if previous: # Nova oferta da mesma transferência: libera a thread presa na conexão antiga.
+            previous.close()
+        self.receivers.submit(self.run, self.receive, message)
+
+    def run(self, function, message):
+        try:
+            function(message)
+        except Exception as e:
+            log.warning("[FILE TRANSFER ERROR] %s", e) # Log de erro.
+
+    def claim(self, transfer_id, sock):
+        with self.lock:
+            previous = self.active.get(transfer_id)
+            self.active[transfer_id] = sock
+        if previous: # Nova oferta da mesma transferência: a conexão antiga está morta ou será substituída.
+            previous.close()
+
+    def release(self, transfer_id, sock):
+        with self.lock:
+            if self.active.get(transfer_id) is sock:
+                del self.active[transfer_id]
+        sock.close()
+
+    def part_path(self, transfer_id):
+        return os.path.join(self.directory, f"{transfer_id}.part")
+
+    def final_path(self, name):
+        base, ext = os.path.splitext(os.path.basename(name) or 'arquivo')
+        path, counter = os.path.join(self.directory, base + ext), 1
+        while os.path.exists(path): # Nunca sobrescreve um arquivo já recebido.
+            path = os.path.join(self.directory, f"{base} ({counter}){ext}")
+            counter += 1
+        return path
+
+    def receive(self, message):
+        peer_id, transfer_id = message['sender_id'], str(uuid.UUID(message['transfer_id']))
+        with self.lock:
+            self.queued.discard(transfer_id)
+        address = self.chat.peer_address(peer_id)
+        if not address:
+            return # Exige conexão direta.
+        entry = IncomingFile(peer_id, str(message['name']), message['size'], self.part_path(transfer_id))
+        with self.lock:
+            entry = self.incoming.setdefault(transfer_id, entry) # Retomada: mantém nome e tamanho da primeira oferta.
+        os.makedirs(self.directory, exist_ok=True)
+        with open(entry.part_path, 'ab') as part:
+            offset = part.tell() - part.tell() % self.CHUNK_SIZE # Descarta um bloco gravado pela metade.
+        listener = socket.create_server(('', 0))
+        listener.settimeout(self.timeout)
+        self.claim(transfer_id, listener)
+        self.chat.send_to_peer(peer_id, {
+            'type': 'file_accept',
+            'sender_id': self.chat.user_id,
+            'transfer_id': transfer_id,
+            'port': listener.getsockname()[1],
+            'offset': offset
+        })
+        try:
+            while True:
+                sock, addr = listener.accept()
+                if addr[0] == address[0]: # Só aceita o remetente da oferta.
+                    break
+                sock.close()
+        finally:
+            listener.close()
+        self.claim(transfer_id, sock)
+        self.chat.signals.file_status.emit(transfer_id, peer_id, 'receiving', entry.name)
+        try:
+            sock.settimeout(self.timeout)
+            hello = bytearray(FILE_HELLO.size)
+            recv_exact(sock, memoryview(hello))
+            hello_id, hello_offset = FILE_HELLO.unpack(hello)
+            if hello_id != uuid.UUID(transfer_id).bytes or hello_offset != offset:
+                raise FrameError("Abertura de transferência inválida.")
+            header = bytearray(FILE_CHUNK.size)
+            view = memoryview(bytearray(self.CHUNK_SIZE)) # Buffer reutilizado para todos os blocos.
+            with open(entry.part_path, 'r+b') as part:
+                part.truncate(offset)
+                part.seek(offset)
+                while offset < entry.size:
+                    recv_exact(sock, memoryview(header))
+                    chunk_offset, length, digest = FILE_CHUNK.unpack(header)
+                    if chunk_offset != offset or length > min(self.CHUNK_SIZE, entry.size - offset) or not length:
+                        raise FrameError(f"Bloco inesperado em {chunk_offset}.")
+                    recv_exact(sock, view[:length])
+                    if hashlib.sha256(view[:length]).digest() != digest:
+                        raise FrameError(f"Bloco em {offset} corrompido.") # O remetente retoma a partir de `offset`.
+                    part.write(view[:length])
+                    part.flush()
+                    offset += length
+                    sock.sendall(FILE_ACK.pack(offset))
+                    self.chat.signals.file_progress.emit(transfer_id, peer_id, offset, entry.size)
+        except Exception as e:
+            self.chat.signals.file_status.emit(transfer_id, peer_id, 'interrupted', str(e))
+            raise
+        finally:
+            self.release(transfer_id, sock)
+        path = self.final_path(entry.name)
+        os.replace(entry.part_path, path)
+        with self.lock:
+            self.incoming.pop(transfer_id, None)
+        self.chat.signals.file_status.emit(transfer_id, peer_id, 'done', path)
+
+    def send(self, message):
+        transfer_id = message['transfer_id']
+        with self.lock:
+            entry = self.outgoing.get(transfer_id)
+        if not entry or entry[0] != message['sender_id']:
+            return
+        peer_id, path, size, _ = entry
+        address = self.chat.peer_address(peer_id)
+        try:
+            if not address:
+                raise ConnectionError("Transferência de arquivo exige conexão direta com o peer.")
+            sock = socket.create_connection((address[0], message['port']), timeout=self.timeout)
+        except OSError as e:
+            self.retry(transfer_id, e)
+            return
+        self.claim(transfer_id, sock)
+        self.chat.signals.file_status.emit(transfer_id, peer_id, 'sending', os.path.basename(path))
+        offset = acked = message['offset']
+        bucket = TokenBucket(self.rate, burst=max(self.rate, self.CHUNK_SIZE)) if self.rate else None
+        view = memoryview(bytearray(self.CHUNK_SIZE))
+        ack = bytearray(FILE_ACK.size)
+        try:
+            sock.sendall(FILE_HELLO.pack(uuid.UUID(transfer_id).bytes, offset))
+            with open(path, 'rb') as source:
+                while acked < size:
+                    while offset < size and offset - acked < self.window * self.CHUNK_SIZE:
+                        source.seek(offset)
+                        length = source.readinto(view[:min(self.CHUNK_SIZE, size - offset)])
+                        if not length:
+                            raise IOError(f"{path} diminuiu durante o envio.")
+                        while bucket and not bucket.consume(length):
+                            time.sleep(length / self.rate / 4) # Espera os tokens do bloco acumularem.
+                        sock.sendall(FILE_CHUNK.pack(offset, length, hashlib.sha256(view[:length]).digest()))
+                        sock.sendfile(source, offset, length) # Do cache de páginas direto para o socket.
+                        offset += length
+                    recv_exact(sock, memoryview(ack)) # Janela cheia (ou fim): espera o destinatário confirmar.
+                    acked = FILE_ACK.unpack(ack)[0]
+                    self.chat.signals.file_progress.emit(transfer_id, peer_id, acked, size)
+        except Exception as e:
+            self.retry(transfer_id, e)
+            return
+        finally:
+            self.release(transfer_id, sock)
+        with self.lock:
+            self.outgoing.pop(transfer_id, None)
+        self.chat.signals.file_status.emit(transfer_id, peer_id, 'done', path)
+
+    def retry(self, transfer_id, error):
+        with self.lock:
+            entry = self.outgoing.get(transfer_id)
+            if entry:
+                entry[3] += 1
+        if not entry:
+            return
+        if entry[3] > self.RETRIES:
+            with self.lock:
+                self.outgoing.pop(transfer_id, None)
+            self.chat.signals.file_status.emit(transfer_id, entry[0], 'failed', str(error))
+            return
+        log.info("[FILE TRANSFER] Transferência %s interrompida (%s); retomando.", transfer_id, error) # Log.
+        self.chat.signals.file_status.emit(transfer_id, entry[0], 'interrupted', str(error))
+        time.sleep(min(2 ** entry[3], 30)) # Backoff antes de oferecer de novo (já na thread da transferência).
+        self.send_offer(transfer_id)
+
+    def shutdown(self):
+        self.receivers.shutdown(wait=False, cancel_futures=True)
+        self.senders.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            sockets = list(self.active.values())
+        for sock in sockets:
+            sock.close()
+
+class ChatNode:
+    """Nó do chat sem interface: descoberta, conexões, armazenamento, amigos, grupos e arquivos.
+
+    Sinais e timers rodam no laço `loop` (EventLoop no modo headless, o loop do Qt na interface); quem usa o nó
+    se conecta aos eventos de `signals` e chama os métodos públicos sempre a partir desse laço.
+    """
+    def __init__(self, loop, use_asyncio=None, data_dir=None):
+        if use_asyncio is None: # Por padrão, decide pela variável de ambiente CHATMESH_ASYNCIO.
+            use_asyncio = os.environ.get('CHATMESH_ASYNCIO', '') not in ('', '0')
+        self.loop = loop # Onde rodam os callbacks dos sinais e dos timers.
+        # Cada nó tem o seu diretório (padrão: CHATMESH_DATA_DIR ou o diretório atual); dois processos não dividem um banco.
+        self.data_dir = DataDirectory(data_dir or os.environ.get('CHATMESH_DATA_DIR', '.'))
+        self.data_dir.acquire()
+        self.user_id, self.username = self.data_dir.load_identity() # O mesmo ID a cada execução: amigos e histórico continuam válidos.
+        self.peers = PeerRegistry(timeout=10) # Peers online; expiram após 10 s sem presença.
+        self.signals = MessageSignals(loop) 
+        self.udp_port = 50000  # Porta UDP fixa para descoberta de peers.
+        self.tcp_port = self.find_free_port() # Encontra uma porta TCP livre dinamicamente.
+        self.tcp_backlog = int(os.environ.get('CHATMESH_TCP_BACKLOG', 128)) # Conexões aguardando o accept no kernel.
+        # Threads que processam as conexões com dados e a fila das que esperam uma delas.
+        self.tcp_workers = max(1, int(os.environ.get('CHATMESH_TCP_WORKERS', 64)))
+        self.tcp_queue = max(1, int(os.environ.get('CHATMESH_TCP_QUEUE', 256))) # queue.Queue(0) não teria limite.
+        # Conexões recebidas abertas ao mesmo tempo (nas duas engines); além disso o servidor recusa novas conexões.
+        self.max_connections = raise_open_files_limit(max(1, int(os.environ.get('CHATMESH_MAX_CONNECTIONS', 10000))))
+        self.inbound = InboundLimiter(float(os.environ.get('CHATMESH_PEER_FRAME_RATE', 1000)),
+                                      int(os.environ.get('CHATMESH_PEER_BYTE_RATE', 4 * 1024 * 1024))) # Limites por endereço remoto.
+        self.shed_warnings = TokenBucket(1)
+        self.stopping = False # stop() chamado: as threads de rede encerram e os frames que chegarem são ignorados.
+        self.tcp_thread = None
+        self.udp_listener_thread = None
+        self.db_path = self.data_dir.file('chat.db') # Arquivo do banco de dados SQLite.
+        self.presence = PresenceService(self, broadcast=os.environ.get('CHATMESH_BROADCAST', '1') != '0',
+                                        seeds=self.parse_seeds(os.environ.get('CHATMESH_SEEDS', '')),
+                                        group=os.environ.get('CHATMESH_MULTICAST') or None)
+        self.network_engine = AsyncNetworkEngine(self) if use_asyncio else None # Engine asyncio opcional.
+        # Servidor TCP da engine com threads; criado aqui para que stop() o encerre mesmo antes da thread começar.
+        self.inbound_pool = None if use_asyncio else InboundConnectionPool(
+            self.read_tcp_connection, self.tcp_workers, self.tcp_queue, self.max_connections, on_shed=self.connection_shed)
+        # Com a engine asyncio, ela mesma mantém as conexões persistentes (mesma interface do pool).
+        self.connection_pool = self.network_engine or PeerConnectionPool(self.peer_address, is_legacy=self.presence.is_legacy)
+        self.peer_status_batcher = PeerStatusBatcher(self.signals) # Transições de status aplicadas em lote.
+        self.recent_message_ids = RecentIds() # IDs recebidos recentemente, para descartar duplicatas.
+        self.relay = RelayRouter(self, enabled=os.environ.get('CHATMESH_RELAY', '') not in ('', '0'),
+                                 rate=int(os.environ.get('CHATMESH_RELAY_RATE', 64 * 1024))) # Encaminhamento entre sub-redes.
+        self.acked_message_ids = RecentIds() # Confirmações recebidas (podem chegar antes do fim do envio).
+        # Envios fora do laço do nó; 32 threads abrem em paralelo as conexões do fan-out de um grupo.
+        self.dispatcher = OutboundDispatcher(self.connection_pool, self.signals, max_workers=32)
+        self.send_callbacks = {} # job_id -> função chamada no laço do nó com o resultado do envio.
+        self.watched_messages = RecentIds() # Mensagens de chat cujo status é publicado em signals.message_status.
+        self.group_sends = {} # message_id -> {'members', 'sent', 'delivered'}: entrega por membro das mensagens de grupo.
+        self.acks = AckTracker() # Mensagens enviadas (1:1 e de grupo) ainda sem ack: reenviadas até a confirmação.
+        self.file_transfer = FileTransfer(self, directory=self.data_dir.file('recebidos'),
+                                          rate=int(os.environ.get('CHATMESH_FILE_RATE', 0)),
+                                          max_size=int(os.environ.get('CHATMESH_FILE_MAX_SIZE', 4 * 1024 ** 3))) # Arquivos por conexão dedicada.
+        self.timers = [] # Timers periódicos, cancelados em stop().
+        self.presence_timer = None
+        self.peer_status_flush_pending = False
+        self.init_database() # Inicializa a conexão com o banco de dados SQLite.
+        self.signals.send_status.connect(self.handle_send_status)
+        self.signals.message_delivered.connect(self.handle_message_delivered)
+        self.signals.peer_status_pending.connect(self.schedule_peer_status_flush)
+        self.signals.friend_response.connect(self.handle_friend_response) # Conectado antes da interface: o cache já está atualizado quando ela recarrega a lista.
+
+    def start(self):
+        self.start_network_threads() # Inicia as threads de rede para comunicação.
+        self.presence_timer = self.loop.call_later(0, self.broadcast_presence) # Primeiro anúncio assim que o laço rodar.
+        self.timers = [
+            self.loop.call_every(1, self.check_offline_peers), # Só consulta o topo do heap.
+            self.loop.call_every(30, self.connection_pool.evict_idle), # Fecha conexões ociosas.
+            self.loop.call_every(1, self.flush_outbox) # Verifica quais filas já passaram do backoff.
+        ]
+
+    def stop(self):
+        self.stopping = True # A partir daqui, frames recebidos não chegam mais ao banco.
+        for timer in self.timers + [self.presence_timer]:
+            if timer:
+                timer.cancel()
+        self.connection_pool.close_all() # Conexões persistentes; na engine asyncio, também o servidor TCP e o socket UDP.
+        if self.inbound_pool:
+            self.inbound_pool.stop() # Fecha o socket de escuta e as conexões recebidas.
+        engine_thread = self.network_engine.thread if self.network_engine else None
+        for thread in (self.tcp_thread, self.udp_listener_thread, engine_thread):
+            if thread is not None and thread.is_alive():
+                thread.join(2) # A escuta UDP acorda pelo timeout de 1 s do socket.
+        self.presence.close()
+        self.dispatcher.shutdown() # Descarta envios ainda na fila.
+        self.history_sync.shutdown()
+        self.file_transfer.shutdown() # Interrompe as transferências; o .part permite retomar depois.
+        self.storage.stop() # Grava o que ainda estiver na fila de escrita.
+        self.conn.close() # Fecha a conexão de leitura do banco de dados.
+        self.data_dir.release() # Outro processo já pode abrir este diretório.
+
+    def set_username(self, username):
+        self.username = username
+        self.data_dir.save_identity(self.user_id, username) # Próximas execuções já começam com este nome.
+        self.storage.execute('''
+            INSERT OR REPLACE INTO profiles (user_id, username)
+            VALUES (?, ?)
+        ''', (self.user_id, username)) # Gravado em background pela thread de escrita.
+        log.info("[LOGIN] Usuário logado: %s com ID %s", self.username, self.user_id) # Log de depuração.
+
+    def find_free_port(self):
+        for _ in range(100):  # Tenta até 100 vezes.
+            port = random.randint(49152, 65535)  # Intervalo de portas dinâmicas/privadas.
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Cria um socket TCP.
+                sock.bind(('', port)) # Tenta vincular o socket a esta porta.
+                sock.close() # Se o vínculo foi bem-sucedido, a porta está livre, então fecha o socket.
+                return port # Retorna a porta encontrada.
+            except OSError: # Captura o erro se a porta já estiver em uso.
+                continue # Tenta a próxima porta.
+        raise IOError("Nenhuma porta livre encontrada.") # Se não encontrar após 100 tentativas, levanta um erro.
+
+    def parse_seeds(self, value):
+        seeds = set()
+        for item in filter(None, (part.strip() for part in value.split(','))): # "host[:porta_udp],..."
+            host, _, port = item.partition(':')
+            seeds.add((socket.gethostbyname(host), int(port or self.udp_port)))
+        return seeds
+
+    def peer_address(self, peer_id):
+        peer = self.peers.get(peer_id) # Leitura única: a tabela é alterada pela thread UDP.
+        return (peer[0], peer[1]) if peer else None
+
+    def lookup_peer(self, peer_id):
+        peer = self.peers.get(peer_id)
+        if peer:
+            return peer.username, f"{peer.ip}:{peer.port}"
+        next_hop = self.relay.next_hop(peer_id)
+        if next_hop:
+            return self.relay.username(peer_id, peer_id), f"relay {next_hop}"
+        return None # Nem visto diretamente nem alcançável por um relay.
+
+    def send_to_peer(self, peer_id, message, on_done=None, job_id=None):
+        target = peer_id
+        if peer_id not in self.peers:
+            next_hop = self.relay.next_hop(peer_id)
+            if next_hop: # Fora do alcance direto: envelope para o próximo salto.
+                message, target = self.relay.wrap(peer_id, message), next_hop
+        payload = encode_message(message, self.presence.peer_codecs(target)) # Binário se o peer anunciou suporte.
+        data = encode_frame(payload) # Um frame com prefixo de tamanho por mensagem.
+        job_id = job_id or str(uuid.uuid4())
+        if on_done:
+            self.send_callbacks[job_id] = on_done # Registrado antes do envio para não perder o resultado.
+        self.dispatcher.submit(target, data, job_id) # Não bloqueia: o resultado chega por send_status.
+        return job_id
+
+    def fan_out(self, peer_ids, message, on_done):
+        """Envia a mesma mensagem a vários peers em paralelo; o payload é codificado uma vez por conjunto de codecs."""
+        frames = {}
+        for peer_id in peer_ids:
+            callback = lambda error, peer_id=peer_id: on_done(peer_id, error)
+            if peer_id not in self.peers: # Só por relay: cada destino tem seu próprio envelope.
+                self.send_to_peer(peer_id, message, on_done=callback)
+                continue
+            codecs = tuple(self.presence.peer_codecs(peer_id))
+            if codecs not in frames:
+                frames[codecs] = encode_frame(encode_message(message, codecs))
+            job_id = str(uuid.uuid4())
+            self.send_callbacks[job_id] = callback
+            self.dispatcher.submit(peer_id, frames[codecs], job_id) # Um lote por peer: os envios correm em paralelo.
+
+    def conversation_id(self, chat_id):
+        return chat_id if chat_id in self.groups else conversation_key(self.user_id, chat_id) # Num grupo, a conversa é o próprio grupo.
+
+    def handle_send_status(self, job_id, peer_id, status, error):
+        if status != 'sending':
+            callback = self.send_callbacks.pop(job_id, None)
+            if callback:
+                callback(error) # None em caso de sucesso.
+            if status == 'failed' and job_id in self.outbox: # A mensagem ficou na outbox para nova tentativa.
+                status = 'queued'
+        if job_id in self.watched_messages:
+            self.signals.message_status.emit(job_id, status)
+
+    def init_database(self):
+        self.conn = connect_database(self.db_path) # Conexão de leitura da interface. Se o arquivo não existir, ele é criado.
+        self.cursor = self.conn.cursor() # Cria um objeto cursor para executar comandos SQL.
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS profiles (
+                user_id TEXT PRIMARY KEY,
+                username TEXT NOT NULL
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender_id TEXT NOT NULL,
+                receiver_id TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                conversation_id TEXT, -- Chave normalizada da conversa (ver conversation_key)
+                message_id TEXT, -- UUID global da mensagem, igual nos dois peers
+                delivery TEXT -- Mensagens enviadas: 'sent' ou 'delivered' (confirmada pelo destinatário)
+            )
+        ''')
+        columns = [row[1] for row in self.cursor.execute("PRAGMA table_info(messages)")]
+        if 'message_id' not in columns: # Migra bancos criados antes dos IDs de mensagem.
+            self.cursor.execute("ALTER TABLE messages ADD COLUMN message_id TEXT")
+            self.cursor.execute("ALTER TABLE messages ADD COLUMN delivery TEXT")
+            rows = self.cursor.execute("SELECT id, sender_id, receiver_id, timestamp, message FROM messages").fetchall()
+            ids, updates = set(), []
+            for row_id, sender_id, receiver_id, timestamp, content in rows:
+                # Mesmo ID que o outro peer deriva (e que os receptores calculam para frames antigos sem ID).
+                message_id = legacy_message_id(sender_id, receiver_id, timestamp, content)
+                if message_id in ids: # Linha repetida idêntica: o índice único exige um ID próprio.
+                    message_id = str(uuid.uuid5(MESSAGE_NAMESPACE, f"{row_id}|{sender_id}|{receiver_id}|{timestamp}"))
+                ids.add(message_id)
+                updates.append((message_id, row_id))
+            self.cursor.executemany("UPDATE messages SET message_id = ? WHERE id = ?", updates)
+            log.info("[DATABASE] IDs gerados para %s mensagens existentes.", len(rows)) # Log de depuração.
+        if 'conversation_id' not in columns: # Migra bancos criados antes da coluna existir.
+            self.cursor.execute("ALTER TABLE messages ADD COLUMN conversation_id TEXT")
+            self.cursor.execute('''
+                UPDATE messages
+                SET conversation_id = CASE WHEN sender_id < receiver_id
+                    THEN sender_id || ':' || receiver_id
+                    ELSE receiver_id || ':' || sender_id END
+            ''')
+            log.info("[DATABASE] Coluna conversation_id adicionada às mensagens existentes.") # Log de depuração.
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation
+            ON messages (conversation_id, timestamp, id)
+        ''') # Índice para a paginação do histórico por conversa.
+        self.cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_message_id
+            ON messages (message_id)
+        ''') # Retransmissões com o mesmo ID não duplicam linhas.
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS friends (
+                user_id TEXT NOT NULL,
+                friend_id TEXT NOT NULL,
+                friend_username TEXT, -- Adicionada esta coluna para armazenar o nome de usuário do amigo
+                status TEXT NOT NULL, -- 'pending_sent', 'pending_received', 'accepted'
+                PRIMARY KEY (user_id, friend_id)
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                job_id TEXT PRIMARY KEY, -- Mesmo ID usado no envio, para casar o resultado com a mensagem
+                sender_id TEXT NOT NULL,
+                receiver_id TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp DATETIME NOT NULL
+            )
+        ''') # Mensagens aguardando entrega a amigos offline ou inalcançáveis.
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS groups (
+                user_id TEXT NOT NULL,
+                group_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                owner_id TEXT NOT NULL,
+                PRIMARY KEY (user_id, group_id)
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_members (
+                user_id TEXT NOT NULL,
+                group_id TEXT NOT NULL,
+                member_id TEXT NOT NULL,
+                username TEXT,
+                PRIMARY KEY (user_id, group_id, member_id)
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_deliveries (
+                message_id TEXT NOT NULL,
+                member_id TEXT NOT NULL,
+                delivery TEXT NOT NULL, -- 'pending', 'sent' ou 'delivered'
+                PRIMARY KEY (message_id, member_id)
+            ) WITHOUT ROWID
+        ''') # Mensagens de grupo são gravadas uma vez em messages (receiver_id = group_id); a entrega é por membro.
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_group_deliveries_member
+            ON group_deliveries (member_id, delivery)
+        ''') # Pendências de um membro que acabou de voltar.
+        tables = {row[0] for row in self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.search_enabled = True
+        if 'messages_fts' not in tables:
+            try:
+                self.cursor.execute('''
+                    CREATE VIRTUAL TABLE messages_fts USING fts5(
+                        message, content='messages', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2'
+                    )
+                ''') # Índice invertido sobre o texto; o conteúdo continua só na tabela messages.
+                self.cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')") # Indexa o histórico existente.
+                log.info("[DATABASE] Índice de busca FTS5 criado.") # Log de depuração.
+            except sqlite3.OperationalError as e: # SQLite compilado sem FTS5.
+                self.search_enabled = False
+                log.warning("[DATABASE] Busca desabilitada: FTS5 indisponível (%s).", e) # Log de erro.
+        if self.search_enabled: # Gatilhos mantêm o índice atualizado a cada escrita, inclusive as da thread de escrita.
+            self.cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+                END
+            ''')
+            self.cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                END
+            ''')
+            self.cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                    INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+                END
+            ''')
+        if 'sync_state' not in tables:
+            self.cursor.execute('''
+                CREATE TABLE sync_state (
+                    user_id TEXT NOT NULL,
+                    peer_id TEXT NOT NULL,
+                    synced_until TEXT NOT NULL, -- Timestamp até onde a conversa com o peer já foi reconciliada
+                    PRIMARY KEY (user_id, peer_id)
+                )
+            ''')
+            # Mensagens anteriores à sincronização têm IDs gerados localmente, diferentes em cada peer: ficam de fora.
+            self.cursor.execute('''
+                INSERT INTO sync_state (user_id, peer_id, synced_until)
+                SELECT '*', '*', COALESCE(MAX(timestamp), '') FROM messages
+            ''')
+        self.conn.commit() # Salva as alterações no banco de dados.
+        self.storage = StorageWriter(self.db_path) # Todas as escritas passam pela thread de escrita.
+        self.friend_cache = FriendCache(self.storage, self.user_id) # Amigos em memória para o caminho quente.
+        self.friend_cache.load(self.cursor)
+        self.outbox = Outbox(self.storage, self.user_id) # Mensagens pendentes, reenviadas com backoff (job_id = message_id).
+        for entry in self.outbox.load(self.cursor): # Enviadas antes de reiniciar e ainda sem confirmação.
+            self.acks.wait(entry.peer_id, entry.job_id, lambda entry=entry: self.resend_message(entry), delay=0)
+        self.groups = GroupDirectory(self.storage, self.user_id) # Grupos e membros em memória.
+        self.groups.load(self.cursor)
+        self.history_sync = HistorySync(self, self.db_path) # Reconciliação do histórico com amigos que voltam.
+        log.info("[DATABASE] Banco de dados inicializado/verificado.") # Log de depuração.
+
+    def start_network_threads(self):
+        if self.network_engine:
+            self.network_engine.start() # TCP, UDP e envios rodam no event loop, sem thread por conexão.
+            log.info("[NETWORK] Engine asyncio iniciada. UDP: %s, TCP: %s", self.udp_port, self.tcp_port) # Log de depuração.
+            return
+        try:
+            self.presence.open_socket() # Vincula o socket a todas as interfaces de rede na porta UDP fixa.
+            log.info("[UDP LISTENER] Escutando por peers na porta UDP %s", self.udp_port) # Log de depuração.
+            self.udp_listener_thread = threading.Thread(target=self.listen_for_peers, daemon=True)
+            self.udp_listener_thread.start() # Inicia a thread.
+        except OSError as e:
+            log.error("Erro ao bindar socket UDP na porta %s: %s", self.udp_port, e) # Log de erro.
+        self.tcp_thread = threading.Thread(target=self.start_tcp_server, daemon=True)
+        self.tcp_thread.start() # Inicia a thread.
+        log.info("[NETWORK] Threads de rede iniciadas. UDP: %s, TCP: %s", self.udp_port, self.tcp_port) # Log de depuração.
+            
+
+    def broadcast_presence(self):
+        if self.presence_timer:
+            self.presence_timer.cancel() # Anúncio antecipado: reinicia a contagem, como um QTimer.
+        delay = self.presence.announce() # Heartbeat compacto ou perfil completo, conforme o caso.
+        self.presence_timer = self.loop.call_later(delay, self.broadcast_presence)
+
+    def listen_for_peers(self):
+        sock = self.presence.sock # Mesmo socket usado pelos anúncios.
+        while not self.stopping: # Escuta até o nó ser parado.
+            try:
+                data, addr = sock.recvfrom(65535) # Recebe dados de um socket UDP (anúncios de rotas passam de 1 KiB).
+            except socket.timeout:
+                continue # Continua o loop se não receber dados no tempo limite (normal para sockets não bloqueantes).
+            except Exception as e:
+                if self.stopping or sock.fileno() == -1: # Socket fechado: não há mais o que escutar.
+                    return
+                log.warning("Error listening for peers: %s", e) # Log de outros erros.
+                continue
+            self.handle_presence_datagram(data, addr)
+
+    def handle_presence_datagram(self, data, addr):
+        try:
+            self.presence.handle_datagram(data, addr)
+        except (json.JSONDecodeError, FrameError):
+            log.debug("[UDP LISTENER] Erro ao decodificar pacote recebido.") # Log de erro para pacote inválido.
+        except Exception as e:
+            log.warning("Error listening for peers: %s", e) # Log de outros erros.
+
+    def peer_seen(self, peer_id, peer_ip, peer_port, peer_username, timeout=None):
+        previous = self.peers.touch(peer_id, peer_ip, peer_port, peer_username, timeout) # Renova a presença do peer.
+        if previous and (previous.ip, previous.port) != (peer_ip, peer_port):
+            log.debug("[UDP LISTENER] Peer %s mudou de endereço para %s:%s.", peer_id, peer_ip, peer_port) # Log.
+            self.connection_pool.invalidate(peer_id) # A próxima mensagem reconecta no novo endereço.
+        if previous is None or (previous.ip, previous.port) != (peer_ip, peer_port):
+            self.peer_status_batcher.mark(peer_id, True) # Só transições chegam à interface.
+            self.presence.peer_set_changed(joined=True, address=(peer_ip, self.udp_port))
+
+    def check_offline_peers(self):
+        for peer_id, peer in self.peers.expire(): # Apenas os peers cujo prazo venceu.
+            log.debug("[PEER STATUS] Peer %s (%s) marcado como offline.", peer.username, peer_id) # Log de depuração.
+            self.connection_pool.invalidate(peer_id) # Fecha a conexão persistente com o peer.
+            self.peer_status_batcher.mark(peer_id, False) # Avisa a UI para marcar como offline.
+            self.presence.peer_set_changed()
+
+    def start_tcp_server(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Cria um socket TCP.
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Permite o reuso do endereço.
+        server.setblocking(False) # Torna o socket não bloqueante para aceitar múltiplas conexões sem travar.
+        try:
+            server.bind(('0.0.0.0', self.tcp_port)) # Vincula o servidor a todas as interfaces na porta TCP.
+            server.listen(self.tcp_backlog) # Começa a escutar por conexões.
+            log.info("[TCP SERVER] Servidor TCP iniciado na porta %s", self.tcp_port) # Log de depuração.
+        except Exception as e:
+            log.error("Erro ao iniciar servidor TCP na porta %s: %s", self.tcp_port, e) # Log de erro.
+            server.close()
+            return # Sai da thread se não conseguir iniciar o servidor.
+        self.inbound_pool.serve(server) # Threads atendem só as conexões com dados, não uma conexão cada.
+
+    def connection_shed(self, address):
+        CONNECTIONS_SHED.inc()
+        if self.shed_warnings.consume(): # Numa enxurrada de conexões, no máximo um aviso por segundo.
+            log.warning("[TCP SERVER] Sobrecarga: conexão de %s recusada (%s recusadas desde o início).", address, CONNECTIONS_SHED.value) # Log.
+
+    def read_tcp_connection(self, connection, chunk):
+        """Processa o que chegou numa conexão recebida; devolve a pausa exigida pelos limites, ou None quando ela termina."""
+        if self.stopping:
+            return None
+        try:
+            if not connection.frames: # Pausada no meio de uma leitura: termina os frames pendentes antes de ler mais.
+                received = connection.sock.recv_into(chunk) # Lê direto no buffer, sem criar bytes novos.
+                if not received: # Se não houver dados, o cliente desconectou.
+                    log.debug("[TCP HANDLER] Conexão TCP fechada pelo cliente.") # Log.
+                    legacy_payload = connection.reader.finish()
+                    if legacy_payload and self.admit_frame(connection.address, len(legacy_payload)) is not None: # Peers antigos enviam um único JSON sem cabeçalho e fecham.
+                        self.process_tcp_message(legacy_payload)
+                    return None
+                connection.last_active = time.monotonic()
+                connection.frames.extend(connection.reader.feed(chunk[:received])) # Uma leitura pode conter vários frames.
+            while connection.frames:
+                payload = connection.frames.popleft()
+                wait = self.admit_frame(connection.address, len(payload))
+                if wait is not None:
+                    self.process_tcp_message(payload)
+                if wait:
+                    return wait # O restante espera a retomada.
+            return 0
+        except BlockingIOError: # O selector avisou, mas os dados já não estavam lá.
+            return 0
+        except FrameError as e:
+            FRAMES_INVALID.inc()
+            log.warning("[TCP HANDLER ERROR] Frame inválido, encerrando conexão: %s", e) # Log de erro de protocolo.
+        except OSError as e:
+            log.debug("[TCP HANDLER] Conexão de %s encerrada com erro: %s", connection.address, e) # Log.
+        return None
+
+    def admit_frame(self, address, size):
+        """Aplica os limites do endereço remoto a um frame ainda não decodificado (nem descomprimido).
+
+        Devolve quantos segundos esperar antes de ler o próximo frame da conexão, ou None se este deve ser descartado.
+        """
+        wait = self.inbound.admit(address, size)
+        if wait is None:
+            FRAMES_SHED.inc()
+            log.debug("[TCP HANDLER] Limite de %s excedido, frame de %s bytes descartado.", address, size) # Log.
+        elif wait:
+            FRAMES_THROTTLED.inc()
+        return wait
+
+    def process_tcp_message(self, data):
+        if self.stopping: # Banco e envios já encerrados.
+            return
+        FRAMES_IN.inc()
+        BYTES_IN.inc(len(data))
+        try:
+            message = decode_message(data) # Decodifica o payload (binário ou JSON) para um dicionário Python.
+            self.handle_message(message)
+        except (json.JSONDecodeError, FrameError):
+            FRAMES_INVALID.inc()
+            log.warning("[TCP HANDLER] Mensagem malformada recebida.") # Log de erro de decodificação.
+        except Exception as e:
+            log.warning("[TCP HANDLER ERROR] Erro inesperado ao processar mensagem TCP: %s", e) # Log de erro geral.
+
+    def handle_message(self, message):
+        log.debug("[TCP HANDLER] Mensagem TCP recebida: %s de %s", message['type'], message.get('sender_id', 'N/A')) # Log.
+        if message['type'] == 'message':
+            if self.friend_cache.status(message['sender_id']) == 'accepted': # Se for amigo aceito (consulta em memória).
+                timestamp = message.get('timestamp', datetime.now().isoformat())
+                message_id = message.get('message_id') or legacy_message_id(message['sender_id'], self.user_id, timestamp, message['content'])
+                if self.recent_message_ids.add(message_id): # Retransmissões já vistas não são exibidas de novo.
+                    self.signals.new_message.emit(message['sender_id'], message['content'], timestamp, message_id)
+                    log.debug("[TCP HANDLER] Mensagem de chat de %s para %s processada.", message['sender_id'], self.user_id) # Log.
+                    self.storage.execute('''
+                        INSERT OR IGNORE INTO messages (message_id, sender_id, receiver_id, message, timestamp, conversation_id)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (message_id, message['sender_id'], self.user_id, message['content'], timestamp, conversation_key(message['sender_id'], self.user_id)))
+                    log.debug("[TCP HANDLER] Mensagem de chat enviada para gravação no DB.") # Log.
+                else:
+                    log.debug("[TCP HANDLER] Mensagem %s de %s duplicada, ignorada.", message_id, message['sender_id']) # Log.
+                if 'message_id' in message and self.lookup_peer(message['sender_id']): # Confirma também duplicatas: o remetente para de reenviar.
+                    self.send_to_peer(message['sender_id'], {
+                        'type': 'ack',
+                        'sender_id': self.user_id,
+                        'message_id': message_id
+                    })
+            else:
+                MESSAGES_DROPPED.inc()
+                log.debug("[TCP HANDLER] Mensagem de %s ignorada: não é amigo aceito.", message['sender_id']) # Log se não for amigo.
+        elif message['type'] == 'relay':
+            if not self.relay.seen.add(message['relay_id']): # Já passou por aqui: loop na malha.
+                return
+            if message['dst'] == self.user_id:
+                payload = message['payload']
+                if payload.get('sender_id', message['src']) == message['src'] and payload.get('type') != 'relay':
+                    self.handle_message(payload) # Entregue como se tivesse chegado diretamente.
+            else:
+                self.relay.forward(message)
+        elif message['type'] in ('sync_summary', 'sync_ids', 'sync_pull', 'sync_messages'):
+            if self.friend_cache.status(message['sender_id']) == 'accepted': # Histórico só com amigos aceitos.
+                self.history_sync.handle(message)
+        elif message['type'] in ('file_offer', 'file_accept', 'file_reject'):
+            if self.friend_cache.status(message['sender_id']) == 'accepted': # Arquivos só entre amigos aceitos.
+                self.file_transfer.handle(message)
+        elif message['type'] == 'group_message':
+            group_id, sender_id = message['group_id'], message['sender_id']
+            if self.groups.is_member(group_id, sender_id): # Só membros do grupo (não precisam ser amigos).
+                if self.recent_message_ids.add(message['message_id']):
+                    self.signals.new_group_message.emit(group_id, sender_id, message['content'], message['timestamp'], message['message_id'])
+                    self.storage.execute('''
+                        INSERT OR IGNORE INTO messages (message_id, sender_id, receiver_id, message, timestamp, conversation_id)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (message['message_id'], sender_id, group_id, message['content'], message['timestamp'], group_id))
+                if self.lookup_peer(sender_id):
+                    self.send_to_peer(sender_id, {
+                        'type': 'ack',
+                        'sender_id': self.user_id,
+                        'message_id': message['message_id']
+                    })
+            else:
+                MESSAGES_DROPPED.inc()
+                log.debug("[TCP HANDLER] Mensagem de grupo de %s ignorada: grupo desconhecido ou não é membro.", sender_id) # Log.
+        elif message['type'] == 'group_invite':
+            members = message['members']
+            if self.friend_cache.status(message['sender_id']) == 'accepted' and self.user_id in members: # Convites só de amigos.
+                if self.groups.add(message['group_id'], message['name'], message['sender_id'], members):
+                    log.info("[TCP HANDLER] Adicionado ao grupo %s (%s).", message['name'], message['group_id']) # Log.
+                    self.signals.update_friends_list.emit()
+        elif message['type'] == 'ack':
+            self.signals.message_delivered.emit(message['sender_id'], message['message_id']) # Tratado na thread da interface, após a gravação do envio.
+        elif message['type'] == 'friend_request':
+            if message['receiver_id'] == self.user_id:
+                self.friend_cache.add(message['sender_id'], message['sender_username'], 'pending_received') # Só grava se ainda não existir.
+                log.info("[TCP HANDLER] Solicitação de amizade de %s registrada como pendente.", message['sender_id']) # Log.
+                self.signals.friend_request.emit(message['sender_id'], message['sender_username'])
+                log.debug("[TCP HANDLER] Solicitação de amizade de %s para %s processada.", message['sender_id'], self.user_id) # Log.
+            else:
+                log.debug("[TCP HANDLER] Solicitação de amizade para %s ignorada: não é para este usuário.", message['receiver_id']) # Log.
+        elif message['type'] == 'friend_response':
+            if message['receiver_id'] == self.user_id:
+                self.signals.friend_response.emit(message['sender_id'], message['accepted'])
+                log.debug("[TCP HANDLER] Resposta de amizade de %s para %s processada (Aceita: %s).", message['sender_id'], self.user_id, message['accepted']) # Log.
+            else:
+                log.debug("[TCP HANDLER] Resposta de amizade para %s ignorada: não é para este usuário.", message['receiver_id']) # Log.
+
+    def send_friend_request(self, friend_id, on_done=None):
+        """Envia a solicitação; devolve False se o peer não está alcançável. `on_done(error)` recebe o resultado."""
+        peer = self.lookup_peer(friend_id) # Descoberto diretamente ou alcançável por um relay.
+        if not peer:
+            log.warning("[FRIEND REQUEST ERROR] ID %s não encontrado em self.peers. Peers atuais: %s", friend_id, self.peers.ids()) # Log de erro.
+            return False
+        username, location = peer
+        log.info("[FRIEND REQUEST] Tentando enviar solicitação para %s (%s) em %s", username, friend_id, location) # Log.
+        self.send_to_peer(friend_id, {
+            'type': 'friend_request',
+            'sender_id': self.user_id,
+            'sender_username': self.username,
+            'receiver_id': friend_id
+        }, on_done=lambda error: self.friend_request_sent(friend_id, username, error, on_done)) # Envio em background.
+        return True
+
+    def friend_request_sent(self, friend_id, username, error, on_done=None):
+        if error is None:
+            log.info("[FRIEND REQUEST] Dados da solicitação de amizade enviados para %s", friend_id) # Log.
+            self.friend_cache.add(friend_id, username, 'pending_sent') # Salva a alteração.
+        elif isinstance(error, socket.timeout): # Erro se o tempo limite de conexão for excedido.
+            log.warning("[FRIEND REQUEST ERROR] Tempo limite de conexão para %s.", friend_id) # Log de erro.
+        elif isinstance(error, ConnectionRefusedError): # Erro se a conexão for recusada pelo peer.
+            log.warning("[FRIEND REQUEST ERROR] Conexão recusada para %s.", friend_id) # Log de erro.
+        else: # Outros erros.
+            log.warning("[FRIEND REQUEST ERROR] Falha geral ao enviar para %s: %s", friend_id, error) # Log de erro.
+        if on_done:
+            on_done(error)
+
+    def handle_friend_response(self, sender_id, accepted):
+        # Roda no loop, depois do callback de envio que grava o 'pending_sent' (uma resposta rápida não chega antes dele).
+        if accepted:
+            self.friend_cache.set_status(sender_id, 'accepted') # Salva a alteração.
+        else:
+            self.friend_cache.remove(sender_id, 'pending_sent') # Salva a alteração.
+
+    def respond_friend_request(self, sender_id, sender_username, accepted):
+        if self.friend_cache.status(sender_id) != 'pending_received': 
+            self.friend_cache.add(sender_id, sender_username, 'pending_received', replace=True) # Salva a alteração.
+        if accepted:  # Se a solicitação foi aceita.
+            log.info("[FRIEND REQUEST HANDLER] Solicitação de %s (%s) ACEITA.", sender_username, sender_id) # Log.
+            self.friend_cache.set_status(sender_id, 'accepted', sender_username) # Salva a alteração.
+        else:  # Se a solicitação foi rejeitada.
+            log.info("[FRIEND REQUEST HANDLER] Solicitação de %s (%s) REJEITADA.", sender_username, sender_id) # Log.
+            self.friend_cache.remove(sender_id, 'pending_received') # Salva a alteração.
+        self.send_friend_response(sender_id, accepted=accepted)
+
+    def send_friend_response(self, receiver_id, accepted):
+        peer = self.lookup_peer(receiver_id) # Verifica se o peer está online para enviar a resposta.
+        if peer:
+            log.info("[FRIEND RESPONSE] Enviando resposta '%s' para %s em %s", 'Aceito' if accepted else 'Rejeitado', receiver_id, peer[1]) # Log.
+            self.send_to_peer(receiver_id, {
+                'type': 'friend_response',
+                'sender_id': self.user_id,
+                'receiver_id': receiver_id,
+                'accepted': accepted,
+                'sender_username': self.username # Inclui o nome de usuário do remetente.
+            }, on_done=lambda error: self.friend_response_sent(receiver_id, error)) # Envio em background.
+        else:
+            log.warning("Peer %s não encontrado para enviar resposta de amigo.", receiver_id) # Log se o peer estiver offline.
+
+    def friend_response_sent(self, receiver_id, error):
+        if error is None:
+            log.info("[FRIEND RESPONSE] Resposta de amizade enviada com sucesso para %s.", receiver_id) # Log.
+        elif isinstance(error, socket.timeout):
+            log.warning("[FRIEND RESPONSE ERROR] Tempo limite ao enviar resposta para %s.", receiver_id) # Log de erro.
+        elif isinstance(error, ConnectionRefusedError):
+            log.warning("[FRIEND RESPONSE ERROR] Conexão recusada ao enviar resposta para %s.", receiver_id) # Log de erro.
+        else:
+            log.warning("Erro ao enviar resposta de amigo para %s: %s", receiver_id, error) # Log de erro.
+
+    def create_group(self, name, members):
+        """Cria um grupo com `members` ({member_id: username}) e convida cada um; devolve o group_id."""
+        group_id = str(uuid.uuid4())
+        members = dict(members, **{self.user_id: self.username})
+        self.groups.add(group_id, name, self.user_id, members)
+        self.send_group_invite(group_id, [member_id for member_id in members if member_id != self.user_id])
+        return group_id
+
+    def send_group_invite(self, group_id, member_ids):
+        self.fan_out(member_ids, {
+            'type': 'group_invite',
+            'sender_id': self.user_id,
+            'group_id': group_id,
+            'name': self.groups.name(group_id),
+            'members': self.groups.member_names(group_id)
+        }, on_done=lambda member_id, error: error and log.warning("[GROUP] Convite para %s falhou: %s", member_id, error)) # Reenviado quando o membro voltar.
+
+    def send_group_message(self, group_id, content):
+        """Grava a mensagem uma vez e a envia em paralelo aos membros alcançáveis; devolve o message_id."""
+        message_id = str(uuid.uuid4())
+        timestamp = datetime.now().isoformat()
+        members = self.groups.others(group_id)
+        self.storage.execute('''
+            INSERT OR IGNORE INTO messages (message_id, sender_id, receiver_id, message, timestamp, conversation_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (message_id, self.user_id, group_id, content, timestamp, group_id)) # Gravada uma vez, não uma por membro.
+        self.storage.execute('''
+            INSERT OR IGNORE INTO group_deliveries (message_id, member_id, delivery)
+            SELECT ?, member_id, 'pending' FROM group_members
+            WHERE user_id = ? AND group_id = ? AND member_id != ?
+        ''', (message_id, self.user_id, group_id, self.user_id))
+        self.group_sends[message_id] = {'members': set(members), 'sent': set(), 'delivered': set()}
+        self.emit_group_status(message_id)
+        reachable = [member_id for member_id in members if self.lookup_peer(member_id)] # Os demais recebem quando voltarem.
+        log.debug("[GROUP] Enviando para %s de %s membros de %s.", len(reachable), len(members), group_id) # Log.
+        self.deliver_group_message(group_id, message_id, content, timestamp, reachable)
+        return message_id
+
+    def deliver_group_message(self, group_id, message_id, content, timestamp, member_ids):
+        self.fan_out(member_ids, {
+            'type': 'group_message',
+            'message_id': message_id,
+            'group_id': group_id,
+            'sender_id': self.user_id,
+            'content': content,
+            'timestamp': timestamp
+        }, on_done=lambda member_id, error: self.group_message_sent(message_id, member_id, error,
+            lambda: self.deliver_group_message(group_id, message_id, content, timestamp, [member_id])))
+
+    def group_message_sent(self, message_id, member_id, error, resend):
+        if error is not None:
+            log.warning("[GROUP] Falha ao enviar %s para %s: %s. Reenvio quando o membro voltar.", message_id, member_id, error) # Log.
+            return
+        self.storage.execute('''
+            UPDATE group_deliveries SET delivery = 'sent'
+            WHERE message_id = ? AND member_id = ? AND delivery = 'pending'
+        ''', (message_id, member_id)) # A confirmação pode ter chegado antes.
+        state = self.group_sends.get(message_id)
+        if state:
+            state['sent'].add(member_id)
+            self.emit_group_status(message_id)
+        if not state or member_id not in state['delivered']: # O ack pode ter chegado antes.
+            self.acks.wait(member_id, message_id, resend)
+
+    def resend_group_messages(self, member_id):
+        rows = self.cursor.execute('''
+            SELECT m.message_id, m.receiver_id, m.message, m.timestamp
+            FROM group_deliveries d JOIN messages m ON m.message_id = d.message_id
+            WHERE d.member_id = ? AND d.delivery = 'pending' AND m.sender_id = ?
+            ORDER BY m.timestamp
+        ''', (member_id, self.user_id)).fetchall()
+        if rows:
+            log.debug("[GROUP] Reenviando %s mensagem(ns) de grupo para %s.", len(rows), member_id) # Log.
+        for group_id in dict.fromkeys(row[1] for row in rows):
+            self.send_group_invite(group_id, [member_id]) # O convite pode ter se perdido com o membro offline.
+        for message_id, group_id, content, timestamp in rows:
+            self.group_sends.setdefault(message_id, {'members': set(self.groups.others(group_id)), 'sent': set(), 'delivered': set()})
+            self.deliver_group_message(group_id, message_id, content, timestamp, [member_id])
+
+    def emit_group_status(self, message_id):
+        state = self.group_sends[message_id]
+        self.signals.group_status.emit(message_id, len(state['sent']), len(state['delivered']), len(state['members']))
+
+    def send_message(self, peer_id, content):
+        """Envia (ou guarda na outbox) uma mensagem de chat; o status chega por signals.message_status."""
+        current_timestamp = datetime.now().isoformat() # Obtém o timestamp atual.
+        job_id = str(uuid.uuid4())
+        self.watched_messages.add(job_id)
+        peer = self.lookup_peer(peer_id)
+        if peer and not self.outbox.has(peer_id): # Alcançável e sem fila pendente: envio direto.
+            username, location = peer
+            log.debug("[MESSAGE SEND] Tentando enviar mensagem para %s (%s) em %s", username, peer_id, location) # Log.
+            self.send_to_peer(peer_id, {
+                'type': 'message',
+                'message_id': job_id, # O ID do envio é o ID global da mensagem.
+                'sender_id': self.user_id,
+                'content': content,
+                'timestamp': current_timestamp
+            }, on_done=lambda error: self.message_sent(peer_id, content, current_timestamp, error, job_id), job_id=job_id) # Envio em background.
+        else: # Offline (ou com mensagens anteriores na fila, para manter a ordem): guarda para entregar depois.
+            log.debug("[MESSAGE SEND] Amigo %s offline ou com fila pendente. Mensagem guardada na outbox.", peer_id) # Log.
+            self.outbox.enqueue(peer_id, content, current_timestamp, job_id)
+            self.signals.message_status.emit(job_id, 'queued')
+            if peer:
+                self.deliver_outbox(peer_id)
+        return job_id
+
+    def flush_outbox(self):
+        for peer_id in self.outbox.due_peers(): # Só peers fora do backoff e sem lote em voo.
+            if self.lookup_peer(peer_id): # Offline: a fila é enviada quando a descoberta (ou uma rota) o encontrar.
+                self.deliver_outbox(peer_id)
+        resend, abandoned = self.acks.due(self.lookup_peer) # Enviadas sem ack no prazo.
+        for callback in resend:
+            callback()
+        for peer_id, message_id in abandoned:
+            log.warning("[MESSAGE ACK] %s não confirmou a mensagem %s; reenvios encerrados.", peer_id, message_id) # Log.
+            self.outbox.acked(message_id) # Sai da tabela outbox (mensagens de grupo nem estão nela).
+
+    def chat_payload(self, entry):
+        return {
+            'type': 'message',
+            'message_id': entry.job_id,
+            'sender_id': self.user_id,
+            'content': entry.content,
+            'timestamp': entry.timestamp
+        }
+
+    def deliver_outbox(self, peer_id):
+        batch = self.outbox.take(peer_id)
+        if batch:
+            log.debug("[OUTBOX] Enviando %s mensagem(ns) pendente(s) para %s.", len(batch), peer_id) # Log.
+        for entry in batch: # Enviadas em sequência: o dispatcher junta os frames do peer num único envio.
+            self.watched_messages.add(entry.job_id) # A interface pode exibir a entrada como 'na fila'.
+            self.send_to_peer(peer_id, self.chat_payload(entry),
+                              on_done=lambda error, entry=entry: self.outbox_sent(entry, error), job_id=entry.job_id)
+
+    def outbox_sent(self, entry, error):
+        if error is None:
+            self.chat_message_sent(entry)
+        else:
+            log.warning("[OUTBOX] Falha ao entregar para %s: %s. Nova tentativa mais tarde.", entry.peer_id, error) # Log.
+            self.outbox.failed(entry)
+
+    def message_sent(self, peer_id, message, timestamp, error, job_id=None):
+        if error is not None and job_id:
+            entry = self.outbox.enqueue(peer_id, message, timestamp, job_id) # Falha transitória: não perde a mensagem.
+            self.outbox.failed(entry) # Próxima tentativa após o backoff (ou quando o peer for visto de novo).
+        if error is None:
+            log.debug("[MESSAGE SEND] Mensagem enviada para %s.", peer_id) # Log.
+            self.chat_message_sent(OutboxEntry(job_id, peer_id, message, timestamp))
+        elif isinstance(error, socket.timeout):
+            log.warning("[MESSAGE SEND ERROR] Tempo limite de conexão para %s.", peer_id) # Log de erro.
+        elif isinstance(error, ConnectionRefusedError):
+            log.warning("[MESSAGE SEND ERROR] Conexão recusada para %s.", peer_id) # Log de erro.
+        else:
+            log.warning("[MESSAGE SEND ERROR] Falha geral ao enviar para %s: %s", peer_id, error) # Log de erro.
+
+    def chat_message_sent(self, entry):
+        delivery = self.delivery_state(entry.job_id)
+        self.outbox.sent(entry, delivery) # Vai para o histórico (gravado em background pela thread de escrita).
+        if delivery != 'delivered': # Sem o ack, reenvia: o receptor pode ter descartado o frame por sobrecarga.
+            self.acks.wait(entry.peer_id, entry.job_id, lambda: self.resend_message(entry))
+
+    def resend_message(self, entry):
+        log.debug("[MESSAGE ACK] Sem confirmação de %s por %s. Reenviando.", entry.job_id, entry.peer_id) # Log.
+        self.send_to_peer(entry.peer_id, self.chat_payload(entry)) # O receptor descarta a duplicata e confirma de novo.
+
+    def delivery_state(self, message_id):
+        return 'delivered' if message_id in self.acked_message_ids else 'sent'
+
+    def handle_message_delivered(self, peer_id, message_id):
+        log.debug("[MESSAGE ACK] Mensagem %s entregue a %s.", message_id, peer_id) # Log.
+        acked = self.acks.acked(peer_id, message_id)
+        state = self.group_sends.get(message_id)
+        if state: # Mensagem de grupo: a entrega é registrada por membro.
+            state['delivered'].add(peer_id)
+            self.storage.execute('''
+                UPDATE group_deliveries SET delivery = 'delivered'
+                WHERE message_id = ? AND member_id = ?
+            ''', (message_id, peer_id))
+            self.emit_group_status(message_id)
+            return
+        self.acked_message_ids.add(message_id)
+        if acked:
+            self.outbox.acked(message_id) # Confirmada: sai da tabela outbox.
+        self.storage.execute('''
+            UPDATE messages SET delivery = 'delivered'
+            WHERE message_id = ? AND receiver_id = ?
+        ''', (message_id, peer_id)) # Se o INSERT do envio ainda não aconteceu, ele já usa delivery_state.
+        if message_id in self.watched_messages:
+            self.signals.message_status.emit(message_id, 'delivered')
+
+    def history_page(self, chat_id, before=None, limit=HISTORY_PAGE_SIZE, after=None):
+        """Mensagens da conversa, das mais recentes para as mais antigas, antes de `before` = (timestamp, id).
+
+        Com `after`, devolve as mensagens seguintes a essa chave, das mais antigas para as mais recentes: é
+        assim que a interface recarrega páginas novas que descartou enquanto o usuário lia o passado.
+        """
+        conversation_id = self.conversation_id(chat_id)
+        if after is not None:
+            self.cursor.execute('''
+                SELECT id, sender_id, message, timestamp
+                FROM messages
+                WHERE conversation_id = ? AND (timestamp, id) > (?, ?)
+                ORDER BY timestamp ASC, id ASC
+                LIMIT ?
+            ''', (conversation_id, after[0], after[1], limit))
+        elif before is None: # Primeira página: as mensagens mais recentes.
+            self.cursor.execute('''
+                SELECT id, sender_id, message, timestamp
+                FROM messages
+                WHERE conversation_id = ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (conversation_id, limit))
+        else: # Páginas seguintes: paginação por chave a partir da mensagem mais antiga exibida.
+            self.cursor.execute('''
+                SELECT id, sender_id, message, timestamp
+                FROM messages
+                WHERE conversation_id = ? AND (timestamp, id) < (?, ?)
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (conversation_id, before[0], before[1], limit))
+        return self.cursor.fetchall()
+
+    def history_key(self, message_id):
+        """Chave (timestamp, id) de paginação de uma mensagem já gravada, ou None."""
+        self.cursor.execute("SELECT timestamp, id FROM messages WHERE message_id = ?", (message_id,))
+        return self.cursor.fetchone()
+
+    def search_page(self, query, conversation_id=None, offset=0, limit=SEARCH_PAGE_SIZE):
+        """Resultados da busca (sender_id, receiver_id, timestamp, trecho), dos mais recentes para os mais antigos."""
+        if conversation_id:
+            scope, scope_params = "m.conversation_id = ?", (conversation_id,)
+        else: # Conversas 1:1 pelo próprio ID; mensagens de grupo têm o grupo como destinatário.
+            group_ids = tuple(group_id for group_id, _ in self.groups.all())
+            groups = f" OR m.conversation_id IN ({','.join('?' * len(group_ids))})" if group_ids else ""
+            scope, scope_params = f"(m.sender_id = ? OR m.receiver_id = ?{groups})", (self.user_id, self.user_id) + group_ids
+        # CROSS JOIN fixa o índice FTS como laço externo e a ordem por rowid (mais recentes primeiro) dispensa ordenação.
+        return self.cursor.execute(f'''
+            SELECT m.sender_id, m.receiver_id, m.timestamp, snippet(messages_fts, 0, '[', ']', '…', 12)
+            FROM messages_fts CROSS JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ? AND {scope}
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ? OFFSET ?
+        ''', (query,) + scope_params + (limit, offset)).fetchall()
+
+    def schedule_peer_status_flush(self):
+        if not self.peer_status_flush_pending:
+            self.peer_status_flush_pending = True # Transições que chegarem até o disparo entram no mesmo lote.
+            self.loop.call_later(0.016, self.flush_peer_status) # Uma vez por quadro (~60 Hz).
+
+    def flush_peer_status(self):
+        self.peer_status_flush_pending = False
+        if self.stopping: # Disparo agendado antes de stop(): o banco já pode estar fechado.
+            return
+        for peer_id, online in self.peer_status_batcher.drain().items():
+            self.signals.peer_status.emit(peer_id, online)
+            if online and self.outbox.has(peer_id): # O amigo voltou: entrega o backlog num lote.
+                self.outbox.peer_online(peer_id)
+                self.deliver_outbox(peer_id)
+            if online:
+                self.resend_group_messages(peer_id) # Mensagens de grupo que não chegaram a esse membro.
+            if online and self.user_id < peer_id and self.friend_cache.status(peer_id) == 'accepted':
+                self.history_sync.start(peer_id) # Só um dos lados inicia; o protocolo corrige os dois.
+
+def run_headless(name=None, accept_friends=False, data_dir=None, accept_files=False):
+    """Roda um nó sem interface (relay, servidor, testes) até Ctrl+C ou SIGTERM."""
+    loop = EventLoop()
+    node = ChatNode(loop, data_dir=data_dir)
+    if name:
+        node.set_username(name)
+    elif not node.username: # Sem --name, usa o nome gravado na identidade do diretório.
+        log.error("[HEADLESS] Nenhum nome gravado em %s: informe --name.", node.data_dir.path) # Log de erro.
+        node.stop()
+        return 2
+    name = node.username
+    if accept_friends: # Sem ninguém para responder ao diálogo: aceita todas as solicitações.
+        node.signals.friend_request.connect(lambda sender_id, username: node.respond_friend_request(sender_id, username, True))
+    # Ofertas de arquivo: aceita todas com --accept-files (ainda sujeitas ao limite de tamanho e ao espaço livre), senão recusa.
+    node.signals.file_offer.connect(lambda transfer_id, peer_id, file_name, size: node.file_transfer.accept(transfer_id) if accept_files else node.file_transfer.reject(transfer_id))
+    node.signals.new_message.connect(lambda sender_id, content, timestamp, message_id: log.info("[HEADLESS] %s: %s", node.friend_cache.username(sender_id, sender_id), content))
+    signal.signal(signal.SIGTERM, lambda *args: loop.stop())
+    if hasattr(signal, 'SIGUSR1'): # kill -USR1 <pid> escreve as métricas no log (não existe no Windows).
+        signal.signal(signal.SIGUSR1, lambda *args: log.info("[METRICS] %s", METRICS.to_json()))
+    node.start()
+    log.info("[HEADLESS] Nó %s rodando com ID %s (TCP %s). Ctrl+C para sair.", name, node.user_id, node.tcp_port) # Log.
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        node.stop()
+    return 0